@@ -0,0 +1,490 @@
+#!/usr/bin/python
+"""
+Measures how fast the wiki answers requests. It makes a synthetic wiki of the
+size you ask for, starts the server on it with a fake compiler (so Java is
+not needed, and compilation costs a fixed time), and then runs a number of
+client threads against it for a while. Each client repeatedly picks a random
+page and one of these requests:
+
+    index   "/pages/"
+    play    "/pages/<pagename>/play/"
+    edit    "/pages/<pagename>/edit/"
+    save    a POST to "/pages/<pagename>/save/" with a small change
+    res     "/pages/<pagename>/res/<imagename>"
+    jar     "/pages/<pagename>/<version>.jar"
+
+The throughput and the 50th and 99th percentile latencies of each kind of
+request are printed, and saved as JSON so that runs can be compared:
+
+    python bench.py --pages 1000 --clients 20 --output before.json
+    ... change something ...
+    python bench.py --pages 1000 --clients 20 --output after.json
+    python bench.py --compare before.json after.json
+
+Run it from the directory containing "server.py". Use --help for the rest of
+the options.
+"""
+
+import sys, os, time, math, random, shutil, signal, socket, struct, zlib
+import tempfile, threading, subprocess, urllib, httplib, zipfile, optparse
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from storage import OUT_DIR
+from incremental import GAMEDATA
+
+# The kinds of request, and how often each is made by default.
+MIX = [("play", 40), ("res", 20), ("jar", 15), ("index", 10), ("edit", 10),
+       ("save", 5)]
+
+# Files and directories which the server needs besides "wiki". The
+# synthetic wiki links to the real ones.
+SHARED = ["templates", "images", "stylesheet.css", "favicon.ico",
+          "compiler.jar", "nifki-lib.jar"]
+
+# How long the fake compiler takes, in seconds. The server process reads it
+# from its environment.
+COMPILE_SECONDS = float(os.environ.get("NIFKI_BENCH_COMPILE_MS", "50")) / 1000
+
+##############################################################################
+# The synthetic wiki.
+
+def pngChunk(kind, data):
+    return (struct.pack(">I", len(data)) + kind + data +
+            struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+def makePng(size, rng):
+    """Returns a PNG file of a 'size' x 'size' picture of random colours."""
+    rows = []
+    for y in range(size):
+        rows.append("\0" + "".join([chr(rng.randrange(256))
+                                    for x in range(size * 3)]))
+    return ("\x89PNG\r\n\x1a\n" +
+            pngChunk("IHDR",
+                     struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)) +
+            pngChunk("IDAT", zlib.compress("".join(rows))) +
+            pngChunk("IEND", ""))
+
+def makeSource(size, rng, imagenames):
+    """Returns about 'size' bytes of something that looks like a program."""
+    lines = []
+    length = 0
+    while length < size:
+        line = "x%d = x%d + %d;  # %s\n" % (
+            rng.randrange(100), rng.randrange(100), rng.randrange(1000),
+            rng.choice(imagenames or ["nothing"]))
+        lines.append(line)
+        length += len(line)
+    return "".join(lines)
+
+def pageSource(i, sourceSize, images, seed):
+    """Returns the original source code of page 'i'."""
+    rng = random.Random("%d-%d" % (seed, i))
+    return makeSource(sourceSize, rng,
+                      ["image%d" % j for j in range(images)])
+
+def makeProperties(name):
+    return ("name: %s\nwidth: 256\nheight: 256\nmsPerFrame: 40\n"
+            "debug: false\n" % name)
+
+def pageName(i):
+    return "Bench%05d" % i
+
+def readfile(filename):
+    f = file(filename, "rb")
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def writefile(filename, data):
+    f = file(filename, "wb")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+def makeWiki(root, pages, images, sourceSize, seed=0, log=sys.stdout):
+    """
+    Makes a synthetic wiki in 'root' with 'pages' pages, each with 'images'
+    pictures and about 'sourceSize' bytes of source code, and a jar file for
+    each made by 'fakeCompile()'.
+    """
+    rng = random.Random(seed)
+    here = os.path.abspath(os.path.dirname(__file__))
+    for name in SHARED:
+        os.symlink(os.path.join(here, name), os.path.join(root, name))
+    wikiPath = os.path.join(root, "wiki")
+    os.makedirs(os.path.join(wikiPath, OUT_DIR))
+    # A few pictures, shared between the pages like popular ones would be.
+    pictures = [makePng(rng.choice([16, 32, 64]), rng) for i in range(20)]
+    for i in range(pages):
+        pagename = pageName(i)
+        pagedir = os.path.join(wikiPath, pagename)
+        os.makedirs(os.path.join(pagedir, "res"))
+        for j in range(images):
+            writefile(os.path.join(pagedir, "res", "image%d" % j),
+                      rng.choice(pictures))
+        writefile(os.path.join(pagedir, "source.sss"),
+                  pageSource(i, sourceSize, images, seed))
+        writefile(os.path.join(pagedir, "properties.txt"),
+                  makeProperties("Benchmark page %d" % i))
+        fakeCompile(pagename, wikiPath)
+        if (i + 1) % 1000 == 0:
+            log.write("Made %d of %d pages\n" % (i + 1, pages))
+    return wikiPath
+
+##############################################################################
+# The fake compiler.
+
+def fakeCompile(pagename, wikiPath):
+    """
+    Writes a jar file for 'pagename' laid out like the real compiler's: the
+    "compiled" program, a copy of the properties, and the pictures.
+    """
+    pagedir = os.path.join(wikiPath, pagename)
+    jar = zipfile.ZipFile(
+        os.path.join(wikiPath, OUT_DIR, pagename + ".jar"), "w",
+        zipfile.ZIP_DEFLATED)
+    try:
+        source = readfile(os.path.join(pagedir, "source.sss"))
+        jar.writestr(GAMEDATA + "asm.nfk", zlib.compress(source))
+        jar.writestr(GAMEDATA + "properties.txt",
+                     readfile(os.path.join(pagedir, "properties.txt")))
+        resdir = os.path.join(pagedir, "res")
+        imagenames = os.listdir(resdir)
+        imagenames.sort()
+        jar.writestr(GAMEDATA + "resources.txt",
+                     "".join([name + "\n" for name in imagenames]))
+        for name in imagenames:
+            jar.writestr(GAMEDATA + name,
+                         readfile(os.path.join(resdir, name)))
+    finally:
+        jar.close()
+
+def fakeCompilePage(pagename, daemon, wikiPath="wiki"):
+    """
+    A replacement for 'compiledaemon.compilePage()' which takes
+    'COMPILE_SECONDS' and then calls 'fakeCompile()'.
+    """
+    start = time.time()
+    time.sleep(COMPILE_SECONDS)
+    fakeCompile(pagename, wikiPath)
+    return 0, time.time() - start
+
+##############################################################################
+# The server.
+
+# The configuration of the server (see "server.py").
+SERVER_CONFIG = """[global]
+server.socket_port = %(port)d
+server.thread_pool = %(threads)d
+log.error_file = %(log)r
+log.access_file = %(log)r
+nifki.home = %(root)r
+nifki.metricsLog = None
+"""
+
+# Run by the server process.
+SERVER_SCRIPT = """
+import compiledaemon, bench, server
+compiledaemon.compilePage = bench.fakeCompilePage
+server.start()
+"""
+
+def startServer(root, port, threads, compileMs):
+    """
+    Starts the server on the wiki in 'root' and waits until it is listening.
+    Returns the process.
+    """
+    here = os.path.abspath(os.path.dirname(__file__))
+    env = dict(os.environ)
+    config = os.path.join(root, "nifki.conf")
+    writefile(config, SERVER_CONFIG % dict(port=port, threads=threads,
+        log=os.path.join(root, "server.log"), root=root))
+    env["NIFKI_CONFIG"] = config
+    env["NIFKI_BENCH_COMPILE_MS"] = str(compileMs)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [here] + filter(None, [os.environ.get("PYTHONPATH")]))
+    process = subprocess.Popen([sys.executable, "-c", SERVER_SCRIPT],
+                               env=env, cwd=root)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("The server exited with code %d"
+                               % process.returncode)
+        try:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                s.connect(("127.0.0.1", port))
+            finally:
+                s.close()
+            return process
+        except socket.error:
+            time.sleep(0.2)
+    stopServer(process)
+    raise RuntimeError("The server did not start listening on port %d" % port)
+
+def stopServer(process):
+    if process.poll() is not None: return
+    os.kill(process.pid, signal.SIGTERM)
+    deadline = time.time() + 10
+    while process.poll() is None and time.time() < deadline: time.sleep(0.1)
+    if process.poll() is None: os.kill(process.pid, signal.SIGKILL)
+    process.wait()
+
+##############################################################################
+# The clients.
+
+def request(port, method, path, body=None):
+    """
+    Makes one request and reads the whole response. Returns the status code.
+    """
+    conn = httplib.HTTPConnection("127.0.0.1", port)
+    try:
+        headers = {"Accept-Encoding": "gzip"}
+        if body is not None:
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+class Client:
+    """
+    One client thread. Makes requests until 'deadline', and records
+    '(kind, seconds, ok)' for each in 'self.results'. 'options' are those
+    the wiki was made with.
+    """
+    def __init__(self, port, options, mix, deadline, seed):
+        self.port = port
+        self.options = options
+        self.pages = options.pages
+        self.images = options.images
+        self.deadline = deadline
+        self.rng = random.Random(seed)
+        self.kinds = []
+        for (kind, weight) in mix: self.kinds.extend([kind] * weight)
+        self.results = []
+        self.saves = 0
+
+    def makeRequest(self, kind):
+        """Returns '(method, path, body)' for a request of 'kind'."""
+        i = self.rng.randrange(self.pages)
+        pagename = pageName(i)
+        if kind == "index": return "GET", "/pages/", None
+        if kind == "play": return "GET", "/pages/%s/play/" % pagename, None
+        if kind == "edit": return "GET", "/pages/%s/edit/" % pagename, None
+        if kind == "jar": return "GET", "/pages/%s/bench.jar" % pagename, None
+        if kind == "res":
+            return "GET", "/pages/%s/res/image%d" % (
+                pagename, self.rng.randrange(max(self.images, 1))), None
+        # Half of the saves change only the tag line, which people often do.
+        self.saves += 1
+        source = pageSource(i, self.options.sourceSize, self.images,
+                            self.options.seed)
+        if self.saves % 2 == 0: source += "# Edit %d\n" % self.saves
+        return "POST", "/pages/%s/save/" % pagename, urllib.urlencode([
+            ("source", source), ("width", "256"), ("height", "256"),
+            ("msPerFrame", "40"), ("name", "Saved %d" % self.saves),
+            ("newpage", pagename), ("save", "Save as")])
+
+    def run(self):
+        while time.time() < self.deadline:
+            kind = self.rng.choice(self.kinds)
+            if kind == "res" and not self.images: continue
+            method, path, body = self.makeRequest(kind)
+            start = time.time()
+            try:
+                status = request(self.port, method, path, body)
+                ok = status < 400
+            except (socket.error, httplib.HTTPException):
+                ok = False
+            self.results.append((kind, time.time() - start, ok))
+
+def percentile(values, p):
+    """Returns the 'p'th percentile of the sorted list 'values'."""
+    if not values: return 0.0
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+def summarise(results, seconds):
+    """
+    Returns a dict describing 'results', which is a list of '(kind,
+    seconds, ok)' collected over 'seconds'. Latencies are in milliseconds.
+    """
+    times = [t for (kind, t, ok) in results]
+    times.sort()
+    errors = len([ok for (kind, t, ok) in results if not ok])
+    mean = 0.0
+    if times: mean = sum(times) / len(times)
+    return {
+        "count": len(times),
+        "errors": errors,
+        "throughput": round(len(times) / seconds, 2),
+        "mean": round(mean * 1000, 2),
+        "p50": round(percentile(times, 50) * 1000, 2),
+        "p99": round(percentile(times, 99) * 1000, 2),
+        "max": round((times or [0.0])[-1] * 1000, 2),
+    }
+
+def runClients(port, options, mix):
+    """Runs the clients. Returns the summary of their results."""
+    deadline = time.time() + options.duration
+    clients = [Client(port, options, mix, deadline, options.seed * 1000 + i)
+               for i in range(options.clients)]
+    threads = [threading.Thread(target=client.run) for client in clients]
+    start = time.time()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    seconds = time.time() - start
+    results = []
+    for client in clients: results.extend(client.results)
+    summary = {}
+    for (kind, weight) in mix:
+        summary[kind] = summarise([r for r in results if r[0] == kind],
+                                  seconds)
+    summary["total"] = summarise(results, seconds)
+    return summary, seconds
+
+##############################################################################
+# Reports.
+
+COLUMNS = ["count", "errors", "throughput", "mean", "p50", "p99", "max"]
+
+def kindsIn(results):
+    kinds = [kind for (kind, weight) in MIX if kind in results]
+    kinds.extend([kind for kind in results
+                  if kind not in kinds and kind != "total"])
+    return kinds + ["total"]
+
+def printReport(report, out=sys.stdout):
+    out.write("%-8s %8s %8s %10s %9s %9s %9s %9s\n"
+              % tuple(["request"] + COLUMNS))
+    out.write("%-8s %8s %8s %10s %9s %9s %9s %9s\n"
+              % ("", "", "", "per sec", "ms", "ms", "ms", "ms"))
+    results = report["results"]
+    for kind in kindsIn(results):
+        row = results[kind]
+        out.write("%-8s %8d %8d %10.1f %9.1f %9.1f %9.1f %9.1f\n"
+                  % tuple([kind] + [row[column] for column in COLUMNS]))
+
+def compare(old, new, out=sys.stdout):
+    """Prints the throughput and latencies of two reports side by side."""
+    def change(a, b):
+        if not a: return "     -"
+        return "%+5.0f%%" % ((b - a) * 100.0 / a)
+    out.write("%-8s %21s %21s %21s\n"
+              % ("request", "throughput (/sec)", "p50 (ms)", "p99 (ms)"))
+    for kind in kindsIn(new["results"]):
+        if kind not in old["results"]: continue
+        a, b = old["results"][kind], new["results"][kind]
+        out.write("%-8s" % kind)
+        for column in ["throughput", "p50", "p99"]:
+            out.write(" %7.1f %7.1f %s" % (a[column], b[column],
+                                           change(a[column], b[column])))
+        out.write("\n")
+
+def readReport(filename):
+    f = file(filename, "rb")
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+##############################################################################
+
+def parseMix(text):
+    """Parses "play=40,res=20,..." into a list of '(kind, weight)'."""
+    mix = []
+    for item in text.split(","):
+        kind, weight = item.split("=")
+        if kind not in dict(MIX):
+            raise ValueError("Unknown request '%s'" % kind)
+        mix.append((kind, int(weight)))
+    return mix
+
+def main(args):
+    parser = optparse.OptionParser(usage="%prog [options]", description=
+        "Runs a load test against a synthetic wiki (see \"bench.py\").")
+    parser.add_option("--pages", type="int", default=200,
+                      help="number of pages [%default]")
+    parser.add_option("--images", type="int", default=3,
+                      help="pictures per page [%default]")
+    parser.add_option("--source-size", type="int", default=2000,
+                      dest="sourceSize",
+                      help="bytes of source code per page [%default]")
+    parser.add_option("--clients", type="int", default=10,
+                      help="concurrent clients [%default]")
+    parser.add_option("--duration", type="float", default=30,
+                      help="seconds to run the clients for [%default]")
+    parser.add_option("--mix", default=",".join(
+                      ["%s=%d" % item for item in MIX]),
+                      help="relative frequency of each request [%default]")
+    parser.add_option("--compile-ms", type="int", default=50,
+                      dest="compileMs",
+                      help="how long the fake compiler takes [%default]")
+    parser.add_option("--threads", type="int", default=10,
+                      help="server threads [%default]")
+    parser.add_option("--port", type="int", default=8089,
+                      help="port for the server [%default]")
+    parser.add_option("--dir", help="where to make the synthetic wiki, "
+                      "which is kept [a temporary directory]")
+    parser.add_option("--seed", type="int", default=0,
+                      help="seed for the random numbers [%default]")
+    parser.add_option("--output", default="bench.json",
+                      help="file to save the results in [%default]")
+    parser.add_option("--compare", action="store_true",
+                      help="compare the two result files given as arguments")
+    options, args = parser.parse_args(args)
+    if options.compare:
+        if len(args) != 2: parser.error("--compare needs two files")
+        compare(readReport(args[0]), readReport(args[1]))
+        return 0
+    if args: parser.error("unexpected arguments")
+    mix = parseMix(options.mix)
+    socket.setdefaulttimeout(60)
+    root = options.dir
+    if root is None: root = tempfile.mkdtemp(prefix="nifki-bench-")
+    else: os.makedirs(root)
+    try:
+        root = os.path.abspath(root)
+        print "Making %d pages in %s" % (options.pages, root)
+        makeWiki(root, options.pages, options.images, options.sourceSize,
+                 options.seed)
+        process = startServer(root, options.port, options.threads,
+                              options.compileMs)
+        try:
+            print "Running %d clients for %gs" % (options.clients,
+                                                  options.duration)
+            results, seconds = runClients(options.port, options, mix)
+        finally:
+            stopServer(process)
+    finally:
+        if options.dir is None: shutil.rmtree(root, True)
+    report = {
+        "time": int(time.time()),
+        "options": {"pages": options.pages, "images": options.images,
+                    "sourceSize": options.sourceSize,
+                    "clients": options.clients, "mix": dict(mix),
+                    "compileMs": options.compileMs,
+                    "threads": options.threads, "seed": options.seed},
+        "seconds": round(seconds, 2),
+        "results": results,
+    }
+    f = file(options.output, "wb")
+    try:
+        json.dump(report, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+    printReport(report)
+    print "Saved the results in %s" % options.output
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,234 @@
+"""
+Content-addressed storage for the resources attached to pages, so that an
+image used by many pages (usually because they were copied from one another
+with "Save as") is only stored once.
+
+Each distinct file is kept in 'BLOB_DIR' under its SHA-1 hash. Each page has
+a manifest, "manifest.txt", mapping resource names to hashes, one per line in
+the form "<name>: <hash>". The compiler still reads "res/<name>", so those
+files are hard links to the blobs, and cost no extra space. On filesystems
+without hard links we fall back to copying.
+
+Pages made before this existed have no manifest. One is made for them the
+first time it is needed.
+
+Blobs which no page uses any more are deleted by 'collectGarbage()' (run
+"python server.py gc"). It may run while the server is running, so it leaves
+alone blobs changed in the last 'GRACE_SECONDS', which may be about to be
+used; 'add()' touches a blob that is already there for the same reason.
+"""
+
+import os, time, errno, shutil, thread, threading
+from digests import fileDigest
+
+BLOB_DIR = "blobs"
+MANIFEST = "manifest.txt"
+
+# How old, in seconds, an unused blob must be before it is deleted.
+GRACE_SECONDS = 3600
+
+def parseManifest(text):
+    """Parses the contents of a manifest and returns it as a dict."""
+    ans = {}
+    for line in text.split("\n"):
+        line = line.strip()
+        if not line: continue
+        colon = line.find(":")
+        if colon==-1: raise ValueError("Colon missing from '"+line+"'")
+        ans[line[:colon]] = line[colon+1:].strip()
+    return ans
+
+def makeManifest(manifest):
+    """Takes a dict and returns the contents of a manifest."""
+    names = manifest.keys()
+    names.sort()
+    return "".join(["%s: %s\n" % (name, manifest[name]) for name in names])
+
+def linkOrCopy(src, dest):
+    """
+    Makes 'dest' a hard link to 'src', or a copy if that is not possible.
+    Raises 'OSError' with 'errno.EEXIST' if 'dest' already exists.
+    """
+    try:
+        os.link(src, dest)
+    except OSError, e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK): raise
+        if os.path.exists(dest): raise OSError(errno.EEXIST, "File exists")
+        shutil.copyfile(src, dest)
+
+def replaceWithLink(src, dest):
+    """Atomically replaces 'dest' with a hard link to (or copy of) 'src'."""
+    tmpfile = "%s.%d.tmp" % (dest, thread.get_ident())
+    linkOrCopy(src, tmpfile)
+    os.rename(tmpfile, dest)
+
+class BlobStore:
+    """
+    The blobs in 'blobDir', and the manifests of the pages in 'wikiPath'.
+    Manifests are cached in memory, and re-read if they change on disk.
+    """
+    def __init__(self, wikiPath="wiki", blobDir=BLOB_DIR):
+        self.wikiPath = wikiPath
+        self.blobDir = blobDir
+        # Serialises changes to manifests.
+        self.lock = threading.RLock()
+        # Maps page name to '(mtime, manifest)'.
+        self.manifests = {}
+
+    def blobPath(self, digest):
+        """Returns the filename of the blob with hash 'digest'."""
+        return os.path.join(self.blobDir, digest[:2], digest)
+
+    def add(self, filename):
+        """
+        Stores the contents of 'filename' as a blob, unless there is one
+        already, and makes 'filename' a link to the blob. Returns its hash.
+        """
+        digest = fileDigest(filename)
+        blob = self.blobPath(digest)
+        if not os.path.isdir(os.path.dirname(blob)):
+            try: os.makedirs(os.path.dirname(blob))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(blob)): raise
+        try:
+            linkOrCopy(filename, blob)
+        except OSError, e:
+            if e.errno != errno.EEXIST: raise
+            # So that 'collectGarbage()' does not delete it meanwhile.
+            os.utime(blob, None)
+            if not os.path.samefile(filename, blob):
+                replaceWithLink(blob, filename)
+        return digest
+
+    def manifestPath(self, pagename):
+        return os.path.join(self.wikiPath, pagename, MANIFEST)
+
+    def readManifest(self, pagename):
+        """
+        Returns the manifest of 'pagename' as a dict, or 'None' if it hasn't
+        got one.
+        """
+        path = self.manifestPath(pagename)
+        try: mtime = os.path.getmtime(path)
+        except OSError: return None
+        cached = self.manifests.get(pagename)
+        if cached and cached[0] == mtime: return cached[1]
+        f = file(path, "rb")
+        try:
+            manifest = parseManifest(f.read())
+        finally:
+            f.close()
+        self.manifests[pagename] = (mtime, manifest)
+        return manifest
+
+    def writeManifest(self, pagename, manifest):
+        """Replaces the manifest of 'pagename' with 'manifest'."""
+        path = self.manifestPath(pagename)
+        tmpfile = "%s.%d.tmp" % (path, thread.get_ident())
+        f = file(tmpfile, "wb")
+        try:
+            f.write(makeManifest(manifest))
+        finally:
+            f.close()
+        os.rename(tmpfile, path)
+        self.manifests[pagename] = (os.path.getmtime(path), manifest)
+
+    def manifest(self, pagename):
+        """
+        Returns the manifest of 'pagename', making one from its "res"
+        directory if it hasn't got one.
+        """
+        manifest = self.readManifest(pagename)
+        if manifest is None: manifest = self.sync(pagename)
+        return manifest
+
+    def sync(self, pagename):
+        """
+        Makes the manifest of 'pagename' match its "res" directory, moving
+        any files that aren't in the blob store into it. Returns the new
+        manifest.
+        """
+        self.lock.acquire()
+        try:
+            resdir = os.path.join(self.wikiPath, pagename, "res")
+            existing = self.readManifest(pagename)
+            old = existing or {}
+            manifest = {}
+            names = []
+            if os.path.isdir(resdir): names = os.listdir(resdir)
+            for name in names:
+                filename = os.path.join(resdir, name)
+                digest = old.get(name)
+                if digest is None or not os.path.exists(self.blobPath(digest)):
+                    digest = self.add(filename)
+                manifest[name] = digest
+            if existing is None or manifest != existing:
+                self.writeManifest(pagename, manifest)
+            return manifest
+        finally:
+            self.lock.release()
+
+    def addResource(self, pagename, name):
+        """
+        Records that "res/<name>" has been added to 'pagename', moving it
+        into the blob store. Returns its hash.
+        """
+        self.lock.acquire()
+        try:
+            manifest = dict(self.manifest(pagename))
+            digest = self.add(
+                os.path.join(self.wikiPath, pagename, "res", name))
+            manifest[name] = digest
+            self.writeManifest(pagename, manifest)
+            return digest
+        finally:
+            self.lock.release()
+
+    def resourcePath(self, pagename, name):
+        """
+        Returns the filename holding resource 'name' of 'pagename', which is
+        its blob if the manifest knows about it.
+        """
+        digest = self.manifest(pagename).get(name)
+        if digest is not None:
+            blob = self.blobPath(digest)
+            if os.path.exists(blob): return blob
+        return os.path.join(self.wikiPath, pagename, "res", name)
+
+    def copyPage(self, pagename, newpage):
+        """
+        Makes a new page called 'newpage' which is a copy of 'pagename'.
+        The resources are shared with the original rather than copied.
+        """
+        manifest = self.sync(pagename)
+        src = os.path.join(self.wikiPath, pagename)
+        dest = os.path.join(self.wikiPath, newpage)
+        os.mkdir(dest)
+        os.mkdir(os.path.join(dest, "res"))
+        for fname in ["source.sss", "properties.txt"]:
+            shutil.copy2(os.path.join(src, fname), os.path.join(dest, fname))
+        for (name, digest) in manifest.items():
+            linkOrCopy(self.blobPath(digest),
+                       os.path.join(dest, "res", name))
+        self.writeManifest(newpage, manifest)
+
+    def collectGarbage(self, grace=GRACE_SECONDS):
+        """
+        Deletes blobs that no page refers to any more, which are those with
+        no other hard links and have not been changed for 'grace' seconds.
+        Returns the number deleted. Do not use this if the wiki is on a
+        filesystem without hard links.
+        """
+        count = 0
+        before = time.time() - grace
+        if not os.path.isdir(self.blobDir): return count
+        for subdir in os.listdir(self.blobDir):
+            subdir = os.path.join(self.blobDir, subdir)
+            if not os.path.isdir(subdir): continue
+            for name in os.listdir(subdir):
+                blob = os.path.join(subdir, name)
+                st = os.stat(blob)
+                if st.st_nlink == 1 and st.st_mtime < before:
+                    os.remove(blob)
+                    count += 1
+        return count
@@ -0,0 +1,218 @@
+"""
+A cache of compiler output, keyed by a hash of everything the compiler reads:
+the page's "source.sss", "properties.txt" and "res/" files, "compiler.jar"
+itself, the "nifki-lib.jar" that its output runs against, and the way
+"jars.py" packs it. Saving a page without changing it, or making a copy of
+it with "Save as", then reuses the output of an earlier compilation instead
+of running the compiler again.
+
+Cached outputs are kept in 'CACHE_DIR' as "<key>.jar" or "<key>.err". When
+their total size exceeds 'MAX_BYTES', the least recently used are deleted.
+A file's modification time records when it was last used, so that another
+process reading the directory sees the same order.
+
+Each 'CompileCache' only knows the sizes of the files it has seen, so when
+several processes share the directory (as in "rebuild.py"), they should
+pass 'maxBytes=None' and leave it to one process to call 'trim()'.
+"""
+
+import os, time, shutil, thread, threading
+from hashlib import sha1
+from digests import fileDigest
+import jars
+
+CACHE_DIR = "cache/compile"
+MAX_BYTES = 64 * 1024 * 1024
+COMPILER = "compiler.jar"
+OUTPUTS = [".jar", ".err"]
+
+def toolDigests():
+    """
+    Returns the part of 'inputDigests()' which is the same for every page.
+    """
+    return [("compiler", fileDigest(COMPILER)),
+            ("library", fileDigest(jars.LIBRARY)),
+            ("jars", jars.layout())]
+
+def inputDigests(wikiPath, pagename):
+    """
+    Returns a list of '(name, digest)' for everything the compiler reads when
+    compiling 'pagename': "compiler", "library", "jars", "source.sss",
+    "properties.txt", and "res/<resname>" for each resource in alphabetical
+    order. The library is included so that upgrading it, like upgrading the
+    compiler, makes every output out of date. "jars" is not a file but says
+    how 'jars.optimise()' packs the output (see 'jars.layout()').
+    """
+    pagedir = os.path.join(wikiPath, pagename)
+    ans = toolDigests()
+    for fname in ["source.sss", "properties.txt"]:
+        ans.append((fname, fileDigest(os.path.join(pagedir, fname))))
+    resdir = os.path.join(pagedir, "res")
+    if os.path.isdir(resdir):
+        resnames = os.listdir(resdir)
+        resnames.sort()
+        for resname in resnames:
+            ans.append(("res/" + resname,
+                        fileDigest(os.path.join(resdir, resname))))
+    return ans
+
+def storedInputDigests(pageStore, pagename):
+    """
+    Returns what 'inputDigests()' would return for a snapshot of 'pagename'
+    made from 'pageStore' now, without making one.
+    """
+    return toolDigests() + pageStore.pageDigests(pagename)
+
+def inputsKey(inputs):
+    """
+    Returns a hash of 'inputs', which is a list of '(name, digest)' as
+    returned by 'inputDigests()'.
+    """
+    h = sha1()
+    for (name, digest) in inputs:
+        h.update("%s %s\n" % (name, digest))
+    return h.hexdigest()
+
+class CompileCache:
+    """
+    Keeps track of the files in 'cacheDir'. 'entries' maps each key to a list
+    '[lastUsed, size, ext]'. If 'maxBytes' is 'None', nothing is deleted
+    until 'trim()' is called. All methods are safe to call from many
+    threads.
+    """
+    def __init__(self, cacheDir=CACHE_DIR, maxBytes=MAX_BYTES):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.totalBytes = 0
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(cacheDir): os.makedirs(cacheDir)
+        for fname in os.listdir(cacheDir):
+            key, ext = os.path.splitext(fname)
+            if ext not in OUTPUTS: continue
+            st = os.stat(os.path.join(cacheDir, fname))
+            self.entries[key] = [st.st_mtime, st.st_size, ext]
+            self.totalBytes += st.st_size
+
+    def inputKey(self, wikiPath, pagename):
+        """
+        Returns a hash of all the inputs to the compilation of 'pagename'.
+        The page name itself is deliberately not included, so that copies of
+        a page share a key.
+        """
+        return inputsKey(inputDigests(wikiPath, pagename))
+
+    def lookup(self, key):
+        """
+        Returns the filename of the cached output for 'key', or 'None' if
+        there isn't one. Counts a hit or a miss.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry[0] = time.time()
+            cachefile = os.path.join(self.cacheDir, key + entry[2])
+            try: os.utime(cachefile, None)
+            except OSError: pass
+            return cachefile
+        finally:
+            self.lock.release()
+
+    def store(self, key, filename):
+        """
+        Copies the compiler output 'filename' into the cache under 'key', and
+        deletes old entries if the cache is now too big.
+        """
+        ext = os.path.splitext(filename)[1]
+        cachefile = os.path.join(self.cacheDir, key + ext)
+        # Other processes may be storing the same key.
+        tmpfile = "%s.%d-%d.tmp" % (cachefile, os.getpid(), thread.get_ident())
+        shutil.copyfile(filename, tmpfile)
+        os.rename(tmpfile, cachefile)
+        size = os.path.getsize(cachefile)
+        self.lock.acquire()
+        try:
+            old = self.entries.get(key)
+            if old: self.totalBytes -= old[1]
+            self.entries[key] = [time.time(), size, ext]
+            self.totalBytes += size
+            if self.maxBytes is not None: self.evict(self.maxBytes)
+        finally:
+            self.lock.release()
+
+    def trim(self, maxBytes=MAX_BYTES):
+        """
+        Deletes least recently used entries until the cache fits in
+        'maxBytes', for a cache made with 'maxBytes=None'. It only knows
+        about the files that were there when it was made and those it has
+        stored itself.
+        """
+        self.lock.acquire()
+        try:
+            self.evict(maxBytes)
+        finally:
+            self.lock.release()
+
+    def evict(self, maxBytes):
+        """
+        Deletes least recently used entries until the cache fits in
+        'maxBytes'. The caller must hold 'lock'.
+        """
+        if self.totalBytes <= maxBytes: return
+        byAge = [(entry[0], key) for (key, entry) in self.entries.items()]
+        byAge.sort()
+        for (lastUsed, key) in byAge:
+            if self.totalBytes <= maxBytes: break
+            lastUsed, size, ext = self.entries.pop(key)
+            self.totalBytes -= size
+            try: os.remove(os.path.join(self.cacheDir, key + ext))
+            except OSError: pass
+
+    def stats(self):
+        """Returns a dict of counters describing the cache."""
+        return dict(hits=self.hits, misses=self.misses,
+                    entries=len(self.entries), bytes=self.totalBytes)
+
+    def compile(self, pagename, compilePage, wikiPath="wiki"):
+        """
+        Compiles 'pagename' using the function 'compilePage' (which should
+        behave like 'compiledaemon.compilePage()') unless its output is in the
+        cache. Returns a triple '(errcode, seconds, cached)'. The output is
+        only cached if 'errcode' is zero, so a compilation which failed or
+        timed out ('compiledaemon.TIMED_OUT') is tried again next time.
+        """
+        start = time.time()
+        outdir = os.path.join(wikiPath, "nifki-out")
+        key = self.inputKey(wikiPath, pagename)
+        cachefile = self.lookup(key)
+        if cachefile is not None:
+            ext = os.path.splitext(cachefile)[1]
+            outfile = os.path.join(outdir, pagename + ext)
+            tmpfile = "%s.%d.tmp" % (outfile, thread.get_ident())
+            try:
+                shutil.copyfile(cachefile, tmpfile)
+            except IOError:
+                # Evicted by another thread. Compile it after all.
+                cachefile = None
+            else:
+                os.rename(tmpfile, outfile)
+                for other in OUTPUTS:
+                    if other == ext: continue
+                    try: os.remove(os.path.join(outdir, pagename + other))
+                    except OSError: pass
+                os.utime(cachefile, None)
+                return 0, time.time() - start, True
+        errcode, seconds = compilePage(pagename)
+        if errcode == 0 and self.inputKey(wikiPath, pagename) == key:
+            for ext in OUTPUTS:
+                outfile = os.path.join(outdir, pagename + ext)
+                if os.path.exists(outfile):
+                    self.store(key, outfile)
+                    break
+        return errcode, time.time() - start, False
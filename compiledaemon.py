@@ -0,0 +1,266 @@
+"""
+Keeps a Java virtual machine running the Nifki compiler in the background, so
+that saving a page does not pay for starting a new JVM and loading all the
+compiler classes every time.
+
+The daemon is the class 'CompileDaemon' in the "daemon" directory, which must
+be compiled first:
+
+    javac -classpath compiler.jar daemon/CompileDaemon.java
+
+If the daemon cannot be started, or dies, we fall back to running the compiler
+once per page, exactly as we used to.
+
+Every compilation is given 'TIMEOUT' seconds. If it takes longer, the
+process is killed (a daemon is started again for the next page) and an error
+report saying so is written in place of the compiler's output. Compiler
+processes also run with a limit on their memory, and at most 'MAX_COMPILES'
+compilations run at once on the machine, counting those of every process
+that uses this module.
+"""
+
+import os, time, errno, select, signal, threading, subprocess, fcntl
+import multiprocessing
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+JAVA = "/usr/local/share/jdk1.5/bin/java"
+CLASSPATH = os.pathsep.join(["compiler.jar", "daemon"])
+
+# The largest Java heap a compiler process may have, in bytes. This is what
+# really limits the memory a compilation can use.
+HEAP_SIZE = 128 * 1024 * 1024
+
+# Options for every JVM that runs the compiler.
+JAVA_OPTIONS = ["-Xmx%dm" % (HEAP_SIZE // (1024 * 1024))]
+
+# After the daemon fails to start, wait this many seconds before trying again.
+RETRY_INTERVAL = 60
+
+# Seconds of real time allowed for one compilation.
+TIMEOUT = 30
+
+# The exit code 'compilePage()' returns when a compilation takes too long,
+# the same as the "timeout" command's.
+TIMED_OUT = 124
+
+# The limit on the private writable memory (RLIMIT_DATA) of a compiler
+# process, in bytes: the heap, plus room for the JVM's own code, class data
+# and thread stacks. This is only a backstop. It is not a limit on the
+# address space, because a 64-bit JVM reserves (but does not use) more than
+# a few gigabytes of that when it starts, for the class space, the code
+# cache and a malloc arena per thread, and would fail to start. Since Linux
+# 4.7, reserved but untouched memory does not count towards RLIMIT_DATA.
+MEMORY_LIMIT = HEAP_SIZE + 512 * 1024 * 1024
+
+# The most compilations that may run at once, and the lock files used to
+# count them.
+MAX_COMPILES = multiprocessing.cpu_count()
+SLOT_DIR = "cache/slots"
+
+class DaemonError(Exception):
+    """Raised when the daemon is not running or stops responding."""
+
+class CompileTimeout(Exception):
+    """Raised when a compilation takes longer than 'TIMEOUT'."""
+
+def limitResources(cpuSeconds=None):
+    """
+    Returns a function which applies 'MEMORY_LIMIT', and 'cpuSeconds' if
+    given, to the current process. It is run in a new process just before
+    the compiler starts.
+    """
+    def limit():
+        if resource is None: return
+        resource.setrlimit(resource.RLIMIT_DATA, (MEMORY_LIMIT, MEMORY_LIMIT))
+        if cpuSeconds is not None:
+            resource.setrlimit(resource.RLIMIT_CPU, (cpuSeconds, cpuSeconds))
+    return limit
+
+def kill(process):
+    """Kills 'process' at once and waits for it to go."""
+    try:
+        os.kill(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    process.wait()
+
+class CompileDaemon:
+    """
+    Manages one compiler process. Requests are sent down its standard input
+    and replies are read from its standard output, one line each. Only one
+    compilation runs at a time; 'compile()' is safe to call from many threads.
+    """
+    def __init__(self, wikiPath="wiki"):
+        self.wikiPath = wikiPath
+        self.process = None
+        self.lock = threading.Lock()
+        self.lastFailure = None
+
+    def start(self):
+        """
+        Starts the compiler process if it isn't already running. Raises
+        'DaemonError' if it cannot be started.
+        """
+        if self.process is not None and self.process.poll() is None: return
+        self.process = None
+        if (self.lastFailure is not None and
+            time.time() < self.lastFailure + RETRY_INTERVAL):
+            raise DaemonError("Compile daemon recently failed to start")
+        try:
+            # No CPU limit, because the daemon compiles many pages.
+            process = subprocess.Popen(
+                [JAVA] + JAVA_OPTIONS +
+                ["-classpath", CLASSPATH, "CompileDaemon"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True,
+                preexec_fn=limitResources())
+        except OSError, e:
+            self.lastFailure = time.time()
+            raise DaemonError("Could not run %s: %s" % (JAVA, e))
+        if process.stdout.readline().strip() != "ready":
+            self.lastFailure = time.time()
+            self._kill(process)
+            raise DaemonError("Compile daemon did not start")
+        self.lastFailure = None
+        self.process = process
+
+    def stop(self):
+        """Stops the compiler process, if it is running."""
+        self.lock.acquire()
+        try:
+            if self.process is not None:
+                self._kill(self.process)
+                self.process = None
+        finally:
+            self.lock.release()
+
+    def _kill(self, process):
+        try:
+            process.stdin.close()
+            process.wait()
+        except (IOError, OSError):
+            pass
+
+    def compile(self, pagename, wikiPath=None):
+        """
+        Compiles 'pagename' in 'wikiPath' (by default the one given to the
+        constructor). Returns "ok" if the compiler wrote a jar file,
+        "err" if it wrote an error report, or "crash" if it failed to do
+        either. Raises 'DaemonError' if the daemon is not available, or
+        'CompileTimeout' (after killing the daemon) if it takes too long.
+        """
+        wikiPath = wikiPath or self.wikiPath
+        self.lock.acquire()
+        try:
+            self.start()
+            try:
+                self.process.stdin.write("%s %s\n" % (wikiPath, pagename))
+                self.process.stdin.flush()
+                ready = select.select([self.process.stdout], [], [],
+                                      TIMEOUT)[0]
+                if not ready:
+                    kill(self.process)
+                    self.process = None
+                    raise CompileTimeout(pagename)
+                reply = self.process.stdout.readline().split()
+            except (IOError, OSError, select.error):
+                reply = []
+            if len(reply) != 2:
+                self._kill(self.process)
+                self.process = None
+                raise DaemonError("Compile daemon stopped responding")
+            return reply[0]
+        finally:
+            self.lock.release()
+
+def compileOnce(pagename, wikiPath="wiki"):
+    """
+    Runs the compiler in a fresh JVM. Returns the exit code of the process,
+    or raises 'CompileTimeout'. This is the slow way, used when the daemon
+    is unavailable.
+    """
+    try:
+        process = subprocess.Popen(
+            [JAVA] + JAVA_OPTIONS +
+            ["-jar", "compiler.jar", wikiPath, pagename],
+            close_fds=True, preexec_fn=limitResources(TIMEOUT))
+    except OSError:
+        return 127
+    deadline = time.time() + TIMEOUT
+    while process.poll() is None:
+        if time.time() > deadline:
+            kill(process)
+            raise CompileTimeout(pagename)
+        time.sleep(0.05)
+    return process.returncode
+
+def acquireSlot():
+    """
+    Waits until fewer than 'MAX_COMPILES' compilations are running, in this
+    process or any other. Returns a file which must be passed to
+    'releaseSlot()' afterwards. If this process dies, the slot is released
+    by the operating system.
+    """
+    if not os.path.isdir(SLOT_DIR):
+        try: os.makedirs(SLOT_DIR)
+        except OSError:
+            if not os.path.isdir(SLOT_DIR): raise
+    while True:
+        for i in range(MAX_COMPILES):
+            f = file(os.path.join(SLOT_DIR, "%d.lock" % i), "a")
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                f.close()
+                if e.errno not in (errno.EAGAIN, errno.EACCES): raise
+                continue
+            return f
+        time.sleep(0.1)
+
+def releaseSlot(slot):
+    slot.close()
+
+def writeTimeoutReport(pagename, wikiPath):
+    """
+    Replaces whatever the compiler left for 'pagename' with an error report
+    saying that it took too long.
+    """
+    outdir = os.path.join(wikiPath, "nifki-out")
+    try: os.remove(os.path.join(outdir, pagename + ".jar"))
+    except OSError: pass
+    f = file(os.path.join(outdir, pagename + ".err"), "wb")
+    try:
+        f.write("The compiler was stopped because it took more than %d "
+                "seconds to compile this page.\n" % TIMEOUT)
+    finally:
+        f.close()
+
+daemon = CompileDaemon()
+
+def compilePage(pagename, daemon=daemon, wikiPath="wiki"):
+    """
+    Compiles 'pagename' in 'wikiPath', using 'daemon' if possible. Returns a pair
+    '(errcode, seconds)' where 'errcode' is non-zero if the compiler failed to
+    run, and 'seconds' is how long the compilation took, including waiting for
+    a slot. If the compiler takes too long, it is stopped, an error report
+    is written for the user to see, and 'errcode' is 'TIMED_OUT'. The report
+    is not cached like real compile errors are, because the next attempt
+    may well succeed on a less busy machine.
+    """
+    start = time.time()
+    slot = acquireSlot()
+    try:
+        try:
+            try:
+                errcode = int(daemon.compile(pagename, wikiPath) == "crash")
+            except DaemonError:
+                errcode = compileOnce(pagename, wikiPath)
+        except CompileTimeout:
+            writeTimeoutReport(pagename, wikiPath)
+            errcode = TIMED_OUT
+    finally:
+        releaseSlot(slot)
+    return errcode, time.time() - start
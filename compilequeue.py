@@ -0,0 +1,233 @@
+"""
+Runs compilations in the background, so that saving a page does not hold a
+CherryPy thread while the compiler runs. Saves add a job to a queue, and a
+fixed number of worker threads take jobs off it. Each worker has its own
+compiler daemon.
+
+If a page is saved again while it is still waiting to be compiled, the two
+jobs are merged: the compiler reads the page when the job starts, so it will
+see the newest source anyway. If a page is saved while it is being compiled,
+it is compiled again afterwards. No page is ever compiled by two workers at
+once.
+
+The queue holds at most 'MAX_WAITING' pages. When it is full, 'admits()'
+says so, and the server refuses saves of pages which are not already
+waiting, rather than letting the queue grow without limit.
+
+Stopping the queue does not wait for the pages that are still waiting, but
+keeps them: 'pending()' lists them, and those being compiled, so that the
+server can save them in its snapshot and pass them to 'restore()' when it
+starts again.
+"""
+
+import time, math, threading, traceback
+import compiledaemon
+
+NUM_WORKERS = 2
+MAX_WAITING = 20
+
+# Bounds on the number of seconds 'retryAfter()' returns.
+MIN_RETRY = 5
+MAX_RETRY = 300
+
+class CompileQueue:
+    """
+    'compilePage' is a function taking a page name and a 'CompileDaemon' and
+    returning an exit code, as for 'compiledaemon.compilePage()'.
+    """
+    def __init__(self, compilePage, numWorkers=NUM_WORKERS,
+                 maxWaiting=MAX_WAITING):
+        self.compilePage = compilePage
+        self.numWorkers = numWorkers
+        self.maxWaiting = maxWaiting
+        self.cond = threading.Condition()
+        # Page names in the order they were queued.
+        self.waiting = []
+        # Maps each page name in 'waiting' to the time it was queued.
+        self.queuedAt = {}
+        # The page names currently being compiled.
+        self.running = {}
+        # Maps page names to the exit code of their last compilation, for
+        # those pages where it was non-zero.
+        self.failed = {}
+        self.workers = []
+        self.stopping = False
+        self.jobs = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+        self.totalRun = 0.0
+
+    def start(self):
+        """Starts the worker threads."""
+        self.stopping = False
+        for i in range(self.numWorkers):
+            worker = threading.Thread(target=self.work,
+                                      name="compiler-%d" % i)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        """
+        Stops the worker threads once they have finished their current jobs.
+        Jobs still in the queue are kept, and are run if the queue is started
+        again.
+        """
+        self.cond.acquire()
+        try:
+            self.stopping = True
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        for worker in self.workers: worker.join()
+        self.workers = []
+
+    def enqueue(self, pagename):
+        """Arranges for 'pagename' to be compiled, and returns immediately."""
+        self.cond.acquire()
+        try:
+            if pagename in self.queuedAt:
+                self.coalesced += 1
+                return
+            self.waiting.append(pagename)
+            self.queuedAt[pagename] = time.time()
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def pending(self):
+        """
+        Returns a list of the pages which are being compiled or are waiting
+        to be compiled, in the order they should be compiled.
+        """
+        self.cond.acquire()
+        try:
+            return ([p for p in self.running.keys() if p not in self.queuedAt]
+                    + self.waiting)
+        finally:
+            self.cond.release()
+
+    def restore(self, pagenames):
+        """Queues 'pagenames', as returned by 'pending()'."""
+        for pagename in pagenames: self.enqueue(pagename)
+
+    def admits(self, pagename):
+        """
+        Returns 'True' if 'pagename' may be queued now: it is already
+        waiting, or there is room. Otherwise counts a rejection.
+        """
+        self.cond.acquire()
+        try:
+            if (pagename in self.queuedAt or
+                len(self.waiting) < self.maxWaiting):
+                return True
+            self.rejected += 1
+            return False
+        finally:
+            self.cond.release()
+
+    def retryAfter(self):
+        """
+        Returns a guess at how many seconds it will take the workers to get
+        through the pages that are waiting now.
+        """
+        self.cond.acquire()
+        try:
+            meanRun = 1.0
+            if self.jobs: meanRun = self.totalRun / self.jobs
+            seconds = (len(self.waiting) * meanRun /
+                       max(len(self.workers), 1))
+            return int(min(max(math.ceil(seconds), MIN_RETRY), MAX_RETRY))
+        finally:
+            self.cond.release()
+
+    def status(self, pagename):
+        """
+        Returns "queued" if 'pagename' is waiting to be compiled, "compiling"
+        if it is being compiled, otherwise 'None'.
+        """
+        self.cond.acquire()
+        try:
+            if pagename in self.queuedAt: return "queued"
+            if pagename in self.running: return "compiling"
+            return None
+        finally:
+            self.cond.release()
+
+    def errcode(self, pagename):
+        """
+        Returns the exit code of the last compilation of 'pagename' since the
+        server started, or zero if it has not been compiled.
+        """
+        return self.failed.get(pagename, 0)
+
+    def stats(self):
+        """Returns a dict of numbers describing the queue."""
+        self.cond.acquire()
+        try:
+            meanWait = meanRun = 0.0
+            if self.jobs:
+                meanWait = self.totalWait / self.jobs
+                meanRun = self.totalRun / self.jobs
+            oldest = 0.0
+            if self.waiting:
+                oldest = time.time() - self.queuedAt[self.waiting[0]]
+            return dict(
+                workers=len(self.workers), depth=len(self.waiting),
+                running=len(self.running), jobs=self.jobs,
+                coalesced=self.coalesced, rejected=self.rejected,
+                meanWait=meanWait, maxWait=self.maxWait, oldestWait=oldest,
+                meanRun=meanRun)
+        finally:
+            self.cond.release()
+
+    def nextJob(self):
+        """
+        Waits for a page that is not already being compiled, marks it as
+        running, and returns its name. Returns 'None' if the queue is
+        stopping. The caller must hold 'cond'.
+        """
+        while not self.stopping:
+            for pagename in self.waiting:
+                if pagename not in self.running:
+                    self.waiting.remove(pagename)
+                    wait = time.time() - self.queuedAt.pop(pagename)
+                    self.running[pagename] = True
+                    self.jobs += 1
+                    self.totalWait += wait
+                    self.maxWait = max(self.maxWait, wait)
+                    return pagename
+            self.cond.wait()
+        return None
+
+    def work(self):
+        """The main loop of a worker thread."""
+        daemon = compiledaemon.CompileDaemon()
+        try:
+            while True:
+                self.cond.acquire()
+                try:
+                    pagename = self.nextJob()
+                finally:
+                    self.cond.release()
+                if pagename is None: return
+                start = time.time()
+                try:
+                    errcode = self.compilePage(pagename, daemon)
+                except:
+                    traceback.print_exc()
+                    errcode = -1
+                self.cond.acquire()
+                try:
+                    self.totalRun += time.time() - start
+                    del self.running[pagename]
+                    if errcode: self.failed[pagename] = errcode
+                    else: self.failed.pop(pagename, None)
+                    # Another worker may have skipped this page while it ran.
+                    self.cond.notifyAll()
+                finally:
+                    self.cond.release()
+        finally:
+            daemon.stop()
@@ -0,0 +1,174 @@
+"""
+Compressed copies of responses, made once per distinct content and then
+reused. This replaces CherryPy's "gzip" tool, which compresses every
+response afresh.
+
+Each body is identified by the SHA-1 of its bytes. The compressed variants
+are kept in a size-limited LRU cache, and the browser is sent whichever
+variant its "Accept-Encoding" header prefers. Brotli is used if the 'brotli'
+module is installed; gzip is always available. Content types which are
+already compressed, such as jar files and images, are sent as they are.
+"""
+
+import zlib
+from hashlib import sha1
+import cherrypy
+import lru
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MAX_BYTES = 16 * 1024 * 1024
+
+# Bodies shorter than this are not worth compressing.
+MIN_SIZE = 256
+
+COMPRESSIBLE = ["text/html", "text/css", "text/plain", "text/javascript",
+                "application/javascript", "image/x-icon"]
+
+def gzipCompressor():
+    """Returns a zlib compressor object that writes the gzip format."""
+    return zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def gzipBytes(data):
+    compressor = gzipCompressor()
+    return compressor.compress(data) + compressor.flush()
+
+def brotliBytes(data):
+    return brotli.compress(data)
+
+# Maps each encoding we can produce to a function that produces it.
+ENCODERS = {"gzip": gzipBytes}
+if brotli is not None: ENCODERS["br"] = brotliBytes
+
+# Encodings in the order we prefer them, when the browser doesn't mind.
+PREFERENCE = ["br", "gzip"]
+
+def isCompressible(contentType):
+    """Returns 'True' if it is worth compressing 'contentType'."""
+    return contentType.split(";")[0].strip().lower() in COMPRESSIBLE
+
+def chooseEncoding(acceptEncoding, encodings=PREFERENCE):
+    """
+    Parses an "Accept-Encoding" header and returns the best of 'encodings'
+    that it allows and we can produce, or 'None' to send the body
+    uncompressed.
+    """
+    qualities = {}
+    for item in acceptEncoding.split(","):
+        parts = item.split(";")
+        name = parts[0].strip().lower()
+        if not name: continue
+        q = 1.0
+        for param in parts[1:]:
+            param = param.strip()
+            if param.startswith("q="):
+                try: q = float(param[2:])
+                except ValueError: q = 0.0
+        qualities[name] = q
+    best, bestQ = None, 0.0
+    for encoding in encodings:
+        if encoding not in ENCODERS: continue
+        q = qualities.get(encoding, qualities.get("*", 0.0))
+        if q > bestQ: best, bestQ = encoding, q
+    return best
+
+def requestedEncoding(encodings=PREFERENCE):
+    """
+    Returns the best of 'encodings' to use for the current request, or
+    'None'.
+    """
+    return chooseEncoding(
+        cherrypy.request.headers.get("Accept-Encoding", ""), encodings)
+
+class CompressedStore:
+    """
+    An LRU cache of compressed variants, keyed by '(digest, encoding)' where
+    'digest' identifies the uncompressed content.
+    """
+    def __init__(self, maxBytes=MAX_BYTES):
+        self.cache = lru.LRUCache(maxBytes)
+
+    def compressed(self, digest, encoding, getData):
+        """
+        Returns the content identified by 'digest' compressed with
+        'encoding'. 'getData' is a function returning the uncompressed bytes;
+        it is only called if the variant is not already in the cache.
+        """
+        key = (digest, encoding)
+        variant = self.cache.get(key)
+        if variant is None:
+            variant = ENCODERS[encoding](getData())
+            self.cache.put(key, variant, len(variant))
+        return variant
+
+    def stats(self):
+        return self.cache.stats()
+
+store = CompressedStore()
+
+def encodeChunks(body):
+    """Generates the chunks of 'body', encoding any unicode ones as UTF-8."""
+    for chunk in body:
+        if isinstance(chunk, unicode): chunk = chunk.encode("UTF-8")
+        yield chunk
+
+def gzipChunks(body):
+    """Generates a gzipped version of 'body' as it goes along."""
+    compressor = gzipCompressor()
+    for chunk in body:
+        chunk = compressor.compress(chunk)
+        if chunk: yield chunk
+    yield compressor.flush()
+
+def statusCode(response):
+    """
+    Returns the status code of 'response' as a string. Before CherryPy
+    finalizes the response, its status may be 'None' (meaning 200), a number,
+    or a string such as "404 Not Found".
+    """
+    return str(response.status or 200).split()[0]
+
+def compressResponse():
+    """
+    Encodes response bodies as UTF-8 (instead of "tools.encode") and
+    compresses them (instead of "tools.gzip"). Bodies that arrive as a list
+    of strings are compressed through 'store', so identical responses are
+    only compressed once. Streamed bodies are gzipped on the fly. Responses
+    with an "ETag" are left alone, because the tag names one encoding, and
+    'serving.serveFile()' has already chosen it. This is a "before_finalize"
+    hook for 'cherrypy.tools.compression'.
+    """
+    response = cherrypy.response
+    headers = response.headers
+    contentType = headers.get("Content-Type", "")
+    if contentType.startswith("text/") and "charset" not in contentType:
+        contentType += ";charset=utf-8"
+        headers["Content-Type"] = contentType
+    body = encodeChunks(response.body)
+    if ("Content-Encoding" in headers or "ETag" in headers or
+        not isCompressible(contentType) or
+        statusCode(response) != "200"):
+        response.body = body
+        return
+    headers["Vary"] = "Accept-Encoding"
+    if isinstance(response.body, list):
+        encoding = requestedEncoding()
+        data = "".join(body)
+        if encoding is None or len(data) < MIN_SIZE:
+            response.body = [data]
+            return
+        data = store.compressed(sha1(data).hexdigest(), encoding,
+                                lambda: data)
+        response.body = [data]
+        headers["Content-Length"] = str(len(data))
+    elif requestedEncoding(["gzip"]):
+        encoding = "gzip"
+        response.body = gzipChunks(body)
+        headers.pop("Content-Length", None)
+    else:
+        response.body = body
+        return
+    headers["Content-Encoding"] = encoding
@@ -0,0 +1,70 @@
+import java.io.BufferedReader;
+import java.io.File;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+
+import org.sc3d.apt.crazon.compiler.Compiler;
+import org.sc3d.apt.crazon.compiler.LocalFileSystem;
+
+/** A long-running front end to the Nifki compiler. Reads requests from
+ * standard input, one per line, each of the form
+ * <pre>
+ *   &lt;wiki path&gt; &lt;page name&gt;
+ * </pre>
+ * and compiles the named page exactly as
+ * <tt>java -jar compiler.jar &lt;wiki path&gt; &lt;page name&gt;</tt> would.
+ * For each request, writes one line to standard output of the form
+ * <pre>
+ *   &lt;status&gt; &lt;milliseconds&gt;
+ * </pre>
+ * where the status is "ok" if a jar file was written, "err" if an error
+ * report was written, and "crash" if the compiler threw an exception. When
+ * it is ready to receive requests, it writes the line "ready".
+ * <p>
+ * Anything the compiler itself prints is redirected to standard error, so that
+ * it cannot get mixed up with the replies.
+ * <p>
+ * To build: <tt>javac -classpath compiler.jar daemon/CompileDaemon.java</tt>
+ */
+public class CompileDaemon {
+  /** The maximum number of errors to report per compilation. This is the
+   * same value that <tt>Compiler.main()</tt> uses. */
+  public static final int NUM_ERRORS = 10;
+
+  public static void main(String[] args) throws IOException {
+    final PrintStream reply = new PrintStream(
+      new FileOutputStream(FileDescriptor.out), true, "UTF-8"
+    );
+    System.setOut(System.err);
+    final BufferedReader in = new BufferedReader(
+      new InputStreamReader(System.in, "UTF-8")
+    );
+    reply.println("ready");
+    String line;
+    while ((line = in.readLine()) != null) {
+      final int space = line.lastIndexOf(' ');
+      if (space == -1) {
+        System.err.println("CompileDaemon: malformed request '"+line+"'");
+        reply.println("crash 0");
+        continue;
+      }
+      final String wikiPath = line.substring(0, space);
+      final String pageName = line.substring(space+1);
+      final long start = System.currentTimeMillis();
+      String status;
+      try {
+        final Compiler compiler = new Compiler(
+          new LocalFileSystem(new File(wikiPath)), NUM_ERRORS
+        );
+        status = compiler.compile(pageName) ? "ok" : "err";
+      } catch (Throwable t) {
+        t.printStackTrace();
+        status = "crash";
+      }
+      reply.println(status+" "+(System.currentTimeMillis()-start));
+    }
+  }
+}
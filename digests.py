@@ -0,0 +1,69 @@
+"""
+Content hashes of files, remembered so that a file is only read again when its
+inode, modification time or size changes. The inode matters because files are
+replaced by renaming, which can leave the time and size the same.
+
+At most 'MAX_ENTRIES' digests are remembered, the most recently used, and
+files in the build directories (see "storage.py") are not remembered at all.
+"""
+
+import os
+from hashlib import sha1
+import lru
+
+# The most digests to remember.
+MAX_ENTRIES = 50000
+
+# Maps filename to '(inode, mtime, size, digest)'. Each entry counts as one
+# "byte".
+cache = lru.LRUCache(MAX_ENTRIES)
+
+def isRemembered(filename):
+    """
+    Says whether to remember the digest of 'filename'. Files in the build
+    directories are not worth it, because they are only read once, and each
+    is replaced by another file under the same name for the next page.
+    """
+    # Not at the top, because "storage.py" imports this module.
+    import storage
+    return not filename.startswith(storage.BUILD_DIR + os.sep)
+
+def fileDigest(filename):
+    """Returns the SHA-1 digest of the contents of 'filename', in hex."""
+    st = os.stat(filename)
+    cached = cache.get(filename)
+    if cached and cached[:3] == (st.st_ino, st.st_mtime, st.st_size):
+        return cached[3]
+    h = sha1()
+    f = file(filename, "rb")
+    try:
+        while True:
+            chunk = f.read(65536)
+            if not chunk: break
+            h.update(chunk)
+    finally:
+        f.close()
+    digest = h.hexdigest()
+    if isRemembered(filename):
+        cache.put(filename, (st.st_ino, st.st_mtime, st.st_size, digest), 1)
+    return digest
+
+def snapshot():
+    """
+    Returns a list of the remembered '(filename, digest)', most recently
+    used first, for "snapshot.py". Files which no longer exist are left out.
+    """
+    return [(filename, entry) for (filename, entry) in cache.items()
+            if os.path.exists(filename)]
+
+def restore(entries):
+    """
+    Remembers the digests in 'entries', from 'snapshot()' in an earlier run,
+    except for files we already know about. Each is checked against the file
+    before it is used, as usual.
+    """
+    known = dict(cache.items())
+    # Least recently used first, so that they end up in the same order.
+    for i in range(len(entries) - 1, -1, -1):
+        filename, entry = entries[i]
+        if filename not in known: cache.put(filename, entry, 1)
@@ -0,0 +1,269 @@
+"""
+A copy of the read-only parts of the wiki as plain files, so that a
+front-end web server can serve them without asking the Python process. The
+export directory is laid out like the URLs:
+
+    index.html                  the welcome page
+    stylesheet.css, ...         the static files, and "images/"
+    pages/index.html            the first page of the list of pages
+    pages/<pagename>/play/index.html
+                                the play page, or the compiler output
+    pages/<pagename>/<version>.jar
+                                the jar file, named as by 'jarVersion()'
+    pages/<pagename>/res/<name> the pictures
+
+Each of these is a hard link to a file in "files/" named after the SHA-1
+hash of its contents, so each distinct file is only stored once, and the
+front-end may let browsers cache "files/" forever. The hash of every path
+exported is recorded in 'MANIFEST', in the same form as the manifests in
+"blobstore.py", so that exporting again only writes what has changed.
+After a page is exported, only the lines for the paths that changed are
+appended to 'MANIFEST', with "-" for a path that was deleted; later lines
+override earlier ones. It is written afresh by 'exportAll()', and whenever
+the appended lines outnumber the paths.
+Paths which are no longer wanted are deleted, and so are files in "files/"
+when nothing links to them any more.
+
+The front-end should serve a file if it exists, trying "index.html" for
+directories, and pass everything else to the server. Requests with a query
+string must always be passed to the server, because the exported
+"pages/index.html" is only what "/pages/" shows without one: the other
+pages of the list, and searches, are made by the server. Pictures have no
+extension, so it must guess their content type or leave it to the browser.
+A page which is waiting to be compiled is exported when it is done, so
+until then the front-end serves the old version. The site pages, such as
+the list of pages, are only exported again when 'siteVersion()' says they
+have changed.
+"""
+
+import os, threading
+from hashlib import sha1
+from digests import fileDigest
+from blobstore import parseManifest, makeManifest, replaceWithLink
+from storage import OUT_DIR, readfile, writefile
+
+MANIFEST = "export.txt"
+FILES_DIR = "files"
+
+def ensureDirectory(path):
+    if not os.path.isdir(path):
+        try: os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path): raise
+
+class Exporter:
+    """
+    Exports the pages of 'pageStore' to 'exportDir'. 'playPage(pagename)'
+    returns the HTML of a page's play page, or 'None' if it has no output.
+    'sitePages' maps paths to functions returning the HTML of pages which do
+    not belong to any one page, such as the list of pages. 'staticFiles'
+    maps paths to the names of the files to export there. 'siteVersion' is
+    a function returning a value which changes whenever the site pages do.
+    All methods are safe to call from many threads.
+    """
+    def __init__(self, exportDir, pageStore, playPage, sitePages,
+                 staticFiles, siteVersion, wikiPath="wiki"):
+        self.exportDir = exportDir
+        self.pageStore = pageStore
+        self.playPage = playPage
+        self.sitePages = sitePages
+        self.staticFiles = staticFiles
+        self.siteVersion = siteVersion
+        # The 'siteVersion()' when the site pages were last exported.
+        self.siteExported = None
+        self.wikiPath = wikiPath
+        self.lock = threading.Lock()
+        self.manifest = None
+        # '(path, digest)' for each change to 'manifest' not yet written,
+        # with 'None' for a deleted path.
+        self.changes = []
+        # The number of lines appended to 'MANIFEST' since it was written
+        # afresh.
+        self.appended = 0
+        # Counts files written and deleted.
+        self.counts = {"exports": 0, "written": 0, "deleted": 0}
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return dict(self.counts)
+        finally:
+            self.lock.release()
+
+    def loadManifest(self):
+        """
+        Reads 'MANIFEST' the first time it is needed. A last line without a
+        newline was cut short while it was appended, so it is ignored, and
+        the file is written afresh next time.
+        """
+        if self.manifest is not None: return
+        try:
+            text = readfile(os.path.join(self.exportDir, MANIFEST))
+        except IOError:
+            text = ""
+        complete = text[:text.rfind("\n") + 1]
+        manifest = parseManifest(complete)
+        for (path, digest) in manifest.items():
+            if digest == "-": del manifest[path]
+        self.manifest = manifest
+        self.appended = complete.count("\n") - len(manifest)
+        if complete != text:
+            # More than there are paths, so that it is written afresh.
+            self.appended = len(manifest) + 1
+
+    def filePath(self, digest, path):
+        """
+        Returns the filename in "files/" for the contents of 'path', whose
+        hash is 'digest'. The extension of 'path' is kept, if it has one.
+        """
+        ext = os.path.splitext(path)[1]
+        return os.path.join(self.exportDir, FILES_DIR, digest + ext)
+
+    def put(self, path, digest, data=None, filename=None):
+        """
+        Makes 'path' a link to the file in "files/" with hash 'digest',
+        writing 'data' or a copy of 'filename' there if it is missing, unless
+        it is already. It is a copy rather than a link so that only the
+        export links to it, which 'forget()' relies on.
+        """
+        old = self.manifest.get(path)
+        if old == digest: return
+        stored = self.filePath(digest, path)
+        if not os.path.exists(stored):
+            ensureDirectory(os.path.dirname(stored))
+            if data is None: data = readfile(filename)
+            writefile(stored, data)
+        dest = os.path.join(self.exportDir, path)
+        ensureDirectory(os.path.dirname(dest))
+        replaceWithLink(stored, dest)
+        self.manifest[path] = digest
+        self.changes.append((path, digest))
+        if old is not None: self.forget(old, path)
+        self.counts["written"] += 1
+
+    def putHtml(self, path, html):
+        data = html.encode("UTF-8")
+        self.put(path, sha1(data).hexdigest(), data=data)
+
+    def putFile(self, path, filename, digest=None):
+        if digest is None: digest = fileDigest(filename)
+        self.put(path, digest, filename=filename)
+
+    def forget(self, digest, path):
+        """
+        Deletes the file in "files/" that 'path' used to link to, if nothing
+        links to it any more.
+        """
+        stored = self.filePath(digest, path)
+        try:
+            if os.stat(stored).st_nlink == 1: os.remove(stored)
+        except OSError:
+            pass
+
+    def remove(self, path):
+        """Deletes 'path', and forgets its file."""
+        digest = self.manifest.pop(path)
+        self.changes.append((path, None))
+        try: os.remove(os.path.join(self.exportDir, path))
+        except OSError: pass
+        self.forget(digest, path)
+        self.counts["deleted"] += 1
+
+    def removeUnwanted(self, wanted, prefix):
+        """Removes the paths starting with 'prefix' that are not 'wanted'."""
+        for path in self.manifest.keys():
+            if path.startswith(prefix) and path not in wanted:
+                self.remove(path)
+
+    def exportPageFiles(self, pagename):
+        """Exports 'pagename' and returns a dict of the paths written."""
+        prefix = "pages/%s/" % pagename
+        wanted = {}
+        html = self.playPage(pagename)
+        if html is not None:
+            wanted[prefix + "play/index.html"] = True
+            self.putHtml(prefix + "play/index.html", html)
+        jarfile = os.path.join(self.wikiPath, OUT_DIR, pagename + ".jar")
+        if os.path.exists(jarfile):
+            digest = fileDigest(jarfile)
+            # The same name as 'jarVersion()' gives it.
+            path = "%s%s.jar" % (prefix, digest[:16])
+            wanted[path] = True
+            self.putFile(path, jarfile, digest)
+        for (name, digest) in self.pageStore.resourceDigests(pagename).items():
+            path = prefix + "res/" + name
+            wanted[path] = True
+            self.putFile(path, self.pageStore.resourcePath(pagename, name),
+                         digest)
+        self.removeUnwanted(wanted, prefix)
+        return wanted
+
+    def exportSitePages(self, force=False):
+        """
+        Exports 'sitePages' if 'siteVersion()' has changed since they were
+        last exported, or if 'force' is true.
+        """
+        # Before rendering, so that a change made meanwhile is not missed.
+        version = self.siteVersion()
+        if not force and version == self.siteExported: return
+        for (path, render) in self.sitePages.items():
+            self.putHtml(path, render())
+        self.siteExported = version
+
+    def finish(self, afresh=False):
+        """
+        Records what has been exported, after it is all in place, by
+        appending the changes to 'MANIFEST', or by writing it afresh if
+        'afresh' is true or there would be too many appended lines.
+        """
+        filename = os.path.join(self.exportDir, MANIFEST)
+        if afresh or self.appended + len(self.changes) > len(self.manifest):
+            writefile(filename, makeManifest(self.manifest))
+            self.appended = 0
+        elif self.changes:
+            ensureDirectory(self.exportDir)
+            f = file(filename, "ab")
+            try:
+                f.write("".join(["%s: %s\n" % (path, digest or "-")
+                                 for (path, digest) in self.changes]))
+            finally:
+                f.close()
+            self.appended += len(self.changes)
+        self.changes = []
+        self.counts["exports"] += 1
+
+    def exportPage(self, pagename):
+        """
+        Brings the export of 'pagename' and of 'sitePages' up to date. This
+        is called after each page is compiled, so the site pages are only
+        rendered if they have changed.
+        """
+        self.lock.acquire()
+        try:
+            self.loadManifest()
+            self.exportPageFiles(pagename)
+            self.exportSitePages()
+            self.finish()
+        finally:
+            self.lock.release()
+
+    def exportAll(self):
+        """
+        Brings the whole export up to date, including the static files, and
+        removes anything which is no longer wanted.
+        """
+        self.lock.acquire()
+        try:
+            self.loadManifest()
+            wanted = {}
+            for pagename in self.pageStore.listPages():
+                wanted.update(self.exportPageFiles(pagename))
+            self.exportSitePages(force=True)
+            for (path, filename) in self.staticFiles.items():
+                self.putFile(path, filename)
+            for path in self.sitePages.keys() + self.staticFiles.keys():
+                wanted[path] = True
+            self.removeUnwanted(wanted, "")
+            self.finish(afresh=True)
+        finally:
+            self.lock.release()
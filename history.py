@@ -0,0 +1,158 @@
+"""
+The history of each page. Every save adds a revision holding the source and
+properties of the page, so that a bad edit can be undone.
+
+Most revisions are stored as a delta against the one before: the lines they
+share are recorded by position, and only the new lines are stored in full.
+Every so often, a revision is stored in full instead (a "keyframe"), so
+that rebuilding any revision means decompressing one keyframe and applying
+at most 'KEYFRAME_INTERVAL - 1' deltas. Everything is compressed with zlib.
+
+The revisions themselves are kept by the storage backend (see "storage.py").
+"""
+
+import time, zlib, difflib
+import lru
+
+# At most this many revisions in a row are stored without a keyframe.
+KEYFRAME_INTERVAL = 20
+
+# Size of the cache of rebuilt revisions.
+MAX_BYTES = 8 * 1024 * 1024
+
+# Separates the properties from the source in the text of a revision.
+SEPARATOR = "\0\n"
+
+def pageText(source, properties):
+    """Returns the text of a revision, as a (byte) string."""
+    return properties.encode("UTF-8") + SEPARATOR + source.encode("UTF-8")
+
+def splitText(text):
+    """The inverse of 'pageText()'. Returns '(source, properties)'."""
+    properties, source = text.split(SEPARATOR, 1)
+    return source.decode("UTF-8"), properties.decode("UTF-8")
+
+def makeDelta(old, new):
+    """
+    Returns a string describing how to turn 'old' into 'new'. It is a
+    sequence of operations, each starting with a line which is either
+    "=<start> <count>", meaning copy 'count' lines of 'old' starting at line
+    'start', or "+<length>", meaning insert the 'length' bytes that follow.
+    """
+    oldLines = old.splitlines(True)
+    newLines = new.splitlines(True)
+    out = []
+    matcher = difflib.SequenceMatcher(None, oldLines, newLines)
+    for (tag, i1, i2, j1, j2) in matcher.get_opcodes():
+        if tag == "equal":
+            out.append("=%d %d\n" % (i1, i2 - i1))
+        elif j2 > j1:
+            inserted = "".join(newLines[j1:j2])
+            out.append("+%d\n" % len(inserted))
+            out.append(inserted)
+    return "".join(out)
+
+def applyDelta(old, delta):
+    """Returns the result of applying 'delta' to 'old'."""
+    oldLines = old.splitlines(True)
+    out = []
+    pos = 0
+    while pos < len(delta):
+        eol = delta.index("\n", pos)
+        op = delta[pos:eol]
+        pos = eol + 1
+        if op[0] == "=":
+            start, count = [int(x) for x in op[1:].split()]
+            out.extend(oldLines[start:start+count])
+        elif op[0] == "+":
+            length = int(op[1:])
+            out.append(delta[pos:pos+length])
+            pos += length
+        else:
+            raise ValueError("Bad delta operation '%s'" % op)
+    return "".join(out)
+
+class History:
+    """
+    The revisions of the pages in 'storage'. Revisions are numbered from 1.
+    Callers must hold the lock for a page while adding a revision to it.
+    """
+    def __init__(self, storage, keyframeInterval=KEYFRAME_INTERVAL,
+                 maxBytes=MAX_BYTES):
+        self.storage = storage
+        self.keyframeInterval = keyframeInterval
+        # Maps '(pagename, number)' to the text of that revision.
+        self.texts = lru.LRUCache(maxBytes)
+
+    def revisions(self, pagename):
+        """
+        Returns a list of '(number, time, kind, size)' for each revision of
+        'pagename', oldest first. 'kind' is "key" or "delta" and 'size' is
+        the number of bytes stored.
+        """
+        return self.storage.revisionHeaders(pagename)
+
+    def text(self, pagename, number):
+        """
+        Returns the text of revision 'number' of 'pagename'. Raises
+        'KeyError' if there is no such revision.
+        """
+        text = self.texts.get((pagename, number))
+        if text is not None: return text
+        headers = self.revisions(pagename)
+        if not 1 <= number <= len(headers): raise KeyError(number)
+        start = number
+        while headers[start-1][2] != "key": start -= 1
+        text = None
+        for n in range(start, number+1):
+            cached = self.texts.get((pagename, n))
+            if cached is not None:
+                text = cached
+                continue
+            data = zlib.decompress(self.storage.readRevision(pagename, n))
+            if n == start: text = data
+            else: text = applyDelta(text, data)
+        self.texts.put((pagename, number), text, len(text))
+        return text
+
+    def revision(self, pagename, number):
+        """Returns '(source, properties)' for revision 'number'."""
+        return splitText(self.text(pagename, number))
+
+    def add(self, pagename, source, properties):
+        """
+        Records a new revision of 'pagename', unless it is the same as the
+        latest one. Returns the number of the latest revision.
+        """
+        headers = self.revisions(pagename)
+        text = pageText(source, properties)
+        number = len(headers) + 1
+        key = zlib.compress(text, 9)
+        kind, data = "key", key
+        if headers:
+            previous = self.text(pagename, number-1)
+            if text == previous: return number-1
+            sinceKey = 0
+            while headers[-1-sinceKey][2] != "key": sinceKey += 1
+            if sinceKey + 1 < self.keyframeInterval:
+                delta = zlib.compress(makeDelta(previous, text), 9)
+                if len(delta) < len(key): kind, data = "delta", delta
+        self.storage.appendRevision(pagename, number, int(time.time()), kind,
+                                    data)
+        self.texts.put((pagename, number), text, len(text))
+        return number
+
+    def diff(self, pagename, old, new):
+        """
+        Returns a unified diff of the source and properties of revisions
+        'old' and 'new' of 'pagename', as a unicode string.
+        """
+        oldSource, oldProperties = self.revision(pagename, old)
+        newSource, newProperties = self.revision(pagename, new)
+        lines = []
+        for (name, a, b) in [("source.sss", oldSource, newSource),
+                             ("properties.txt", oldProperties, newProperties)]:
+            lines.extend(difflib.unified_diff(a.splitlines(), b.splitlines(),
+                "%s (revision %d)" % (name, old),
+                "%s (revision %d)" % (name, new), lineterm=""))
+        return u"\n".join(lines)
@@ -0,0 +1,330 @@
+"""
+Processing of uploaded images: checking that they really are images, making
+them smaller without changing how they look, and making thumbnails for the
+edit page.
+
+Every upload is checked for the structure of a PNG or JPEG file (chunk
+lengths and CRCs, or JPEG markers from start to end of image), and if the
+Python Imaging Library is installed, it is also decoded. Neither format is
+re-encoded: PNGs have their text chunks dropped and their image data
+recompressed, and JPEGs have their metadata segments dropped, so the pixels
+and colour-management information are exactly as uploaded. Without PIL,
+there are no thumbnails, and the edit page shows the original images.
+
+Thumbnails are kept in 'THUMB_DIR' under the hash of the original image,
+which is the name of its blob (see "blobstore.py"). 'collectGarbage()'
+deletes those whose blob has gone, and the atlases which have not been used
+for 'ATLAS_GRACE_SECONDS'.
+"""
+
+import os, time, struct, zlib, thread, StringIO
+from hashlib import sha1
+from digests import fileDigest
+import lru
+
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+THUMB_DIR = "cache/thumbs"
+THUMB_HEIGHT = 32
+THUMB_MAX_WIDTH = 128
+
+# How long, in seconds, an atlas is kept after it was last used.
+ATLAS_GRACE_SECONDS = 30 * 24 * 60 * 60
+
+# The most atlases whose positions are remembered.
+MAX_ATLASES = 1000
+
+class InvalidImage(Exception):
+    """Raised when an uploaded file cannot be decoded as an image."""
+    pass
+
+def sniffType(head):
+    """
+    Returns the content type of an image whose first few bytes are 'head',
+    or 'None' if it is not a PNG or JPEG image.
+    """
+    if head[1:4] == "PNG": return "image/png"
+    if head[:2] == "\xFF\xD8": return "image/jpeg"
+    return None
+
+# Maps filename to '(mtime, contentType)'.
+contentTypes = {}
+
+def contentType(filename):
+    """Returns the content type of the image in 'filename'."""
+    mtime = os.path.getmtime(filename)
+    cached = contentTypes.get(filename)
+    if cached and cached[0] == mtime: return cached[1]
+    f = file(filename, "rb")
+    try:
+        head = f.read(4)
+    finally:
+        f.close()
+    ans = sniffType(head) or "application/octet-stream"
+    contentTypes[filename] = (mtime, ans)
+    return ans
+
+PNG_SIGNATURE = "\x89PNG\r\n\x1a\n"
+
+# PNG chunks which do not affect how the image looks.
+PNG_TEXT_CHUNKS = ["tEXt", "zTXt", "iTXt", "tIME"]
+
+def pngChunks(data):
+    """
+    Returns a list of '(type, body)' for the chunks of the PNG image 'data'.
+    Raises 'InvalidImage' if the chunks do not fit together, a CRC is wrong,
+    or the image does not start with "IHDR", end with "IEND" and have at
+    least one "IDAT".
+    """
+    if data[:8] != PNG_SIGNATURE: raise InvalidImage("Bad PNG signature")
+    chunks = []
+    pos = 8
+    while pos < len(data):
+        if pos + 12 > len(data): raise InvalidImage("Truncated PNG chunk")
+        length, kind = struct.unpack(">L4s", data[pos:pos+8])
+        end = pos + 8 + length
+        if end + 4 > len(data): raise InvalidImage("Truncated PNG chunk")
+        body = data[pos+8:end]
+        crc = struct.unpack(">L", data[end:end+4])[0]
+        if zlib.crc32(kind + body) & 0xffffffff != crc:
+            raise InvalidImage("Bad CRC in PNG chunk %r" % kind)
+        chunks.append((kind, body))
+        pos = end + 4
+        if kind == "IEND": break
+    kinds = [kind for (kind, body) in chunks]
+    if not kinds or kinds[0] != "IHDR" or kinds[-1] != "IEND":
+        raise InvalidImage("PNG must start with IHDR and end with IEND")
+    if "IDAT" not in kinds: raise InvalidImage("PNG has no image data")
+    return chunks
+
+def optimisePng(chunks):
+    """
+    Returns a PNG image made of 'chunks' without the text chunks, and with
+    the image data recompressed as one "IDAT" at the best zlib level.
+    Everything else, including the bit depth and the colour-management
+    chunks, is kept as it is. Raises 'InvalidImage' if the image data cannot
+    be decompressed.
+    """
+    try:
+        pixels = zlib.decompress("".join(
+            [body for (kind, body) in chunks if kind == "IDAT"]))
+    except zlib.error, e:
+        raise InvalidImage(str(e))
+    out = [PNG_SIGNATURE]
+    for (kind, body) in chunks:
+        if kind in PNG_TEXT_CHUNKS: continue
+        if kind == "IDAT":
+            # All the image data goes where the first "IDAT" was.
+            if pixels is None: continue
+            body = zlib.compress(pixels, 9)
+            pixels = None
+        out.append(struct.pack(">L4s", len(body), kind) + body +
+                   struct.pack(">L", zlib.crc32(kind + body) & 0xffffffff))
+    return "".join(out)
+
+def checkJpeg(data):
+    """
+    Raises 'InvalidImage' unless 'data' is a sequence of JPEG segments
+    starting with a start of image and a frame header, followed by a start
+    of scan and compressed data ending with an end of image marker.
+    """
+    if data[:2] != "\xFF\xD8": raise InvalidImage("Bad JPEG signature")
+    pos = 2
+    frame = False
+    while True:
+        if pos + 4 > len(data) or data[pos] != "\xFF":
+            raise InvalidImage("Bad JPEG segment")
+        marker = ord(data[pos+1])
+        length = (ord(data[pos+2]) << 8) | ord(data[pos+3])
+        if length < 2: raise InvalidImage("Bad JPEG segment")
+        # Start of frame markers, except DHT, JPG and DAC.
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            frame = True
+        pos += 2 + length
+        if marker == 0xDA: break
+    if not frame: raise InvalidImage("JPEG has no frame header")
+    if data.rfind("\xFF\xD9") < pos:
+        raise InvalidImage("JPEG has no end of image marker")
+
+def stripJpegMetadata(data):
+    """
+    Returns the JPEG image 'data' without its comments and application
+    segments, apart from JFIF (APP0), ICC profiles (APP2) and Adobe (APP14)
+    which affect how it is decoded or its colours. The compressed image data
+    is not touched, so this is lossless.
+    """
+    if data[:2] != "\xFF\xD8": return data
+    out = [data[:2]]
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != "\xFF": return data
+        marker = ord(data[pos+1])
+        if marker == 0xDA:
+            # Start of scan: the rest is image data.
+            break
+        length = (ord(data[pos+2]) << 8) | ord(data[pos+3])
+        segment = data[pos:pos+2+length]
+        isApp = 0xE0 <= marker <= 0xEF
+        if not ((isApp and marker not in (0xE0, 0xE2, 0xEE)) or
+                marker == 0xFE):
+            out.append(segment)
+        pos += 2 + length
+    out.append(data[pos:])
+    return "".join(out)
+
+def readfile(filename):
+    f = file(filename, "rb")
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def writefile(filename, data):
+    """Replaces the contents of 'filename' with 'data' atomically."""
+    tmpfile = "%s.%d.tmp" % (filename, thread.get_ident())
+    f = file(tmpfile, "wb")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmpfile, filename)
+
+def ingest(filename):
+    """
+    Checks that 'filename' is a PNG or JPEG image, and rewrites it without
+    metadata and, for PNGs, with the image data recompressed, if that makes
+    it smaller. Raises 'InvalidImage' if it is not well formed or cannot be
+    decoded.
+    """
+    data = readfile(filename)
+    kind = sniffType(data[:4])
+    if kind is None: raise InvalidImage("Not a PNG or JPEG image")
+    if kind == "image/png":
+        smaller = optimisePng(pngChunks(data))
+    else:
+        checkJpeg(data)
+        smaller = stripJpegMetadata(data)
+    if Image is not None:
+        try:
+            Image.open(StringIO.StringIO(data)).verify()
+            Image.open(StringIO.StringIO(data)).load()
+        except Exception, e:
+            raise InvalidImage(str(e))
+    if len(smaller) < len(data): writefile(filename, smaller)
+
+def makeThumbDir():
+    """Creates 'THUMB_DIR' if it does not exist yet."""
+    try: os.makedirs(THUMB_DIR)
+    except OSError:
+        if not os.path.isdir(THUMB_DIR): raise
+
+def resample():
+    """Returns the best resampling filter the installed PIL provides."""
+    return getattr(Image, "LANCZOS", None) or Image.ANTIALIAS
+
+def makeThumbnail(filename):
+    """
+    Returns a PNG image 'THUMB_HEIGHT' pixels high of the image in
+    'filename', as a string.
+    """
+    image = Image.open(filename)
+    if image.mode not in ("RGB", "RGBA"): image = image.convert("RGBA")
+    width, height = image.size
+    thumbWidth = max(1, min(THUMB_MAX_WIDTH,
+                            width * THUMB_HEIGHT / max(1, height)))
+    image = image.resize((thumbWidth, THUMB_HEIGHT), resample())
+    out = StringIO.StringIO()
+    image.save(out, "PNG", optimize=True)
+    return out.getvalue()
+
+def thumbnail(filename):
+    """
+    Returns the name of a file containing a thumbnail of 'filename'.
+    Thumbnails are cached in 'THUMB_DIR' under the hash of the original, so
+    copies of an image share a thumbnail. If PIL is not installed, or the
+    image cannot be decoded, returns 'None'.
+    """
+    if Image is None: return None
+    thumbfile = os.path.join(THUMB_DIR, fileDigest(filename) + ".png")
+    if not os.path.exists(thumbfile):
+        try:
+            data = makeThumbnail(filename)
+        except Exception:
+            return None
+        makeThumbDir()
+        writefile(thumbfile, data)
+    return thumbfile
+
+# Maps atlas keys to a list of '(x, width)' for each image in it. Each
+# entry counts as one "byte".
+atlases = lru.LRUCache(MAX_ATLASES)
+
+def atlas(filenames):
+    """
+    Packs thumbnails of all of 'filenames' side by side into one PNG image,
+    so that the edit page can show them all with a single request. Returns
+    a pair '(atlasfile, positions)' where 'positions' is a list of
+    '(x, width)', one for each of 'filenames', or 'None' if PIL is not
+    installed or there are no images.
+    """
+    if Image is None or not filenames: return None
+    h = sha1()
+    for filename in filenames: h.update(fileDigest(filename) + "\n")
+    key = h.hexdigest()
+    atlasfile = os.path.join(THUMB_DIR, "atlas-%s.png" % key)
+    positions = atlases.get(key)
+    if positions is not None and os.path.exists(atlasfile):
+        touch(atlasfile)
+        return atlasfile, positions
+    thumbfiles = [thumbnail(filename) for filename in filenames]
+    if None in thumbfiles: return None
+    try:
+        thumbs = [Image.open(thumbfile).convert("RGBA")
+                  for thumbfile in thumbfiles]
+    except Exception:
+        return None
+    positions = []
+    x = 0
+    for thumb in thumbs:
+        positions.append((x, thumb.size[0]))
+        x += thumb.size[0]
+    image = Image.new("RGBA", (max(1, x), THUMB_HEIGHT), (0, 0, 0, 0))
+    for (thumb, (x, width)) in zip(thumbs, positions):
+        image.paste(thumb, (x, 0))
+    out = StringIO.StringIO()
+    image.save(out, "PNG", optimize=True)
+    makeThumbDir()
+    writefile(atlasfile, out.getvalue())
+    atlases.put(key, positions, 1)
+    return atlasfile, positions
+
+def touch(filename):
+    """Records that 'filename' has just been used, for 'collectGarbage()'."""
+    try: os.utime(filename, None)
+    except OSError: pass
+
+def collectGarbage(isUsed, grace=ATLAS_GRACE_SECONDS):
+    """
+    Deletes the thumbnails of images whose hash 'd' has 'isUsed(d)' false,
+    and the atlases which have not been used for 'grace' seconds. Either is
+    made again if it is needed. Returns the number of files deleted.
+    """
+    if not os.path.isdir(THUMB_DIR): return 0
+    before = time.time() - grace
+    count = 0
+    for name in os.listdir(THUMB_DIR):
+        filename = os.path.join(THUMB_DIR, name)
+        if name.startswith("atlas-"):
+            unwanted = os.path.getmtime(filename) < before
+        else:
+            unwanted = not isUsed(os.path.splitext(name)[0])
+        if unwanted:
+            os.remove(filename)
+            count += 1
+    return count
@@ -0,0 +1,215 @@
+"""
+Recompiling only what has changed. The jar file made by the compiler holds
+the compiled program, a copy of "properties.txt", and the pictures the
+program uses, all under 'GAMEDATA'. So when a page is saved with the same
+source code (which is most saves: people often change only the tag line or
+the debug flag), we can copy the old jar and replace the entries that have
+changed instead of running the compiler.
+
+This is only done if:
+
+  - the compiler, the library, the source code and the way the jar is
+    packed (see "jars.py") have not changed,
+  - the page still has resources with exactly the same names, and
+  - the current output is a jar file, not an error report.
+
+Anything else gets a full compilation. To know what the current jar was
+made from, the inputs of each page's jar are recorded in 'INPUTS_DIR', in
+the same "<name>: <hash>" form as the manifests in "blobstore.py".
+"""
+
+import os, time, zipfile, thread, threading
+import blobstore, compiledaemon, jars, storage
+from storage import OUT_DIR
+
+GAMEDATA = "org/sc3d/apt/crazon/gamedata/"
+
+INPUTS_DIR = "cache/inputs"
+
+class StaleInputs(Exception):
+    """
+    Raised by 'buildSnapshot()' when the page has changed since the snapshot
+    was made, so the new output is out of date already.
+    """
+
+# Counts how many compilations were done each way.
+counts = {"full": 0, "patched": 0}
+countsLock = threading.Lock()
+
+def count(how):
+    countsLock.acquire()
+    try:
+        counts[how] += 1
+    finally:
+        countsLock.release()
+
+def inputsPath(pagename):
+    return os.path.join(INPUTS_DIR, pagename + ".txt")
+
+def readInputs(pagename):
+    """
+    Returns the inputs of the current jar for 'pagename' as a dict, or
+    'None' if they are not known.
+    """
+    try:
+        f = file(inputsPath(pagename), "rb")
+    except IOError:
+        return None
+    try:
+        return blobstore.parseManifest(f.read())
+    finally:
+        f.close()
+
+def recordInputs(pagename, inputs):
+    """
+    Records 'inputs' (a list of '(name, digest)' as returned by
+    'compilecache.inputDigests()') as those of the current jar.
+    """
+    if not os.path.isdir(INPUTS_DIR):
+        try: os.makedirs(INPUTS_DIR)
+        except OSError:
+            if not os.path.isdir(INPUTS_DIR): raise
+    path = inputsPath(pagename)
+    tmpfile = "%s.%d.tmp" % (path, thread.get_ident())
+    f = file(tmpfile, "wb")
+    try:
+        f.write(blobstore.makeManifest(dict(inputs)))
+    finally:
+        f.close()
+    os.rename(tmpfile, path)
+
+def forgetInputs(pagename):
+    """
+    Says that the inputs of the current jar are unknown. This must be done
+    before the jar is replaced, so that a crash cannot leave a record which
+    does not match the jar.
+    """
+    try: os.remove(inputsPath(pagename))
+    except OSError: pass
+
+def changedInputs(old, new):
+    """
+    Compares the dicts 'old' and 'new' of inputs. Returns a list of the
+    names of the inputs which have changed, or 'None' if the changes need a
+    full compilation.
+    """
+    if old is None: return None
+    for name in ["compiler", "library", "jars", "source.sss"]:
+        if old.get(name) != new.get(name): return None
+    oldRes = [name for name in old if name.startswith("res/")]
+    newRes = [name for name in new if name.startswith("res/")]
+    oldRes.sort()
+    newRes.sort()
+    if oldRes != newRes: return None
+    return [name for name in new if old.get(name) != new[name]]
+
+def readfile(filename):
+    f = file(filename, "rb")
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def patchJar(oldJar, newJar, replacements):
+    """
+    Writes a copy of the jar file 'oldJar' to 'newJar', with the contents of
+    some entries replaced. 'replacements' maps entry names to their new
+    contents. Entries are kept in the same order and with the same
+    compression.
+    """
+    src = zipfile.ZipFile(oldJar, "r")
+    try:
+        dest = zipfile.ZipFile(newJar, "w")
+        try:
+            for info in src.infolist():
+                data = replacements.get(info.filename)
+                if data is None: data = src.read(info.filename)
+                # A fresh 'ZipInfo', so that the sizes are written up front
+                # even if the compiler wrote them after the data.
+                newInfo = zipfile.ZipInfo(info.filename, info.date_time)
+                newInfo.compress_type = info.compress_type
+                newInfo.external_attr = info.external_attr
+                newInfo.extra = info.extra
+                dest.writestr(newInfo, data)
+        finally:
+            dest.close()
+    finally:
+        src.close()
+
+def compilePage(pagename, buildPath, inputs, compileFully, wikiPath="wiki"):
+    """
+    Makes the output for the snapshot of 'pagename' in 'buildPath', whose
+    inputs are 'inputs', by patching the current jar in 'wikiPath' if
+    possible, or else by calling 'compileFully()', which should behave like
+    'compiledaemon.compilePage()'. Returns '(errcode, seconds)'.
+    """
+    start = time.time()
+    jarfile = os.path.join(wikiPath, OUT_DIR, pagename + ".jar")
+    changed = None
+    if os.path.exists(jarfile):
+        changed = changedInputs(readInputs(pagename), dict(inputs))
+    if changed is None:
+        count("full")
+        return compileFully()
+    pagedir = os.path.join(buildPath, pagename)
+    replacements = {}
+    for name in changed:
+        if name.startswith("res/"): entry = GAMEDATA + name[4:]
+        else: entry = GAMEDATA + name
+        replacements[entry] = readfile(os.path.join(pagedir, name))
+    tmpfile = os.path.join(buildPath, OUT_DIR, pagename + ".jar.tmp")
+    try:
+        src = zipfile.ZipFile(jarfile, "r")
+        try:
+            names = src.namelist()
+        finally:
+            src.close()
+        # Pictures which the program does not use are not in the jar.
+        for entry in replacements.keys():
+            if entry not in names: del replacements[entry]
+        patchJar(jarfile, tmpfile, replacements)
+    except (IOError, zipfile.BadZipfile):
+        # The jar has gone, or is not what we expected.
+        count("full")
+        return compileFully()
+    os.rename(tmpfile, os.path.join(buildPath, OUT_DIR, pagename + ".jar"))
+    count("patched")
+    return 0, time.time() - start
+
+def compileAndOptimise(pagename, daemon, buildPath, inputs):
+    """
+    Calls 'compilePage()', using 'daemon' if a full compilation is needed,
+    then passes the jar, if there is one, through 'jars.optimise()'. Returns
+    '(errcode, seconds)'.
+    """
+    errcode, seconds = compilePage(pagename, buildPath, inputs,
+        lambda: compiledaemon.compilePage(pagename, daemon, buildPath))
+    jarfile = os.path.join(buildPath, OUT_DIR, pagename + ".jar")
+    if os.path.exists(jarfile):
+        start = time.time()
+        jars.optimise(jarfile)
+        seconds += time.time() - start
+    return errcode, seconds
+
+def buildSnapshot(pagename, daemon, buildPath, inputs, compileCache,
+                  isCurrent=None):
+    """
+    Makes the output for the snapshot of 'pagename' in 'buildPath', whose
+    inputs are 'inputs', using 'compileCache', then 'compileAndOptimise()',
+    and replaces the old output in "wiki" with the new. Cached outputs have
+    been optimised already. Returns '(errcode, seconds, cached)'.
+
+    If 'isCurrent' is given, it is called just before the output is
+    published, and if it returns 'False' the output is left unpublished and
+    'StaleInputs' is raised. This is for callers which, unlike the server,
+    do not hold the page lock while the page is being saved.
+    """
+    errcode, seconds, cached = compileCache.compile(pagename,
+        lambda pagename: compileAndOptimise(pagename, daemon, buildPath,
+                                            inputs),
+        buildPath)
+    if isCurrent is not None and not isCurrent(): raise StaleInputs(pagename)
+    forgetInputs(pagename)
+    if storage.publishOutput(buildPath, pagename) == ".jar":
+        recordInputs(pagename, inputs)
+    return errcode, seconds, cached
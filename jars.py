@@ -0,0 +1,243 @@
+"""
+Makes the jar files written by the compiler smaller before they are served.
+The compiler deflates every entry at the default level, including the
+pictures, which are PNG or JPEG files and so are compressed already, and it
+adds a directory entry which the applet does not need. 'optimise()'
+rewrites a jar with every entry deflated as hard as zlib can, except those
+which deflate does not make smaller, which are stored; it drops directory
+entries and all but the last of any entries with the same name.
+
+If 'COMBINE_LIBRARY' is set, it also copies into each jar the classes of
+"nifki-lib.jar" that the applet needs, and removes the "Class-Path" from the
+manifest and the index that points into the library, so that starting a
+game downloads one archive instead of two. The playing page must then list
+only the page's jar (see 'archive()').
+
+The zip file is written directly, because 'zipfile' always deflates at the
+default level.
+"""
+
+import os, re, struct, zlib, thread, threading, zipfile
+import imaging
+
+LIBRARY = "nifki-lib.jar"
+
+# The applet class named in "templates/playing.html".
+APPLET_CLASS = "org/sc3d/apt/crazon/vm/NifkiApplet.class"
+
+MANIFEST = "META-INF/MANIFEST.MF"
+INDEX = "META-INF/INDEX.LIST"
+
+# Whether to copy the library into each page's jar.
+COMBINE_LIBRARY = False
+
+def archive(pagename, version):
+    """Returns the "archive" attribute of the applet tag for 'pagename'."""
+    jar = "pages/%s/%s.jar" % (pagename, version)
+    if COMBINE_LIBRARY: return jar
+    return "%s, %s" % (LIBRARY, jar)
+
+def layout():
+    """
+    Returns a string describing the jars that 'optimise()' makes, for the
+    compile cache, so that changing 'COMBINE_LIBRARY' makes every output out
+    of date.
+    """
+    return ["separate", "combined"][COMBINE_LIBRARY]
+
+# Counts what 'optimise()' has done.
+counts = {"optimised": 0, "bytesIn": 0, "bytesOut": 0}
+countsLock = threading.Lock()
+
+##############################################################################
+# Finding the classes the applet needs.
+
+# Matches a class name in a class file, in either of the forms "a/b/C" (a
+# reference) or "a.b.C" (a string passed to 'Class.forName()').
+CLASS_NAME = re.compile(r"org[/.]sc3d[/.][A-Za-z0-9_$/.]+")
+
+# Maps '(filename, mtime)' of a library to the result of 'neededClasses()'.
+neededCache = {}
+
+def neededClasses(library=LIBRARY):
+    """
+    Returns a sorted list of the names of the class files in 'library' that
+    can be reached from 'APPLET_CLASS'. Every class name mentioned anywhere
+    in a class file counts as a reference, which finds the constant pool
+    entries, the types in signatures, and the names that the applet loads by
+    reflection. This may include a few classes which are not needed, but
+    never leaves out one that is.
+    """
+    key = (library, os.stat(library).st_mtime)
+    ans = neededCache.get(key)
+    if ans is not None: return ans
+    lib = zipfile.ZipFile(library, "r")
+    try:
+        names = dict([(name, True) for name in lib.namelist()])
+        found = {APPLET_CLASS: True}
+        todo = [APPLET_CLASS]
+        while todo:
+            data = lib.read(todo.pop())
+            for match in CLASS_NAME.findall(data):
+                name = match.replace(".", "/").rstrip("/") + ".class"
+                if name in names and name not in found:
+                    found[name] = True
+                    todo.append(name)
+    finally:
+        lib.close()
+    ans = found.keys()
+    ans.sort()
+    neededCache.clear()
+    neededCache[key] = ans
+    return ans
+
+def stripClassPath(manifest):
+    """Removes the "Class-Path" attribute from the text of a manifest."""
+    lines = manifest.replace("\r\n", "\n").split("\n")
+    ans = []
+    skipping = False
+    for line in lines:
+        # Long values are continued on lines starting with a space.
+        if skipping and line.startswith(" "): continue
+        skipping = line.lower().startswith("class-path:")
+        if not skipping: ans.append(line)
+    return "\r\n".join(ans)
+
+##############################################################################
+# Writing zip files.
+
+def dosTime(dateTime):
+    """Returns '(time, date)' in the MS-DOS form used in zip files."""
+    year, month, day, hour, minute, second = dateTime
+    if year < 1980:
+        year, month, day, hour, minute, second = 1980, 1, 1, 0, 0, 0
+    return ((hour << 11) | (minute << 5) | (second // 2),
+            ((year - 1980) << 9) | (month << 5) | day)
+
+def deflate(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+def isCompressed(data):
+    """Says whether 'data' is a picture format which is compressed already."""
+    return imaging.sniffType(data[:16]) is not None
+
+def writeZip(f, entries):
+    """
+    Writes a zip file to 'f' containing 'entries', which is a list of
+    '(name, dateTime, data)'. Returns the number of bytes written.
+    """
+    offset = 0
+    directory = []
+    for (name, dateTime, data) in entries:
+        crc = zlib.crc32(data) & 0xffffffff
+        method = zipfile.ZIP_STORED
+        packed = data
+        if not isCompressed(data):
+            deflated = deflate(data)
+            if len(deflated) < len(data):
+                method = zipfile.ZIP_DEFLATED
+                packed = deflated
+        dtime, ddate = dosTime(dateTime)
+        fields = (20, 0, method, dtime, ddate, crc, len(packed), len(data),
+                  len(name))
+        header = struct.pack("<4s5HLLLHH", "PK\003\004", *(fields + (0,)))
+        f.write(header + name)
+        f.write(packed)
+        directory.append(struct.pack("<4s6HLLL5HLL", "PK\001\002", 20,
+            *(fields + (0, 0, 0, 0, 0, offset))) + name)
+        offset += len(header) + len(name) + len(packed)
+    directory = "".join(directory)
+    f.write(directory)
+    f.write(struct.pack("<4s4HLLH", "PK\005\006", 0, 0, len(entries),
+                        len(entries), len(directory), offset, 0))
+    return offset + len(directory) + 22
+
+##############################################################################
+
+def readEntries(jarfile):
+    """
+    Returns a list of '(name, dateTime, data)' for the files in 'jarfile',
+    in order, leaving out directories and all but the last entry of each
+    name.
+    """
+    src = zipfile.ZipFile(jarfile, "r")
+    try:
+        last = {}
+        infos = src.infolist()
+        for i in range(len(infos)): last[infos[i].filename] = i
+        ans = []
+        for i in range(len(infos)):
+            info = infos[i]
+            if info.filename.endswith("/") or last[info.filename] != i:
+                continue
+            ans.append((info.filename, info.date_time, src.read(info)))
+        return ans
+    finally:
+        src.close()
+
+def combine(entries, library=LIBRARY):
+    """
+    Returns 'entries' with the classes from 'library' that the applet needs
+    added, and the manifest and index changed to match. If they are there
+    already, they are replaced.
+    """
+    needed = neededClasses(library)
+    isNeeded = dict([(name, True) for name in needed])
+    ans = []
+    for (name, dateTime, data) in entries:
+        if name == INDEX or name in isNeeded: continue
+        if name == MANIFEST: data = stripClassPath(data)
+        ans.append((name, dateTime, data))
+    lib = zipfile.ZipFile(library, "r")
+    try:
+        for name in needed:
+            info = lib.getinfo(name)
+            ans.append((name, info.date_time, lib.read(info)))
+    finally:
+        lib.close()
+    return ans
+
+def optimise(jarfile, combineLibrary=None):
+    """
+    Rewrites 'jarfile' as described at the top of this file. If
+    'combineLibrary' is not given, 'COMBINE_LIBRARY' says whether to copy in
+    the library. Returns '(oldSize, newSize)'.
+    """
+    if combineLibrary is None: combineLibrary = COMBINE_LIBRARY
+    oldSize = os.path.getsize(jarfile)
+    entries = readEntries(jarfile)
+    if combineLibrary: entries = combine(entries)
+    # The manifest must be the first entry (or the second, after
+    # "META-INF/"), or 'JarInputStream' will not find it.
+    entries.sort(lambda a, b: cmp(b[0] == MANIFEST, a[0] == MANIFEST))
+    tmpfile = "%s.%d.%d.tmp" % (jarfile, os.getpid(), thread.get_ident())
+    f = file(tmpfile, "wb")
+    try:
+        newSize = writeZip(f, entries)
+    finally:
+        f.close()
+    os.rename(tmpfile, jarfile)
+    countsLock.acquire()
+    try:
+        counts["optimised"] += 1
+        counts["bytesIn"] += oldSize
+        counts["bytesOut"] += newSize
+    finally:
+        countsLock.release()
+    return oldSize, newSize
+
+def main(args):
+    """Optimises the jar files named in 'args', for trying it out."""
+    combineLibrary = False
+    if args[:1] == ["--combine"]:
+        combineLibrary = True
+        args = args[1:]
+    for jarfile in args:
+        oldSize, newSize = optimise(jarfile, combineLibrary)
+        print "%s: %d -> %d bytes" % (jarfile, oldSize, newSize)
+    return 0
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main(sys.argv[1:]))
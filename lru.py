@@ -0,0 +1,120 @@
+"""
+A dictionary with a limit on the total size of its values. When it is full,
+the least recently used entries are thrown away.
+"""
+
+import threading
+
+class LRUCache:
+    """
+    Maps keys to values, keeping at most 'maxBytes' bytes worth of values.
+    The size of each value is given when it is stored. Entries are kept in a
+    doubly-linked list, most recently used first, so that every operation
+    takes constant time. All methods are safe to call from many threads.
+    """
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        # Maps each key to a list '[prev, next, key, value, size]'.
+        self.entries = {}
+        # The sentinel of the linked list. 'head[1]' is the most recently used
+        # entry and 'head[0]' the least recently used.
+        self.head = [None, None, None, None, 0]
+        self.head[0] = self.head[1] = self.head
+        self.totalBytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def unlink(self, entry):
+        entry[0][1] = entry[1]
+        entry[1][0] = entry[0]
+
+    def linkFirst(self, entry):
+        entry[0] = self.head
+        entry[1] = self.head[1]
+        self.head[1][0] = entry
+        self.head[1] = entry
+
+    def get(self, key, default=None):
+        """
+        Returns the value for 'key', or 'default' if there isn't one. Counts
+        a hit or a miss.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.unlink(entry)
+            self.linkFirst(entry)
+            return entry[3]
+        finally:
+            self.lock.release()
+
+    def put(self, key, value, size):
+        """
+        Stores 'value' under 'key', and throws away old entries until
+        everything fits. A value bigger than 'maxBytes' is not stored at all.
+        """
+        self.lock.acquire()
+        try:
+            self._remove(key)
+            if size > self.maxBytes: return
+            entry = [None, None, key, value, size]
+            self.entries[key] = entry
+            self.linkFirst(entry)
+            self.totalBytes += size
+            while self.totalBytes > self.maxBytes:
+                self._remove(self.head[0][2])
+        finally:
+            self.lock.release()
+
+    def pop(self, key):
+        """Removes the entry for 'key', if there is one."""
+        self.lock.acquire()
+        try:
+            self._remove(key)
+        finally:
+            self.lock.release()
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.unlink(entry)
+            self.totalBytes -= entry[4]
+
+    def items(self):
+        """
+        Returns a list of '(key, value)' for every entry, most recently used
+        first.
+        """
+        self.lock.acquire()
+        try:
+            ans = []
+            entry = self.head[1]
+            while entry is not self.head:
+                ans.append((entry[2], entry[3]))
+                entry = entry[1]
+            return ans
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """Removes all entries."""
+        self.lock.acquire()
+        try:
+            self.entries = {}
+            self.head[0] = self.head[1] = self.head
+            self.totalBytes = 0
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Returns a dict of counters describing the cache."""
+        return dict(hits=self.hits, misses=self.misses,
+                    entries=len(self.entries), bytes=self.totalBytes)
@@ -0,0 +1,352 @@
+"""
+Numbers describing what the server is doing: how long each kind of request
+takes, how many bytes are sent, how long compilations take and how they
+end, how well the caches are working, and how many threads are busy.
+
+'render()' returns them all in the Prometheus text format, which the server
+exports on "/metrics". If 'openJsonLog()' has been called, every request and
+every compilation is also written to a log file as one line of JSON.
+
+Requests are measured by 'MetricsTool', whose "before_finalize" hook runs
+after that of 'compression.compressResponse()' so that it sees the bytes
+that are actually sent.
+"""
+
+import time, thread, threading
+import cherrypy
+from compression import statusCode
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+# Upper bounds of the histogram buckets, in seconds.
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# The actions under "/pages/<pagename>/" that are timed separately.
+ACTIONS = ["play", "edit", "save", "res", "thumb", "atlas", "history"]
+
+def escapeLabel(value):
+    return (str(value).replace("\\", "\\\\").replace("\"", "\\\"")
+                      .replace("\n", "\\n"))
+
+def formatLabels(labels):
+    """
+    Formats 'labels' (a tuple of '(name, value)') in the form
+    '{name="value",...}'.
+    """
+    if not labels: return ""
+    return "{%s}" % ",".join(['%s="%s"' % (name, escapeLabel(value))
+                              for (name, value) in labels])
+
+def formatValue(value):
+    if isinstance(value, float):
+        if value == int(value) and abs(value) < 1e15: return str(int(value))
+        return repr(value)
+    return str(value)
+
+class Metric:
+    """
+    A named set of values, one for each combination of labels. Subclasses
+    say what the values are and how they are written out.
+    """
+    kind = "untyped"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        # Maps a sorted tuple of '(label, value)' to the value.
+        self.values = {}
+        registry.append(self)
+
+    def key(self, labels):
+        items = labels.items()
+        items.sort()
+        return tuple(items)
+
+    def samples(self):
+        """Returns a list of '(suffix, labels, value)' to write out."""
+        self.lock.acquire()
+        try:
+            return [("", labels, value)
+                    for (labels, value) in self.values.items()]
+        finally:
+            self.lock.release()
+
+    def render(self):
+        lines = ["# HELP %s %s\n" % (self.name, self.help),
+                 "# TYPE %s %s\n" % (self.name, self.kind)]
+        samples = self.samples()
+        samples.sort()
+        for (suffix, labels, value) in samples:
+            lines.append("%s%s%s %s\n" % (self.name, suffix,
+                formatLabels(labels), formatValue(value)))
+        return "".join(lines)
+
+class Counter(Metric):
+    """A value which only goes up."""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.lock.acquire()
+        try:
+            self.values[key] = self.values.get(key, 0) + amount
+        finally:
+            self.lock.release()
+
+class Gauge(Metric):
+    """
+    A value which goes up and down. If 'function' is given, it is called to
+    find the value whenever the gauge is written out.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, function=None):
+        Metric.__init__(self, name, help)
+        self.function = function
+
+    def set(self, value, **labels):
+        self.lock.acquire()
+        try:
+            self.values[self.key(labels)] = value
+        finally:
+            self.lock.release()
+
+    def samples(self):
+        if self.function is not None: return [("", (), self.function())]
+        return Metric.samples(self)
+
+class Histogram(Metric):
+    """Counts how many observations fell into each of 'buckets'."""
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        Metric.__init__(self, name, help)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        self.lock.acquire()
+        try:
+            entry = self.values.get(key)
+            if entry is None:
+                # The counts for each bucket, then the sum and the count.
+                entry = [0] * len(self.buckets) + [0.0, 0]
+                self.values[key] = entry
+            for i in range(len(self.buckets)):
+                if value <= self.buckets[i]: entry[i] += 1
+            entry[-2] += value
+            entry[-1] += 1
+        finally:
+            self.lock.release()
+
+    def samples(self):
+        ans = []
+        for (suffix, labels, entry) in Metric.samples(self):
+            for i in range(len(self.buckets)):
+                ans.append(("_bucket", labels + (("le", self.buckets[i]),),
+                            entry[i]))
+            ans.append(("_bucket", labels + (("le", "+Inf"),), entry[-1]))
+            ans.append(("_sum", labels, entry[-2]))
+            ans.append(("_count", labels, entry[-1]))
+        return ans
+
+class Stats:
+    """
+    Exports the dict returned by one of the 'stats()' methods found
+    elsewhere in the server, such as 'CompileCache.stats()'. Each key
+    becomes a metric called "nifki_<prefix>_<key>". Keys in 'counters' are
+    counters, and the rest are gauges. If there are "hits" and "misses",
+    their ratio is exported too.
+    """
+    def __init__(self, prefix, stats, counters=("hits", "misses")):
+        self.prefix = prefix
+        self.stats = stats
+        self.counters = counters
+        registry.append(self)
+
+    def render(self):
+        stats = self.stats()
+        keys = stats.keys()
+        keys.sort()
+        lines = []
+        for key in keys:
+            name = "nifki_%s_%s" % (self.prefix, key)
+            kind = "gauge"
+            if key in self.counters:
+                name += "_total"
+                kind = "counter"
+            lines.append("# TYPE %s %s\n%s %s\n"
+                         % (name, kind, name, formatValue(stats[key])))
+        if "hits" in stats and "misses" in stats:
+            lookups = stats["hits"] + stats["misses"]
+            ratio = 0.0
+            if lookups: ratio = float(stats["hits"]) / lookups
+            name = "nifki_%s_hit_ratio" % self.prefix
+            lines.append("# TYPE %s gauge\n%s %s\n"
+                         % (name, name, formatValue(ratio)))
+        return "".join(lines)
+
+# Everything that 'render()' writes out.
+registry = []
+
+def render():
+    """Returns all the metrics in the Prometheus text format."""
+    return "".join([metric.render() for metric in registry])
+
+# Maps thread ident to the start time of the request it is handling.
+inflight = {}
+
+requestSeconds = Histogram("nifki_request_seconds",
+    "Time taken to handle and send each response, by handler.")
+requests = Counter("nifki_requests_total",
+    "Responses sent, by handler and status code.")
+responseBytes = Counter("nifki_response_bytes_total",
+    "Bytes of response bodies sent, by handler.")
+activeRequests = Gauge("nifki_active_requests",
+    "Requests being handled right now.", lambda: len(inflight))
+compileSeconds = Histogram("nifki_compile_seconds",
+    "Time taken to compile each page, including the cache lookup.")
+compiles = Counter("nifki_compiles_total",
+    "Compilations, by whether the output was cached and the exit code.")
+
+jsonLog = None
+jsonLogLock = threading.Lock()
+
+def openJsonLog(path):
+    """
+    Starts writing a line of JSON to 'path' for each event. If the log is
+    already open, it is closed and opened again, so that it can be rotated.
+    """
+    global jsonLog
+    if json is None: return
+    jsonLogLock.acquire()
+    try:
+        if jsonLog is not None: jsonLog.close()
+        jsonLog = file(path, "a")
+    finally:
+        jsonLogLock.release()
+
+def logEvent(**fields):
+    """Writes 'fields' to the JSON log, with the time, if it is open."""
+    if jsonLog is None: return
+    fields["time"] = round(time.time(), 3)
+    line = json.dumps(fields, sort_keys=True) + "\n"
+    jsonLogLock.acquire()
+    try:
+        jsonLog.write(line)
+        jsonLog.flush()
+    finally:
+        jsonLogLock.release()
+
+def recordCompile(pagename, seconds, errcode, cached):
+    """Records one compilation."""
+    compileSeconds.observe(seconds)
+    compiles.inc(cached=str(cached).lower(), exitcode=errcode)
+    logEvent(event="compile", page=pagename, ms=int(seconds * 1000),
+             exitcode=errcode, cached=cached)
+
+def handlerName(path):
+    """Returns the name under which requests for 'path' are measured."""
+    parts = [part for part in path.split("/") if part]
+    if not parts: return "root"
+    if parts[0] != "pages":
+        if parts[0] in ("status", "metrics"): return parts[0]
+        return "static"
+    if len(parts) == 1: return "index"
+    if len(parts) == 2: return "page"
+    if parts[2].endswith(".jar"): return "jar"
+    if parts[2] in ACTIONS: return parts[2]
+    return "other"
+
+def recordRequest(handler, path, status, start, size):
+    """Records one response."""
+    seconds = time.time() - start
+    requestSeconds.observe(seconds, handler=handler)
+    requests.inc(handler=handler, status=status)
+    responseBytes.inc(size, handler=handler)
+    logEvent(event="request", handler=handler, path=path, status=status,
+             ms=int(seconds * 1000), bytes=size)
+
+class Measurement:
+    """
+    The measurement of one request, which is recorded once by 'record()',
+    whichever of the hooks below gets there first.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.thread = thread.get_ident()
+        self.done = False
+        inflight[self.thread] = self.start
+
+    def record(self, path, status, size):
+        if self.done: return
+        self.done = True
+        inflight.pop(self.thread, None)
+        recordRequest(handlerName(path), path, status, self.start, size)
+
+def countedBody(body, measurement, path, status):
+    """
+    Generates the chunks of 'body', and records the request when they have
+    all been sent, or the client has gone away.
+    """
+    size = 0
+    try:
+        for chunk in body:
+            size += len(chunk)
+            yield chunk
+    finally:
+        measurement.record(path, status, size)
+
+def startRequest():
+    cherrypy.request.metrics = Measurement()
+
+def finishRequest():
+    request, response = cherrypy.request, cherrypy.response
+    measurement = getattr(request, "metrics", None)
+    if measurement is None: return
+    response.body = countedBody(response.body, measurement,
+                                request.path_info, statusCode(response))
+
+def failRequest():
+    request = cherrypy.request
+    measurement = getattr(request, "metrics", None)
+    if measurement is None: return
+    body = cherrypy.response.body
+    size = 0
+    if isinstance(body, list):
+        for chunk in body: size += len(chunk)
+    measurement.record(request.path_info, "500", size)
+
+def endRequest():
+    """
+    Records the request if 'countedBody()' has not, because the body was
+    never sent, as for a "HEAD" request. The body of a response is not
+    closed until after this runs, so its own record would come too late.
+    """
+    request = cherrypy.request
+    measurement = getattr(request, "metrics", None)
+    if measurement is None: return
+    measurement.record(request.path_info, statusCode(cherrypy.response), 0)
+
+class MetricsTool(cherrypy.Tool):
+    """
+    Measures every request. A CherryPy tool attaches one hook, so this one
+    attaches the others itself.
+    """
+    def __init__(self):
+        cherrypy.Tool.__init__(self, "on_start_resource", startRequest)
+
+    def _setup(self):
+        cherrypy.Tool._setup(self)
+        hooks = cherrypy.serving.request.hooks
+        # Later than the other "before_finalize" hooks.
+        hooks.attach("before_finalize", finishRequest, priority=90)
+        hooks.attach("after_error_response", failRequest)
+        hooks.attach("on_end_request", endRequest)
@@ -0,0 +1,65 @@
+#!/usr/bin/python
+"""
+Copies every page from one storage backend to another (see "storage.py").
+Run it from the directory containing "wiki", while the server is stopped:
+
+    python migrate.py to-sqlite [<wikiPath> [<dbPath>]]
+    python migrate.py to-files [<dbPath> [<wikiPath>]]
+
+The history of each page is copied too. Pages which already exist in the
+destination are left alone, so it is safe to run again after it has been
+interrupted. Resources are not copied, because both backends share the blob
+store. After moving to SQLite, the old page directories can be deleted by
+hand once the server is running happily; the "nifki-out" directory must be
+kept.
+"""
+
+import sys
+import storage
+
+def migrate(source, dest, log=sys.stdout):
+    """
+    Copies the pages in 'source' that are not in 'dest'. Returns a pair
+    '(copied, skipped)'.
+    """
+    existing = {}
+    for pagename in dest.listPages(): existing[pagename] = True
+    pagenames = source.listPages()
+    pagenames.sort()
+    copied = skipped = 0
+    for pagename in pagenames:
+        if pagename in existing:
+            skipped += 1
+            continue
+        dest.putPage(pagename, source.readSource(pagename),
+                     source.readProperties(pagename),
+                     source.resourceDigests(pagename))
+        for (number, when, kind, size) in source.revisionHeaders(pagename):
+            dest.appendRevision(pagename, number, when, kind,
+                                source.readRevision(pagename, number))
+        copied += 1
+        if copied % 100 == 0:
+            log.write("Copied %d of %d pages\n" % (copied, len(pagenames)))
+    return copied, skipped
+
+def main(args):
+    if not args or args[0] not in ("to-sqlite", "to-files"):
+        sys.stderr.write(__doc__)
+        return 2
+    if args[0] == "to-sqlite":
+        wikiPath = (args[1:2] or ["wiki"])[0]
+        dbPath = (args[2:3] or [storage.DB_PATH])[0]
+        source = storage.FileStorage(wikiPath)
+        dest = storage.SQLiteStorage(dbPath, wikiPath)
+    else:
+        dbPath = (args[1:2] or [storage.DB_PATH])[0]
+        wikiPath = (args[2:3] or ["wiki"])[0]
+        source = storage.SQLiteStorage(dbPath, wikiPath)
+        dest = storage.FileStorage(wikiPath)
+    copied, skipped = migrate(source, dest)
+    print "Copied %d pages, skipped %d which were already there." % (
+        copied, skipped)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,53 @@
+"""
+A cache of rendered pages, such as the 'play' and 'edit' views, so that
+popular pages are not rebuilt from the files on disk for every visit.
+
+Each page has a version number, which 'invalidate()' increments whenever the
+page changes. Cached HTML is stored under the version that was current when
+rendering started, so a rendering that races with a change is never served
+afterwards. Old versions are simply left for the LRU policy to throw away.
+"""
+
+import threading
+import lru
+
+MAX_BYTES = 32 * 1024 * 1024
+
+class PageCache:
+    """Maps '(kind, pagename)' to rendered HTML, encoded as UTF-8."""
+    def __init__(self, maxBytes=MAX_BYTES):
+        self.cache = lru.LRUCache(maxBytes)
+        self.lock = threading.Lock()
+        # Maps page names to version numbers. Missing entries mean zero.
+        self.versions = {}
+
+    def version(self, pagename):
+        """Returns the current version of 'pagename'."""
+        return self.versions.get(pagename, 0)
+
+    def get(self, kind, pagename, version):
+        """
+        Returns the cached HTML for view 'kind' of 'pagename' at 'version',
+        or 'None'.
+        """
+        return self.cache.get((kind, pagename, version))
+
+    def put(self, kind, pagename, version, html):
+        """
+        Stores 'html' as view 'kind' of 'pagename' at 'version', and returns
+        it encoded as UTF-8.
+        """
+        html = html.encode("UTF-8")
+        self.cache.put((kind, pagename, version), html, len(html))
+        return html
+
+    def invalidate(self, pagename):
+        """Records that 'pagename' has changed."""
+        self.lock.acquire()
+        try:
+            self.versions[pagename] = self.versions.get(pagename, 0) + 1
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return self.cache.stats()
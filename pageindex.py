@@ -0,0 +1,358 @@
+"""
+An in-memory index of the pages in the wiki, the resources attached to each
+page, the tag line of each page, and the compiler output for each page. This
+saves listing directories and checking for files on every request.
+
+The server tells the index about changes it makes itself. Changes made by
+anything else are noticed by comparing stamps (directory modification times,
+or counters in the database), which are checked at most once every
+'CHECK_INTERVAL' seconds. Tag lines are read when first needed, and after
+that only change when the server says so.
+
+'PageIndex.snapshot()' returns everything the index knows, with the stamps,
+so that a restarted server can start from it instead of from nothing (see
+"snapshot.py"). Everything taken from a snapshot is checked against the
+current stamps before it is used, so a stale snapshot costs only the time
+to read what has changed.
+"""
+
+import os, time, bisect, threading
+from storage import OUT_DIR, directoryStamp, listDirectory
+
+CHECK_INTERVAL = 1
+
+class Listing:
+    """
+    A set of names, together with a stamp which changes whenever the set
+    does. 'getStamp' and 'getNames' are functions which return the current
+    stamp and names. For a directory, the stamp is its modification time.
+    """
+    def __init__(self, getStamp, getNames):
+        self.getStamp = getStamp
+        self.getNames = getNames
+        self.checked = 0
+        self.stamp = None
+        self.names = {}
+
+    def check(self, force=False):
+        """
+        Reads the names again if the stamp has changed since we last looked,
+        unless we looked less than 'CHECK_INTERVAL' seconds ago. Returns
+        'True' if the listing changed.
+        """
+        now = time.time()
+        if not force and now < self.checked + CHECK_INTERVAL: return False
+        self.checked = now
+        stamp = self.getStamp()
+        if stamp == self.stamp: return False
+        self.stamp = stamp
+        names = {}
+        if stamp is not None:
+            for name in self.getNames(): names[name] = True
+        self.names = names
+        return True
+
+    def touch(self):
+        """
+        Records the current stamp, so that a change we have already recorded
+        does not cause the names to be read again.
+        """
+        self.stamp = self.getStamp()
+
+    def state(self):
+        """Returns '(stamp, names)', for 'PageIndex.snapshot()'."""
+        return self.stamp, self.names.keys()
+
+    def restore(self, state):
+        """
+        Takes the names from 'state()' of an earlier run. They are kept if
+        the stamp has not changed when 'check()' is next called.
+        """
+        self.stamp, names = state
+        self.names = dict([(name, True) for name in names])
+        self.checked = 0
+
+def DirectoryListing(path):
+    """Returns a 'Listing' of the names in the directory 'path'."""
+    return Listing(lambda: directoryStamp(path), lambda: listDirectory(path))
+
+class PageIndex:
+    """
+    The index of the pages in 'storage' (see "storage.py"), and of the
+    compiler output in 'wikiPath'. Resource listings are loaded the first
+    time they are needed. 'parseTagLine' is a function which takes the
+    contents of a properties file and returns the tag line. If 'snapshot' is
+    given, it is passed to 'restore()' before anything is read.
+    """
+    def __init__(self, storage, parseTagLine, wikiPath="wiki", snapshot=None):
+        self.storage = storage
+        self.parseTagLine = parseTagLine
+        self.wikiPath = wikiPath
+        self.lock = threading.RLock()
+        self.wiki = Listing(storage.pagesStamp, storage.listPages)
+        self.out = DirectoryListing(os.path.join(wikiPath, OUT_DIR))
+        # Maps page name to the 'Listing' of its resources.
+        self.res = {}
+        # Maps page name to tag line.
+        self.tagLines = {}
+        # Maps page name to the 'propertiesStamp()' of the page when its tag
+        # line was read, if the storage has one.
+        self.tagLineStamps = {}
+        # The pages whose tag lines came from a snapshot and have not been
+        # checked against their stamps yet.
+        self.unchecked = {}
+        # A sorted list of page names. It is replaced, never changed, so
+        # that callers of 'pageNames()' can use it without the lock.
+        self.sortedNames = []
+        # Counts changes to the list of pages and to the tag lines, for
+        # 'listingVersion()'.
+        self.changes = 0
+        if snapshot is not None: self.restore(snapshot)
+        self.check(force=True)
+
+    def check(self, force=False):
+        """Looks for changes made by something other than the server."""
+        self.lock.acquire()
+        try:
+            if self.wiki.check(force):
+                names = self.wiki.names.keys()
+                names.sort()
+                self.sortedNames = names
+                self.changes += 1
+                for cache in [self.res, self.tagLines, self.tagLineStamps,
+                              self.unchecked]:
+                    for pagename in cache.keys():
+                        if pagename not in self.wiki.names: del cache[pagename]
+            self.out.check(force)
+        finally:
+            self.lock.release()
+
+    def pageNames(self):
+        """Returns a sorted list of the names of all pages."""
+        self.check()
+        return self.sortedNames
+
+    def hasPage(self, pagename):
+        """Returns 'True' if 'pagename' exists."""
+        self.check()
+        return pagename in self.wiki.names
+
+    def addPage(self, pagename):
+        """Records that the server has created the page 'pagename'."""
+        self.lock.acquire()
+        try:
+            if pagename not in self.wiki.names:
+                self.wiki.names[pagename] = True
+                names = list(self.sortedNames)
+                bisect.insort(names, pagename)
+                self.sortedNames = names
+                self.changes += 1
+            self.wiki.touch()
+            self.res.pop(pagename, None)
+            self.tagLines.pop(pagename, None)
+            self.tagLineStamps.pop(pagename, None)
+            self.unchecked.pop(pagename, None)
+        finally:
+            self.lock.release()
+
+    def listingVersion(self):
+        """
+        Returns a number which changes whenever a page is added or removed,
+        or the server changes a tag line or finds that one has changed. A
+        tag line changed by something else is only found when it is next
+        read.
+        """
+        self.check()
+        return self.changes
+
+    def propertiesStamp(self, pagename):
+        """
+        Returns the stamp of the properties of 'pagename', or 'None' if the
+        storage cannot tell cheaply.
+        """
+        return self.storage.propertiesStamp(pagename)
+
+    def loadTagLines(self, pagenames):
+        """
+        Reads the tag lines of those of 'pagenames' which we do not know yet,
+        all at once. Tag lines from a snapshot are read again if the page has
+        changed since. The properties are read without holding the lock.
+        """
+        # Maps page names to the tag lines from the snapshot which are out of
+        # date.
+        stale = {}
+        self.lock.acquire()
+        try:
+            for pagename in pagenames:
+                if self.unchecked.pop(pagename, None) is None: continue
+                if (self.propertiesStamp(pagename) !=
+                    self.tagLineStamps.get(pagename)):
+                    stale[pagename] = self.tagLines.pop(pagename, None)
+            missing = [pagename for pagename in pagenames
+                       if pagename not in self.tagLines]
+        finally:
+            self.lock.release()
+        if not missing: return
+        # Before reading, so that a change made meanwhile is not missed.
+        stamps = dict([(pagename, self.propertiesStamp(pagename))
+                       for pagename in missing])
+        found = self.storage.readAllProperties(missing)
+        self.lock.acquire()
+        try:
+            for pagename in missing:
+                # 'setTagLine()' may have been called meanwhile.
+                if pagename in self.tagLines: continue
+                try: tagLine = self.parseTagLine(found[pagename])
+                except (KeyError, ValueError): tagLine = u""
+                if pagename in stale and stale[pagename] != tagLine:
+                    self.changes += 1
+                self.tagLines[pagename] = tagLine
+                self.tagLineStamps[pagename] = stamps[pagename]
+        finally:
+            self.lock.release()
+
+    def tagLine(self, pagename):
+        """Returns the tag line of 'pagename' as a unicode string."""
+        self.loadTagLines([pagename])
+        return self.tagLines.get(pagename, u"")
+
+    def tagLineList(self, pagenames):
+        """Returns a list of the tag lines of 'pagenames'."""
+        self.loadTagLines(pagenames)
+        return [self.tagLines.get(pagename, u"") for pagename in pagenames]
+
+    def setTagLine(self, pagename, tagLine):
+        """Records that the server has changed the tag line of 'pagename'."""
+        self.lock.acquire()
+        try:
+            if self.tagLines.get(pagename) != tagLine: self.changes += 1
+            self.tagLines[pagename] = tagLine
+            self.tagLineStamps[pagename] = self.propertiesStamp(pagename)
+            self.unchecked.pop(pagename, None)
+        finally:
+            self.lock.release()
+
+    def search(self, query):
+        """
+        Returns a list of the names of pages whose name or tag line contains
+        'query', ignoring case. Pages whose names start with 'query' come
+        first, then other pages whose names contain it, then pages whose tag
+        lines contain it. Within each group, pages are in alphabetical order.
+        """
+        query = query.lower()
+        prefix, inName, inTagLine = [], [], []
+        self.loadTagLines(self.pageNames())
+        for pagename in self.pageNames():
+            lower = pagename.lower()
+            if lower.startswith(query): prefix.append(pagename)
+            elif query in lower: inName.append(pagename)
+            elif query in self.tagLine(pagename).lower():
+                inTagLine.append(pagename)
+        return prefix + inName + inTagLine
+
+    def resListing(self, pagename, check=True):
+        """
+        Returns the 'Listing' of the resources of 'pagename', brought up to
+        date if 'check' is true.
+        """
+        self.lock.acquire()
+        try:
+            listing = self.res.get(pagename)
+            if listing is None:
+                storage = self.storage
+                listing = Listing(
+                    lambda: storage.resourcesStamp(pagename),
+                    lambda: storage.listResources(pagename))
+                self.res[pagename] = listing
+            if check: listing.check()
+            return listing
+        finally:
+            self.lock.release()
+
+    def resources(self, pagename):
+        """
+        Returns a sorted list of the names of the resources attached to
+        'pagename'.
+        """
+        names = self.resListing(pagename).names.keys()
+        names.sort()
+        return names
+
+    def hasResource(self, pagename, resname):
+        """Returns 'True' if 'pagename' has a resource called 'resname'."""
+        return resname in self.resListing(pagename).names
+
+    def addResource(self, pagename, resname):
+        """Records that the server has added 'resname' to 'pagename'."""
+        self.lock.acquire()
+        try:
+            listing = self.resListing(pagename)
+            listing.names[resname] = True
+            listing.touch()
+        finally:
+            self.lock.release()
+
+    def output(self, pagename):
+        """
+        Returns ".jar" if the compiler has produced a jar file for
+        'pagename', ".err" if it has produced an error report, or 'None'.
+        """
+        self.check()
+        names = self.out.names
+        for ext in [".jar", ".err"]:
+            if pagename + ext in names: return ext
+        return None
+
+    def outputChanged(self, pagename):
+        """Records that the compiler has just run on 'pagename'."""
+        self.lock.acquire()
+        try:
+            for ext in [".jar", ".err"]:
+                fname = pagename + ext
+                if os.path.exists(os.path.join(self.wikiPath, OUT_DIR, fname)):
+                    self.out.names[fname] = True
+                else:
+                    self.out.names.pop(fname, None)
+            self.out.touch()
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        """
+        Returns everything in the index, with the stamps it was read at, as
+        a dict containing only lists, tuples, strings and numbers. Tag lines
+        are only included if the storage has stamps for them.
+        """
+        self.lock.acquire()
+        try:
+            tagLines = {}
+            for (pagename, stamp) in self.tagLineStamps.items():
+                if stamp is not None and pagename in self.tagLines:
+                    tagLines[pagename] = (stamp, self.tagLines[pagename])
+            return {
+                "pages": self.wiki.state(),
+                "out": self.out.state(),
+                "res": dict([(pagename, listing.state())
+                             for (pagename, listing) in self.res.items()]),
+                "tagLines": tagLines,
+            }
+        finally:
+            self.lock.release()
+
+    def restore(self, snapshot):
+        """Starts from what an earlier 'snapshot()' said."""
+        self.lock.acquire()
+        try:
+            self.wiki.restore(snapshot["pages"])
+            names = self.wiki.names.keys()
+            names.sort()
+            self.sortedNames = names
+            self.out.restore(snapshot["out"])
+            for (pagename, state) in snapshot["res"].items():
+                self.resListing(pagename, check=False).restore(state)
+            for (pagename, (stamp, tagLine)) in snapshot["tagLines"].items():
+                self.tagLines[pagename] = tagLine
+                self.tagLineStamps[pagename] = stamp
+                self.unchecked[pagename] = True
+        finally:
+            self.lock.release()
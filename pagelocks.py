@@ -0,0 +1,43 @@
+"""
+A lock for each page, so that saves, uploads and snapshots for the compiler
+happen one at a time for any one page, while different pages do not wait
+for each other.
+"""
+
+import threading
+
+class PageLocks:
+    """
+    Locks are made when first needed and thrown away when nobody is holding
+    or waiting for them, so there are only ever as many as there are pages
+    being changed.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Maps page name to '[lock, users]' where 'users' is the number of
+        # threads holding or waiting for 'lock'.
+        self.locks = {}
+
+    def acquire(self, pagename):
+        """Waits until no other thread holds the lock for 'pagename'."""
+        self.lock.acquire()
+        try:
+            entry = self.locks.get(pagename)
+            if entry is None:
+                entry = [threading.RLock(), 0]
+                self.locks[pagename] = entry
+            entry[1] += 1
+        finally:
+            self.lock.release()
+        entry[0].acquire()
+
+    def release(self, pagename):
+        """Releases the lock for 'pagename'."""
+        self.lock.acquire()
+        try:
+            entry = self.locks[pagename]
+            entry[0].release()
+            entry[1] -= 1
+            if entry[1] == 0: del self.locks[pagename]
+        finally:
+            self.lock.release()
@@ -0,0 +1,256 @@
+#!/usr/bin/python
+"""
+Recompiles every page whose output is out of date, using a pool of
+processes, one per CPU by default. Run it from the directory containing
+"wiki" after upgrading "compiler.jar" or "nifki-lib.jar":
+
+    python rebuild.py [--jobs <n>] [--db <dbPath>] [--all]
+
+The server may keep running. A page saved while it is being rebuilt is
+left for the server to compile: just before an output is published, the
+page's inputs are checked again, and if they have changed the output is
+dropped (see 'incremental.buildSnapshot()'). The server may go on showing
+a cached play page for a rebuilt page, with a link to its old jar, until
+the page is next saved or the server is restarted; the link still works,
+but browsers will not cache the jar.
+
+An output is out of date if it is missing, or if it was made from inputs
+(see 'compilecache.inputDigests()') other than the current ones. Each page
+rebuilt is recorded in 'STATE_FILE' as it finishes, so if the rebuild is
+interrupted, running it again carries on where it stopped. With --all,
+every page is rebuilt unless this tool has already rebuilt it from the
+same inputs; delete 'STATE_FILE' to start again from scratch.
+
+Progress is reported as it goes, and at the end the pages which could not
+be compiled are listed, along with those which compiled with errors.
+"""
+
+import sys, os, time, errno, shutil, signal, traceback, optparse
+import multiprocessing
+import compiledaemon, compilecache, incremental, storage
+
+STATE_FILE = "cache/rebuild.txt"
+
+# How often to report progress, in seconds.
+PROGRESS_INTERVAL = 5
+
+def readState(filename=STATE_FILE):
+    """
+    Returns a dict mapping page names to the key of the inputs they were
+    last rebuilt from. Later lines override earlier ones.
+    """
+    state = {}
+    try:
+        f = file(filename, "rb")
+    except IOError:
+        return state
+    try:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 2: state[fields[0]] = fields[1]
+    finally:
+        f.close()
+    return state
+
+def writeState(state, filename=STATE_FILE):
+    """Replaces the contents of 'filename' with 'state'."""
+    pagenames = state.keys()
+    pagenames.sort()
+    storage.writefile(filename, "".join(
+        ["%s %s\n" % (pagename, state[pagename]) for pagename in pagenames]))
+
+def currentOutput(pagename, wikiPath="wiki"):
+    """Returns the extension of the output of 'pagename', or 'None'."""
+    for ext in storage.OUTPUTS:
+        if os.path.exists(os.path.join(wikiPath, storage.OUT_DIR,
+                                       pagename + ext)):
+            return ext
+    return None
+
+def openStorage(dbPath):
+    if dbPath is None: return storage.FileStorage()
+    return storage.SQLiteStorage(dbPath)
+
+##############################################################################
+# The worker processes.
+
+# Set by 'initWorker()' in each worker process.
+worker = {}
+
+def initWorker(dbPath, state, rebuildAll):
+    # Interrupting the rebuild is handled by the parent process.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker["pageStore"] = openStorage(dbPath)
+    # Each worker would count only its own files, so none of them deletes
+    # any; 'rebuild()' trims the cache once they have finished.
+    worker["compileCache"] = compilecache.CompileCache(maxBytes=None)
+    worker["daemon"] = compiledaemon.CompileDaemon()
+    worker["state"] = state
+    worker["rebuildAll"] = rebuildAll
+
+def isFresh(pagename, inputs, key):
+    """Says whether the output of 'pagename' was made from 'inputs'."""
+    output = currentOutput(pagename)
+    if output is None: return False
+    if worker["state"].get(pagename) == key: return True
+    if worker["rebuildAll"]: return False
+    return (output == ".jar" and
+            incremental.readInputs(pagename) == dict(inputs))
+
+def rebuildPage(pagename):
+    """
+    Rebuilds 'pagename' if it is out of date. Returns '(pagename, result,
+    seconds, key, message)' where 'result' is one of "fresh", "compiled",
+    "cached", "errors" (the compiler reported errors in the page), "stale"
+    (the page was saved meanwhile, so the output was dropped) or "failed"
+    (the compiler could not be run; 'message' says why), and 'key'
+    identifies the inputs.
+    """
+    start = time.time()
+    try:
+        buildPath = storage.buildPath()
+        worker["pageStore"].materialise(pagename, buildPath)
+        try:
+            inputs = compilecache.inputDigests(buildPath, pagename)
+            key = compilecache.inputsKey(inputs)
+            if isFresh(pagename, inputs, key):
+                return pagename, "fresh", time.time() - start, key, None
+            isCurrent = lambda: key == compilecache.inputsKey(
+                compilecache.storedInputDigests(worker["pageStore"], pagename))
+            errcode, seconds, cached = incremental.buildSnapshot(pagename,
+                worker["daemon"], buildPath, inputs, worker["compileCache"],
+                isCurrent)
+        finally:
+            storage.releaseBuild(buildPath, pagename)
+    except incremental.StaleInputs:
+        return pagename, "stale", time.time() - start, None, None
+    except Exception, e:
+        return (pagename, "failed", time.time() - start, None,
+                traceback.format_exception_only(e.__class__, e)[-1].strip())
+    seconds = time.time() - start
+    if errcode == compiledaemon.TIMED_OUT:
+        return (pagename, "failed", seconds, None,
+                "the compiler took more than %d seconds"
+                % compiledaemon.TIMEOUT)
+    if errcode:
+        return (pagename, "failed", seconds, None,
+                "the compiler exited with code %d" % errcode)
+    if currentOutput(pagename) == ".err":
+        return pagename, "errors", seconds, key, None
+    return pagename, ["compiled", "cached"][cached], seconds, key, None
+
+##############################################################################
+
+def removeDeadBuilds():
+    """
+    Deletes the build directories (see 'storage.buildPath()') of processes
+    which have exited.
+    """
+    if not os.path.isdir(storage.BUILD_DIR): return
+    for name in os.listdir(storage.BUILD_DIR):
+        try:
+            pid = int(name.split("-")[0])
+        except ValueError:
+            continue
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            if e.errno == errno.ESRCH:
+                shutil.rmtree(os.path.join(storage.BUILD_DIR, name), True)
+
+def formatDuration(seconds):
+    seconds = int(seconds)
+    if seconds < 60: return "%ds" % seconds
+    if seconds < 3600: return "%dm%02ds" % (seconds / 60, seconds % 60)
+    return "%dh%02dm" % (seconds / 3600, seconds % 3600 / 60)
+
+RESULTS = [("compiled", "compiled"), ("cached", "copied from the cache"),
+           ("fresh", "already up to date"), ("errors", "with compile errors"),
+           ("stale", "saved while rebuilding, left to the server"),
+           ("failed", "failed")]
+
+def rebuild(pagenames, jobs, dbPath=None, rebuildAll=False, log=sys.stdout):
+    """
+    Rebuilds 'pagenames' using 'jobs' processes. Returns a pair '(counts,
+    problems)' where 'counts' maps each result of 'rebuildPage()' to the
+    number of pages with that result and 'problems' is a list of
+    '(pagename, result, message)' for the pages which failed or have compile
+    errors. Raises 'KeyboardInterrupt' if interrupted.
+    """
+    state = readState()
+    if os.path.exists(STATE_FILE): writeState(state)
+    elif not os.path.isdir(os.path.dirname(STATE_FILE)):
+        os.makedirs(os.path.dirname(STATE_FILE))
+    stateFile = file(STATE_FILE, "ab")
+    pool = multiprocessing.Pool(jobs, initWorker,
+                                (dbPath, state, rebuildAll))
+    counts = dict([(result, 0) for (result, description) in RESULTS])
+    problems = []
+    start = lastReport = time.time()
+    done = 0
+    try:
+        results = pool.imap_unordered(rebuildPage, pagenames)
+        while done < len(pagenames):
+            # A timeout, so that KeyboardInterrupt is delivered.
+            pagename, result, seconds, key, message = results.next(1e6)
+            done += 1
+            counts[result] += 1
+            if key is not None and result != "fresh":
+                stateFile.write("%s %s\n" % (pagename, key))
+                stateFile.flush()
+            if result in ("failed", "errors"):
+                problems.append((pagename, result, message))
+            now = time.time()
+            if now - lastReport >= PROGRESS_INTERVAL or done == len(pagenames):
+                lastReport = now
+                rate = done / max(now - start, 0.001)
+                log.write("%d/%d pages, %d failed, %.1f pages/s, "
+                          "about %s left\n"
+                          % (done, len(pagenames), counts["failed"], rate,
+                             formatDuration((len(pagenames) - done) / rate)))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        stateFile.close()
+        removeDeadBuilds()
+        compilecache.CompileCache().trim()
+    return counts, problems
+
+def main(args):
+    parser = optparse.OptionParser(usage="%prog [options]",
+        description="Recompiles every page whose output is out of date "
+                    "(see \"rebuild.py\").")
+    parser.add_option("--jobs", type="int",
+                      default=multiprocessing.cpu_count(),
+                      help="number of processes [%default]")
+    parser.add_option("--db", help="read the pages from this SQLite "
+                      "database instead of the page directories")
+    parser.add_option("--all", action="store_true", dest="rebuildAll",
+                      help="rebuild pages even if their output is up to date")
+    options, args = parser.parse_args(args)
+    if args: parser.error("unexpected arguments")
+    pagenames = openStorage(options.db).listPages()
+    pagenames.sort()
+    print "Checking %d pages using %d processes" % (len(pagenames),
+                                                    options.jobs)
+    start = time.time()
+    try:
+        counts, problems = rebuild(pagenames, options.jobs, options.db,
+                                   options.rebuildAll)
+    except KeyboardInterrupt:
+        print "Interrupted. Run it again to carry on."
+        return 1
+    print "Finished in %s:" % formatDuration(time.time() - start)
+    for (result, description) in RESULTS:
+        print "%8d %s" % (counts[result], description)
+    for (pagename, result, message) in problems:
+        if result == "failed": print "Failed: %s: %s" % (pagename, message)
+    for (pagename, result, message) in problems:
+        if result == "errors": print "Compile errors: %s" % pagename
+    return int(counts["failed"] > 0)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,15 +1,96 @@
 #!/usr/bin/python
 
-import sys, os, cgi, time, textwrap, string, shutil
+import sys, os, cgi, time, textwrap, string, bisect, urllib
+import mimetypes
 import cherrypy
+from cherrypy.process.plugins import Monitor
+import compilecache, compilequeue, pageindex, serving, snapshot
+import compression, pagecache, uploads, imaging, storage, pagelocks
+import history, incremental, metrics, jars, export, compiledaemon
+from digests import fileDigest
+from hashlib import sha1
 
-#from cherrypy.lib.filter.decodingfilter import DecodingFilter
-#from cherrypy.lib.filter.encodingfilter import EncodingFilter
-#from cherrypy.lib.filter.gzipfilter import GzipFilter
+# The settings, which may be changed by a CherryPy config file named by the
+# environment variable NIFKI_CONFIG. The "nifki.*" settings which name files
+# are relative to 'nifki.home'.
+cherrypy.config.update({
+    'environment': 'production',
+    'server.socket_port': 8080,
+    'server.socket_host': '127.0.0.1',
+    # Browsers fetch a page, its pictures and its jar over one connection.
+    'server.protocol_version': 'HTTP/1.1',
+    # Threads for handling requests, and how long an idle keep-alive
+    # connection may hold one.
+    'server.thread_pool': 10,
+    'server.socket_timeout': 10,
+    # How long a restart waits for requests that are still running.
+    'server.shutdown_timeout': 30,
+    'log.access_file': '/var/log/nifki',
+    'log.error_file': '/var/log/nifki',
+    # The directory holding "wiki", "templates" and the rest.
+    'nifki.home': '/home/apt1002/python/nifki',
+    # The SQLite database holding the pages, or 'None' to keep them in a
+    # directory each in "wiki". Use "migrate.py" to move them.
+    'nifki.dbPath': None,
+    # Where "snapshot.py" saves what the server knows about the wiki, and
+    # how often in seconds, or 'None' not to.
+    'nifki.snapshot': 'cache/snapshot.dat',
+    'nifki.snapshotInterval': 300,
+    # Where "metrics.py" writes a line of JSON for each event, or 'None'.
+    'nifki.metricsLog': '/var/log/nifki-metrics.json',
+    # Where "export.py" keeps a copy of the read-only pages for a front-end
+    # web server, or 'None'.
+    'nifki.exportDir': None,
+})
+if os.environ.get("NIFKI_CONFIG"):
+    cherrypy.config.update(os.environ["NIFKI_CONFIG"])
 
-cherrypy.debug = False
+os.chdir(cherrypy.config.get('nifki.home'))
 
-os.chdir("/home/apt1002/python/nifki")
+compileCache = compilecache.CompileCache()
+
+# Where pages are kept: 'storage.FileStorage()' for a directory per page in
+# "wiki", or 'storage.SQLiteStorage()' for a database.
+if cherrypy.config.get('nifki.dbPath'):
+    pageStore = storage.SQLiteStorage(cherrypy.config.get('nifki.dbPath'))
+else:
+    pageStore = storage.FileStorage()
+pageCache = pagecache.PageCache()
+pageLocks = pagelocks.PageLocks()
+pageHistory = history.History(pageStore)
+
+def compilePage(pagename, daemon):
+    """
+    Compiles a snapshot of 'pagename' using 'daemon', unless the output is
+    already in the cache or only the properties or pictures have changed
+    (see "incremental.py"), and then replaces the old output with the new.
+    Logs how long it took and returns the exit code. This is run by the
+    threads of 'compileQueue'.
+    """
+    buildPath = storage.buildPath()
+    pageLocks.acquire(pagename)
+    try:
+        pageStore.materialise(pagename, buildPath)
+    finally:
+        pageLocks.release(pagename)
+    try:
+        inputs = compilecache.inputDigests(buildPath, pagename)
+        errcode, seconds, cached = incremental.buildSnapshot(pagename, daemon,
+            buildPath, inputs, compileCache)
+    finally:
+        storage.releaseBuild(buildPath, pagename)
+    cherrypy.log("Compiled %s in %dms (exit code %d%s)"
+                 % (pagename, seconds*1000, errcode,
+                    ["", ", cached"][cached]), "COMPILE")
+    metrics.recordCompile(pagename, seconds, errcode, cached)
+    pageIndex.outputChanged(pagename)
+    pageCache.invalidate(pagename)
+    exportPage(pagename)
+    # A timeout leaves an error report, which is shown like compile errors.
+    if errcode == compiledaemon.TIMED_OUT: return 0
+    return errcode
+
+compileQueue = compilequeue.CompileQueue(compilePage)
 
 def readfile(filename):
     """
@@ -23,12 +104,39 @@ def readfile(filename):
     f.close()
     return contents
 
+# Maps the filename of each template to a tuple '(checked, mtime, html)' where
+# 'html' is its decoded contents and 'checked' is when we last looked at it.
+templateCache = {}
+
+# How often (in seconds) to check whether a template has changed on disk. Set
+# this to 'None' to load each template only once.
+TEMPLATE_CHECK_INTERVAL = 1
+
+def loadTemplate(filename):
+    """
+    Returns the contents of "templates/<filename>.html" as a unicode string.
+    Templates are kept in memory, and re-read only if the file is modified.
+    """
+    path = os.path.join("templates", filename+".html")
+    cached = templateCache.get(path)
+    if cached is not None:
+        checked, mtime, html = cached
+        if (TEMPLATE_CHECK_INTERVAL is None or
+            time.time() < checked + TEMPLATE_CHECK_INTERVAL):
+            return html
+        if os.path.getmtime(path) == mtime:
+            templateCache[path] = (time.time(), mtime, html)
+            return html
+    mtime = os.path.getmtime(path)
+    html = readfile(path).decode("UTF-8")
+    templateCache[path] = (time.time(), mtime, html)
+    return html
+
 def template(filename, **kwargs):
     """
     A simple templating mechanism to keep big bits of HTML out of the code.
     """
-    html = readfile(os.path.join("templates", filename+".html")).decode("UTF-8")
-    return html % kwargs
+    return loadTemplate(filename) % kwargs
 
 def template2(filename, title, **kwargs):
     """
@@ -55,9 +163,18 @@ def httpError(code, message):
     """
     Returns an error page containing 'message' with HTTP response code 'code'.
     """
-    cherrypy.response.headerMap['Status'] = code
+    cherrypy.response.status = code
     return template("error", message=message)
 
+def busy(page):
+    """
+    Returns 'page' with the HTTP response code 503 (Service Unavailable),
+    telling the browser when the compile queue is likely to have room.
+    """
+    cherrypy.response.status = 503
+    cherrypy.response.headers["Retry-After"] = str(compileQueue.retryAfter())
+    return page
+
 def parseProperties(properties):
     """
     Parses a file of the form of "properties.txt" and returns its contents as a
@@ -76,6 +193,37 @@ def parseProperties(properties):
             ans[line[:colon]] = line[colon+1:].strip()
     return ans
 
+def parseTagLine(properties):
+    """Returns the "name" property in 'properties', which is the tag line."""
+    return parseProperties(properties)["name"]
+
+def loadSnapshot():
+    """
+    Returns the page index and the list of pages waiting to be compiled
+    saved by 'saveSnapshot()', or '(None, [])'.
+    """
+    filename = cherrypy.config.get('nifki.snapshot')
+    if not filename: return None, []
+    return snapshot.load(filename)
+
+def saveSnapshot():
+    """
+    Saves a snapshot of the page index and of the pages waiting to be
+    compiled, if 'nifki.snapshot' is set.
+    """
+    filename = cherrypy.config.get('nifki.snapshot')
+    if not filename: return
+    try:
+        snapshot.save(filename, pageIndex, compileQueue.pending())
+    except (IOError, OSError):
+        cherrypy.log("Could not save the snapshot", "SNAPSHOT",
+                     traceback=True)
+
+savedIndex, savedQueue = loadSnapshot()
+pageIndex = pageindex.PageIndex(pageStore, parseTagLine, snapshot=savedIndex)
+# Pages which were saved but not compiled when the server last stopped.
+compileQueue.restore(savedQueue)
+
 def makeProperties(properties):
     """Takes a dict and returns a file of the form of "properties.txt"."""
     return "".join(["%s: %s\n" % (k, v) for (k, v) in properties])
@@ -100,33 +248,238 @@ def isValidPageName(pagename):
     if allUpperCase(pagename): return False
     return True
 
+def jarVersion(pagename):
+    """
+    Returns a string which changes whenever the jar file for 'pagename'
+    changes. It is used in the URL of the jar file.
+    """
+    return fileDigest("wiki/nifki-out/%s.jar" % pagename)[:16]
+
+# The 'stats()' methods shown by "/status" and exported by "/metrics", as a
+# list of '(prefix, function, counters)' where 'counters' are the keys which
+# only ever go up.
+STATS = [
+    ("queue", compileQueue.stats, ("jobs", "coalesced", "rejected")),
+    ("cache", compileCache.stats, ("hits", "misses")),
+    ("compressed", compression.store.stats, ("hits", "misses")),
+    ("pages", pageCache.stats, ("hits", "misses")),
+    ("builds", lambda: dict(incremental.counts), ("full", "patched")),
+    ("jars", lambda: dict(jars.counts), ("optimised", "bytesIn", "bytesOut")),
+    ("export", lambda: (exporter and exporter.stats()) or {},
+     ("exports", "written", "deleted")),
+]
+for (prefix, statsFunction, counters) in STATS:
+    metrics.Stats(prefix, statsFunction, counters)
+metrics.Gauge("nifki_request_threads_configured",
+              "Threads configured to handle requests ('server.thread_pool').",
+              lambda: cherrypy.config.get("server.thread_pool", 10))
+
+def formatTime(when):
+    """Formats a time in seconds since the epoch for display."""
+    return time.strftime("%Y-%m-%d %H:%M UTC", time.gmtime(when))
+
+def playPage(pagename):
+    """
+    Returns the HTML shown when 'pagename' is played: the page with the
+    applet tag on it if the game compiled successfully, otherwise the
+    compiler output. Returns 'None' if the page has not been compiled.
+    """
+    output = pageIndex.output(pagename)
+    if output == ".jar":
+        props = parseProperties(pageStore.readProperties(pagename))
+        return template("playing",
+            pagename=pagename,
+            width=int(props["width"]), height=int(props["height"]),
+            archive=jars.archive(pagename, jarVersion(pagename)),
+            name=props["name"])
+    elif output == ".err":
+        errfile = file("wiki/nifki-out/%s.err" % pagename, "rb")
+        err = errfile.read().decode("UTF-8")
+        errfile.close()
+        lines = []
+        for line in err.split("\n"):
+            for shortline in textwrap.wrap(line, width=80):
+                lines.append(shortline)
+        err = "\n".join(lines)
+        return template("compiler-output",
+            pagename=pagename, err=cgi.escape(err))
+    return None
+
+def pageVersion(source, properties):
+    """
+    Returns a string which changes whenever the source or properties of a
+    page change. The edit page sends it back when it is saved, so that we
+    can tell if somebody else has saved the page in the meantime.
+    """
+    h = sha1(source.encode("UTF-8"))
+    h.update("\0" + properties.encode("UTF-8"))
+    return h.hexdigest()[:16]
+
+# Hooks into the handling of every request. They are turned on in
+# 'Wiki._cp_config'.
+cherrypy.tools.requestSize = cherrypy.Tool("before_request_body",
+                                           uploads.checkRequestSize)
+cherrypy.tools.compression = cherrypy.Tool("before_finalize",
+                                           compression.compressResponse,
+                                           priority=70)
+cherrypy.tools.metrics = metrics.MetricsTool()
+
 class Wiki:
     """Handles the root URL of the wiki."""
-    # Now expressed as settings, see end of file.
-    #_cpFilterList = [
-    #    DecodingFilter('utf-8'),
-    #    EncodingFilter('utf-8'),
-    #    GzipFilter()]
+    # Request bodies are decoded as UTF-8 by CherryPy. Encoding and
+    # compression are done by 'compression.compressResponse()'.
+    _cp_config = {
+        'tools.requestSize.on': True,
+        'tools.compression.on': True,
+        'tools.metrics.on': True,
+        'tools.encode.on': False,
+        'tools.gzip.on': False,
+        # Handlers may return generators, which are sent as they go.
+        'response.stream': True,
+    }
 
     @cherrypy.expose
     def index(self):
         return template("welcome-to-nifki")
 
+    # Maps URLs to the static files they refer to, and their content types.
+    staticFiles = {
+        "nifki-lib.jar": ("nifki-lib.jar", "application/java-archive"),
+        "stylesheet.css": ("stylesheet.css", "text/css"),
+        "tutorial.txt": ("templates/tutorial.txt", "text/plain"),
+        "favicon.ico": ("favicon.ico", "image/x-icon"),
+    }
+
+    # How long (in seconds) browsers may keep static files without checking.
+    STATIC_MAX_AGE = 24 * 60 * 60
+
+    @cherrypy.expose
+    def default(self, *path):
+        """Serves the static files, and the contents of "images/"."""
+        if len(path) == 1 and path[0] in self.staticFiles:
+            filename, contentType = self.staticFiles[path[0]]
+        elif (len(path) == 2 and path[0] == "images" and
+              not path[1].startswith(".") and
+              os.path.isfile(os.path.join("images", path[1]))):
+            filename = os.path.join("images", path[1])
+            contentType = (mimetypes.guess_type(filename)[0] or
+                           "application/octet-stream")
+        else:
+            return httpError(404, "Not found: /%s" %
+                             cgi.escape("/".join(path)))
+        return serving.serveFile(filename, contentType, self.STATIC_MAX_AGE)
+
+    @cherrypy.expose
+    def status(self):
+        """
+        Returns some numbers describing the compile queue and cache, as plain
+        text, for sizing the pool of compiler threads.
+        """
+        cherrypy.response.headers["Content-Type"] = "text/plain"
+        lines = []
+        for (prefix, statsFunction, counters) in STATS:
+            stats = statsFunction()
+            keys = stats.keys()
+            keys.sort()
+            for key in keys:
+                lines.append("%s.%s: %s\n" % (prefix, key, stats[key]))
+        return "".join(lines)
+
+    @cherrypy.expose
+    def metrics(self):
+        """
+        Returns the numbers collected by "metrics.py" in the Prometheus text
+        format. Only requests made directly from this machine are answered.
+        """
+        request = cherrypy.request
+        if (request.remote.ip != "127.0.0.1" or
+            "X-Forwarded-For" in request.headers):
+            return httpError(403, "Metrics are only available locally")
+        cherrypy.response.headers["Content-Type"] = (
+            "text/plain; version=0.0.4")
+        return metrics.render()
+
 class Pages:
     """
     Handles everything in the /pages/ URL-space. Most things are accessed as
     /pages/<pagename>/<action>/, which CherryPy will pass to the 'default()'
     method.
     """
+    # The number of pages listed at once, by default and at most.
+    PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+
     @cherrypy.expose
-    def index(self):
-        pagenames = [page for page in os.listdir("wiki") if page != "nifki-out"]
-        pagenames.sort()
-        pagenames = ['   <li><a href="/pages/%s/play/">%s</a></li>'
-                     % (page, page)
-                     for page in pagenames]
-        return template2("list-of-all-pages",
-            title="List of All Pages", pagenames="\n".join(pagenames))
+    def index(self, q="", after=None, offset="0", count=None):
+        """
+        Returns a list of up to 'count' pages, starting at 'offset', or just
+        after the page called 'after' if that is specified. If 'q' is not
+        blank, only pages whose name or tag line contains it are listed. The
+        HTML for the list is generated while it is being sent.
+        """
+        try:
+            offset = max(0, int(offset))
+            count = int(count or self.PAGE_SIZE)
+        except ValueError:
+            return httpError(400, "Bad offset or count")
+        count = min(max(1, count), self.MAX_PAGE_SIZE)
+        q = q.strip()
+        if q:
+            pagenames = pageIndex.search(q)
+            if after is not None:
+                try: offset = pagenames.index(after) + 1
+                except ValueError: pass
+            summary = "Pages matching '%s' (%d found):" % (
+                cgi.escape(q), len(pagenames))
+            query = "q=%s&amp;" % urllib.quote_plus(q.encode("UTF-8"))
+        else:
+            pagenames = pageIndex.pageNames()
+            if after is not None:
+                offset = bisect.bisect_right(pagenames, after)
+            summary = ("Here is the complete list of all %d Nifki pages "
+                       "written so far:" % len(pagenames))
+            query = ""
+        shown = pagenames[offset:offset+count]
+        navigation = []
+        if offset > 0:
+            navigation.append(
+                '<a href="/pages/?%soffset=%d&amp;count=%d">Previous</a>'
+                % (query, max(0, offset-count), count))
+        if shown:
+            navigation.append("Showing %d to %d of %d." %
+                              (offset+1, offset+len(shown), len(pagenames)))
+        if offset+count < len(pagenames):
+            navigation.append(
+                '<a href="/pages/?%safter=%s&amp;count=%d">Next</a>'
+                % (query, shown[-1], count))
+        head, tail = template2("list-of-all-pages",
+            title="List of All Pages", q=cgi.escape(q, True), summary=summary,
+            navigation=" ".join(navigation), pagenames=u"\0").split(u"\0")
+        return self.listPages(head, shown, tail)
+
+    def firstPage(self):
+        """
+        Returns the first page of the list of pages, as 'index()' shows it
+        when there is no query string, all at once, for "export.py".
+        """
+        return u"".join(self.index())
+
+    def listPages(self, head, pagenames, tail):
+        """
+        Generates the list of pages for 'index()' a few lines at a time,
+        between 'head' and 'tail'.
+        """
+        yield head
+        for start in range(0, len(pagenames), 50):
+            lines = []
+            chunk = pagenames[start:start+50]
+            for (page, tagLine) in zip(chunk, pageIndex.tagLineList(chunk)):
+                if tagLine: tagLine = " &mdash; " + cgi.escape(tagLine)
+                lines.append(
+                    '   <li><a href="/pages/%s/play/">%s</a>%s</li>\n'
+                    % (page, page, tagLine))
+            yield "".join(lines)
+        yield tail
 
     @cherrypy.expose
     def default(self, pagename, action=None, *path, **params):
@@ -134,80 +487,88 @@ class Pages:
             return httpError(404, "Bad page name '%s'" % cgi.escape(pagename))
         if action==None:
             raise cherrypy.HTTPRedirect("/pages/%s/play/" % pagename)
-        if action.endswith(".jar"): return self.jar(pagename)
+        if action.endswith(".jar"): return self.jar(pagename, action[:-4])
         if action=="play": return self.play(pagename)
         if action=="edit": return self.edit(pagename)
         if action=="save": return self.save(pagename, **params)
         if action=="res": return self.res(pagename, path[0])
+        if action=="thumb": return self.thumb(pagename, path[0])
+        if action=="atlas": return self.atlas(pagename, path[0])
+        if action=="history": return self.history(pagename, *path)
         return httpError(404, "Unknown action: %s" % action)
     
-    def jar(self, pagename):
+    # How long (in seconds) browsers may keep resources without checking.
+    RES_MAX_AGE = 60 * 60
+
+    # Whether the edit page shows all the thumbnails as one image.
+    USE_ATLAS = False
+
+    def jar(self, pagename, version):
         """
-        Returns the jar file for this page. Note that the requested filename is
-        completely ignored. In fact, we vary the filename in order to defeat the
-        browser cache.
+        Returns the jar file for this page. The requested filename 'version'
+        is the one generated by 'jarVersion()', which changes whenever the jar
+        does. If it is current, browsers may cache the file forever; if not,
+        we return the current jar anyway, but only for this visit.
         """
-        jarfile = file(os.path.join("wiki/nifki-out", pagename+".jar"), "rb")
-        jar = jarfile.read()
-        jarfile.close()
-        cherrypy.response.headerMap["Content-Type"] = "application/java-archive"
+        if pageIndex.output(pagename) != ".jar":
+            return httpError(404, "No jar file for '%s'" % pagename)
+        jarfile = "wiki/nifki-out/%s.jar" % pagename
         # Mozilla refuses to cache anything without a "Last-Modified" header,
         # and ludicrously downloads a copy of the jar file for every entry
-        # contained within it. Really! Top quality!
-        cherrypy.response.headerMap["Last-Modified"] = (
-          cherrypy.response.headerMap["Date"] )
-        return jar
+        # contained within it. Really! Top quality! 'serveFile()' sets one.
+        return serving.serveFile(jarfile, "application/java-archive",
+                                 immutable=(version == jarVersion(pagename)))
     
     def play(self, pagename):
         """
         Returns the page with the applet tag on it, if the game compiled
         successfully, otherwise returns a page showing the compiler output.
+        While the game is waiting to be compiled, returns a page that reloads
+        itself until it is done. The last two are cached in 'pageCache'.
         """
-        if os.path.exists("wiki/nifki-out/%s.jar" % pagename):
-            propsfile = file("wiki/%s/properties.txt" % pagename, "rb")
-            props = parseProperties(propsfile.read().decode("UTF-8"))
-            propsfile.close()
-            return template("playing",
-                pagename=pagename,
-                width=int(props["width"]), height=int(props["height"]),
-                random=int(time.time()),
-                name=props["name"])
-        elif os.path.exists("wiki/nifki-out/%s.err" % pagename):
-            errfile = file("wiki/nifki-out/%s.err" % pagename, "rb")
-            err = errfile.read().decode("UTF-8")
-            errfile.close()
-            lines = []
-            for line in err.split("\n"):
-                for shortline in textwrap.wrap(line, width=80):
-                    lines.append(shortline)
-            err = "\n".join(lines)
-            return template("compiler-output",
-                pagename=pagename, err=cgi.escape(err))
-        else:
+        status = compileQueue.status(pagename)
+        if status:
+            return template("compiling", pagename=pagename, status=status)
+        if compileQueue.errcode(pagename):
+            cherrypy.response.status = 500
+            return template("compiler-error")
+        version = pageCache.version(pagename)
+        html = pageCache.get("play", pagename, version)
+        if html is not None: return html
+        html = playPage(pagename)
+        if html is None:
             raise cherrypy.HTTPRedirect("/pages/%s/edit/" % pagename)
+        return pageCache.put("play", pagename, version, html)
 
     def edit(self, pagename):
-        if not os.path.isdir("wiki/%s/" % pagename):
+        """
+        Returns the edit page for 'pagename', from 'pageCache' if possible.
+        Browsers are told not to reuse it without asking, because an old edit
+        page would save old source code over newer changes.
+        """
+        if not pageIndex.hasPage(pagename):
             return template("no-such-page", pagename=pagename)
-        # Load "source.sss" file.
-        sourcefile = file("wiki/%s/source.sss" % pagename, "rb")
-        source = sourcefile.read().decode("UTF-8")
-        sourcefile.close()
-        # Load "properties.txt" file.
-        propsfile = file("wiki/%s/properties.txt" % pagename, "rb")
-        props = parseProperties(propsfile.read().decode("UTF-8"))
-        propsfile.close()
+        cherrypy.response.headers["Cache-Control"] = "no-cache"
+        version = pageCache.version(pagename)
+        html = pageCache.get("edit", pagename, version)
+        if html is not None: return html
+        source = pageStore.readSource(pagename)
+        properties = pageStore.readProperties(pagename)
+        props = parseProperties(properties)
         # Return an editing page.
-        return self.editPage(pagename, None, source, props["width"],
+        html = self.editPage(pagename, None, source, props["width"],
                              props["height"], props["msPerFrame"],
-                             props["name"], props["debug"]!="false", pagename)
+                             props["name"], props["debug"]!="false", pagename,
+                             pageVersion(source, properties))
+        return pageCache.put("edit", pagename, version, html)
     
     def editPage(self, pagename, errormessage, source, width, height,
-                 msPerFrame, name, showDebug, newpage):
+                 msPerFrame, name, showDebug, newpage, version):
         """
         Returns an edit page populated with the specified data. All fields are
         strings except 'showDebug' which is a boolean. 'errormessage' can be
-        'None'. This method compiles the table of images itself.
+        'None'. 'version' is the 'pageVersion()' of the page the source was
+        loaded from. This method compiles the table of images itself.
         """
         # Wrap up 'errormessage' in an HTML paragraph.
         if errormessage:
@@ -216,12 +577,26 @@ class Pages:
         else:
             errormessage = ""
         # Compile a list of the images attached to the page.
-        imagelist = os.listdir("wiki/%s/res" % pagename)
-        imagelist.sort()
-        imagelist = [
-            # "    <td>%s</td>" % image
-            template("fragments/editing-image", pagename=pagename, image=image)
-            for image in imagelist]
+        images = pageIndex.resources(pagename)
+        atlas = None
+        if self.USE_ATLAS:
+            atlas = imaging.atlas([pageStore.resourcePath(pagename, image)
+                                   for image in images])
+        if atlas:
+            atlasfile, positions = atlas
+            # Not 'width', which a list comprehension would overwrite.
+            imagelist = [
+                template("fragments/editing-image-atlas",
+                    pagename=pagename, image=image,
+                    atlas=os.path.basename(atlasfile), x=x,
+                    width=thumbWidth)
+                for (image, (x, thumbWidth)) in zip(images, positions)]
+        else:
+            imagelist = [
+                # "    <td>%s</td>" % image
+                template("fragments/editing-image",
+                    pagename=pagename, image=image)
+                for image in images]
         imagelist = [
             "    <tr>\n" + "\n".join(row) + "\n    </tr>"
             for row in group(imagelist, 5, "     <td></td>")]
@@ -243,13 +618,25 @@ class Pages:
             debugChecked=["", "checked"][showDebug],
             imagelist=imagelist,
             newpage=cgi.escape(newpage),
+            version=cgi.escape(version or "", True),
             uploadedImage="")
 
     def save(self, pagename, source, width, height, msPerFrame, name,
-             newpage, uploadedImage=None, debug=None, save=None, upload=None):
+             newpage, uploadedImage=None, debug=None, save=None, upload=None,
+             version=None):
         if upload:
             return self.uploadImage(pagename, source, width, height, msPerFrame,
-                                    name, newpage, uploadedImage, debug)
+                                    name, newpage, uploadedImage, debug,
+                                    version)
+        if not compileQueue.admits(newpage):
+            # Give the changes back, so that they can be saved later.
+            page = self.editPage(pagename,
+                "Your changes have not been saved because the server is too "
+                "busy compiling other pages. Please try saving again in a "
+                "minute.",
+                source, width, height, msPerFrame, name, debug!=None, newpage,
+                version)
+            return busy(page)
         errormessage = None
         if newpage==pagename: pass  # Unchanged.
         elif not isValidPageName(newpage):
@@ -259,13 +646,8 @@ class Pages:
                 "letter, must contain only letters and digits, must not be "
                 "entirely capital letters, and must have at least three "
                 "characters and at most twenty.") % newpage
-        elif os.path.isdir("wiki/%s/" % newpage):
-            errormessage = (
-                "Your changes have not been saved because a page called "
-                "'%s' already exists.") % newpage
         else:
-            # New page.
-            shutil.copytree("wiki/%s/" % pagename, "wiki/%s/" % newpage)
+            errormessage = self.newPage(pagename, newpage)
         # Check that width, height and msPerFrame are integers.
         try: int(width), int(height), int(msPerFrame)
         except ValueError:
@@ -274,130 +656,384 @@ class Pages:
         # Either save or return to the editing page with an error message.
         if errormessage:
             return self.editPage(pagename, errormessage, source, width, height,
-                                 msPerFrame, name, debug!=None, newpage)
+                                 msPerFrame, name, debug!=None, newpage,
+                                 version)
+        elif newpage==pagename:
+            return self.savePage(pagename, source, width, height,
+                                 msPerFrame, name, debug!=None, version)
         else:
+            # A new page cannot have been changed by anybody else.
             return self.savePage(newpage, source, width, height,
-                                 msPerFrame, name, debug!=None)
+                                 msPerFrame, name, debug!=None, None)
+
+    def newPage(self, pagename, newpage):
+        """
+        Makes 'newpage' a copy of 'pagename'. Returns an error message if
+        'newpage' already exists, otherwise 'None'.
+        """
+        pageLocks.acquire(newpage)
+        try:
+            if pageIndex.hasPage(newpage):
+                return (
+                    "Your changes have not been saved because a page called "
+                    "'%s' already exists.") % newpage
+            pageStore.copyPage(pagename, newpage)
+            pageIndex.addPage(newpage)
+            pageCache.invalidate(newpage)
+            return None
+        finally:
+            pageLocks.release(newpage)
+
+    # The largest image that may be uploaded, in bytes.
+    MAX_IMAGE_SIZE = 102400
 
     def uploadImage(self, pagename, source, width, height, msPerFrame, name,
-                    newpage, uploadedImage, debug):
-        errormessage = None
-        magic = uploadedImage.file.read(4)
+                    newpage, uploadedImage, debug, version):
+        """
+        Adds the images in 'uploadedImage' (one or a list of uploaded files)
+        to 'pagename', and returns an edit page.
+        """
+        if isinstance(uploadedImage, list): images = uploadedImage
+        else: images = [uploadedImage]
+        errormessages = []
+        for image in images:
+            errormessage = self.receiveImage(pagename, image)
+            if errormessage: errormessages.append(errormessage)
+        return self.editPage(pagename, " ".join(errormessages), source, width,
+                             height, msPerFrame, name, debug!=None, newpage,
+                             version)
+
+    def receiveImage(self, pagename, uploadedImage):
+        """
+        Adds one uploaded image to the resources of 'pagename'.
+        Returns an error message, or 'None' if it worked.
+        """
+        if uploadedImage is None or not uploadedImage.filename:
+            return "Image file not found."
+        try:
+            tmpfile, magic = uploads.receive(uploadedImage.file,
+                                             pageStore.uploadDir(pagename),
+                                             self.MAX_IMAGE_SIZE)
+        except uploads.TooLarge:
+            return "Image files must be smaller than 100K."
         if not magic:
-            errormessage = "Image file not found."
-        elif magic[1:4] != "PNG" and magic[:2] != "\xFF\xD8":
-            errormessage = "Images must be in PNG or JPEG format."
-        else:
-            imageData = magic + uploadedImage.file.read(102400-len(magic))
-            if uploadedImage.file.read(1):
-                errormessage = "Image files must be smaller than 100K."
-        if not errormessage:
-            fname = uploadedImage.filename
-            fname = os.path.basename(fname)
-            if (fname.lower().endswith(".png") or
-                fname.lower().endswith(".jpg") or
-                fname.lower().endswith(".jpeg")):
-                fname = fname[:fname.rfind('.')]
-            allowed = string.ascii_letters + string.digits
-            fname = "".join([x for x in fname if x in allowed])
-            if not isValidPageName(fname):
-                fname = "image"
-            existingNames = os.listdir("wiki/%s/res" % pagename)
-            if fname in existingNames:
-                count = 1
-                while True:
-                    proposedName = "%s%d" % (fname, count)
-                    if proposedName not in existingNames: break
-                    count += 1
-                fname = proposedName
-            imageFile = file("wiki/%s/res/%s" % (pagename, fname), "wb")
-            imageFile.write(imageData)
-            imageFile.close()
-        return self.editPage(pagename, errormessage, source, width, height,
-                             msPerFrame, name, debug!=None, newpage)
+            os.remove(tmpfile)
+            return "Image file not found."
+        if not imaging.sniffType(magic):
+            os.remove(tmpfile)
+            return "Images must be in PNG or JPEG format."
+        try:
+            imaging.ingest(tmpfile)
+        except imaging.InvalidImage:
+            os.remove(tmpfile)
+            return "The file '%s' is not a valid image." % (
+                os.path.basename(uploadedImage.filename))
+        fname = uploadedImage.filename
+        fname = os.path.basename(fname)
+        if (fname.lower().endswith(".png") or
+            fname.lower().endswith(".jpg") or
+            fname.lower().endswith(".jpeg")):
+            fname = fname[:fname.rfind('.')]
+        allowed = string.ascii_letters + string.digits
+        fname = "".join([x for x in fname if x in allowed])
+        if not isValidPageName(fname):
+            fname = "image"
+        pageLocks.acquire(pagename)
+        try:
+            fname = pageStore.addResource(pagename, tmpfile, fname,
+                lambda proposedName:
+                    pageIndex.hasResource(pagename, proposedName))
+            pageIndex.addResource(pagename, fname)
+            pageCache.invalidate(pagename)
+        finally:
+            pageLocks.release(pagename)
+        return None
 
     def savePage(self, pagename, source, width, height, msPerFrame, name,
-                 showDebug):
+                 showDebug, version):
         """
-        Saves changes to 'pagename'. Runs the compiler. Returns a redirect to
-        the 'play' page. All parameters are strings except 'showDebug' which is
-        a boolean.
+        Saves changes to 'pagename'. Queues it to be compiled. Returns a
+        redirect to the 'play' page. All parameters are strings except
+        'showDebug' which is a boolean. If 'version' is not 'None' and the
+        page has changed since that version, returns the edit page with an
+        error message instead.
         """
-        # Save the source file, 'source.sss'.
-        sourcefile = file("wiki/%s/source.sss" % pagename, "wb")
-        sourcefile.write(source.encode("UTF-8"))
-        sourcefile.close()
-        # Save the properties file, 'properties.txt'.
         props = makeProperties([
             ("name", name),
             ("width", int(width)), ("height", int(height)),
             ("msPerFrame", int(msPerFrame)),
             ("debug", ["false", "true"][showDebug])
         ])
-        propsfile = file("wiki/%s/properties.txt" % pagename, "wb")
-        propsfile.write(props.encode("UTF-8"))
-        propsfile.close()
-        # Run the compiler.
-        errcode = os.system("/usr/local/share/jdk1.5/bin/java -jar compiler.jar wiki %s" % pagename)
-        if errcode:
-            cherrypy.response.headerMap['Status'] = 500
-            return template("compiler-error")
+        pageLocks.acquire(pagename)
+        try:
+            if version:
+                current = pageVersion(pageStore.readSource(pagename),
+                                      pageStore.readProperties(pagename))
+                if current != version:
+                    return self.editPage(pagename,
+                        "Your changes have not been saved because somebody "
+                        "else has changed this page since you started "
+                        "editing it. Save again to replace their changes "
+                        "with yours.",
+                        source, width, height, msPerFrame, name, showDebug,
+                        pagename, current)
+            self.storePage(pagename, source, props)
+        finally:
+            pageLocks.release(pagename)
+        raise cherrypy.HTTPRedirect("/pages/%s/play/" % pagename)
+
+    def storePage(self, pagename, source, properties):
+        """
+        Records a new revision of 'pagename', replaces its source and
+        properties, and queues the page to be compiled. The revision is
+        recorded first, so that if that fails the page is left as it was,
+        rather than changed but not compiled. The caller must hold the lock
+        for 'pagename'.
+        """
+        if not pageHistory.revisions(pagename):
+            # Keep the version saved before there was any history.
+            pageHistory.add(pagename, pageStore.readSource(pagename),
+                            pageStore.readProperties(pagename))
+        pageHistory.add(pagename, source, properties)
+        pageStore.savePage(pagename, source, properties)
+        pageIndex.setTagLine(pagename, parseTagLine(properties))
+        pageCache.invalidate(pagename)
+        # Compile it in the background.
+        compileQueue.enqueue(pagename)
+
+    def history(self, pagename, *path):
+        """
+        Handles "/pages/<pagename>/history/" and below: the list of
+        revisions, one revision ("<number>/"), the changes made by one
+        revision ("<number>/diff/"), and putting a revision back
+        ("<number>/revert/").
+        """
+        if not pageIndex.hasPage(pagename):
+            return template("no-such-page", pagename=pagename)
+        path = [x for x in path if x]
+        revisions = pageHistory.revisions(pagename)
+        if not path: return self.historyPage(pagename, revisions)
+        try: number = int(path[0])
+        except ValueError: number = 0
+        if not 1 <= number <= len(revisions):
+            return httpError(404, "No such revision '%s'" % cgi.escape(path[0]))
+        if len(path) == 1:
+            return self.revisionPage(pagename, number, len(revisions))
+        if path[1] == "diff": return self.diffPage(pagename, number)
+        if path[1] == "revert": return self.revert(pagename, number)
+        return httpError(404, "Unknown action: %s" % cgi.escape(path[1]))
+
+    def historyPage(self, pagename, revisions):
+        """Returns the list of revisions of 'pagename', newest first."""
+        lines = []
+        for (number, when, kind, size) in reversed(revisions):
+            changes = ""
+            if number > 1:
+                changes = ('<a href="/pages/%s/history/%d/diff/">changes</a>'
+                           % (pagename, number))
+            lines.append(
+                '   <tr><td><a href="/pages/%s/history/%d/">Revision %d</a>'
+                '</td><td>%s</td><td>%s</td></tr>\n'
+                % (pagename, number, number, formatTime(when), changes))
+        if not lines:
+            lines.append('   <tr><td>No changes have been saved yet.</td></tr>')
+        return template2("history", title="History of %s" % pagename,
+                         pagename=pagename, revisions="".join(lines))
+
+    def revisionPage(self, pagename, number, latest):
+        """Returns the source and properties of one revision."""
+        source, properties = pageHistory.revision(pagename, number)
+        revert = ""
+        if number != latest:
+            revert = template("fragments/history-revert",
+                              pagename=pagename, number=number)
+        previous = ""
+        if number > 1:
+            previous = ('<a href="/pages/%s/history/%d/">Previous revision</a>'
+                        % (pagename, number-1))
+        return template2("revision",
+            title="Revision %d of %s" % (number, pagename),
+            pagename=pagename, number=number,
+            when=formatTime(pageHistory.revisions(pagename)[number-1][1]),
+            properties=cgi.escape(properties), source=cgi.escape(source),
+            previous=previous, revert=revert)
+
+    def diffPage(self, pagename, number):
+        """Returns the changes between revision 'number' and the one before."""
+        if number > 1:
+            diff = pageHistory.diff(pagename, number-1, number)
         else:
-            raise cherrypy.HTTPRedirect("/pages/%s/play/" % pagename)
+            diff = u""
+        return template2("diff",
+            title="Changes made by revision %d of %s" % (number, pagename),
+            pagename=pagename, number=number,
+            diff=cgi.escape(diff or u"No changes."))
+
+    def revert(self, pagename, number):
+        """
+        Saves revision 'number' of 'pagename' as a new revision, and returns a
+        redirect to the 'play' page. Only POST requests are accepted, so that
+        following a link cannot change a page.
+        """
+        if cherrypy.request.method != "POST":
+            return httpError(405, "Use the button on the revision page.")
+        if not compileQueue.admits(pagename):
+            return busy(template("error", message=
+                "The server is too busy compiling other pages to revert this "
+                "one now. Please try again in a minute."))
+        source, properties = pageHistory.revision(pagename, number)
+        pageLocks.acquire(pagename)
+        try:
+            self.storePage(pagename, source, properties)
+        finally:
+            pageLocks.release(pagename)
+        raise cherrypy.HTTPRedirect("/pages/%s/play/" % pagename)
     
     def res(self, pagename, imagename):
-        imagefile = file("wiki/%s/res/%s" % (pagename, imagename), "rb")
-        image = imagefile.read()
-        imagefile.close()
-        cherrypy.response.headerMap["Content-Type"] = "image/png"
-        return image
-
-cherrypy.root = Wiki()
-cherrypy.root.pages = Pages()
-cherrypy.config.update(
-  {
-    'global': {
-      # 'server.protocolVersion': "HTTP/1.1",
-      #  ^^ Doesn't seem to work!
-      #     Docs suggest CherryPy supports HTTP 1.0 only unless behind Apache.
-
-      'logDebugInfoFilter.logBuildTime': False,
-      'logDebugInfoFilter.logPageSize': False,
-      'server.socketPort': 8080,
-      'server.socketHost': '127.0.0.1',
-      'server.logAccessFile': '/var/log/nifki',
-      'server.logFile': '/var/log/nifki',
-      'staticFilter.root': '/home/apt1002/python/nifki',
-      'decodingFilter.on': True,
-      'decodingFilter.encoding': 'utf-8',
-      'encodingFilter.on': True,
-      'encodingFilter.encoding': 'utf-8',
-      'gzipFilter.on': True,
-#      'tidyFilter.on': True,  # only turn on temporarily, breaks stuff.
-      'tidyFilter.strictXml': True,
-      'tidyFilter.tmpDir': '/tmp',
-      'tidyFilter.tidyPath': 'tidy',
-    },
-    '/nifki-lib.jar' : {
-      'staticFilter.on': True,
-      'staticFilter.file': 'nifki-lib.jar'
-     },
-    '/stylesheet.css' : {
-      'staticFilter.on': True,
-      'staticFilter.file': 'stylesheet.css'
-     },
-    '/tutorial.txt' : {
-      'staticFilter.on': True,
-      'staticFilter.file': 'templates/tutorial.txt'
-     },
-    '/favicon.ico' : {
-      'staticFilter.on': True,
-      'staticFilter.file': 'favicon.ico'
-     },
-    '/images' : {
-      'staticFilter.on': True,
-      'staticFilter.dir': 'images'
-     },
-  })
-##print cherrypy.config.configMap
-cherrypy.server.start()
+        if not pageIndex.hasResource(pagename, imagename):
+            return httpError(404, "No such picture '%s'" %
+                             cgi.escape(imagename))
+        imagefile = pageStore.resourcePath(pagename, imagename)
+        return serving.serveFile(imagefile, imaging.contentType(imagefile),
+                                 self.RES_MAX_AGE)
+
+    def thumb(self, pagename, imagename):
+        """
+        Returns a small version of a picture, for the edit page. If there
+        is no thumbnail, redirects to the picture itself, rather than
+        sending it here where it would be cached as the thumbnail.
+        """
+        if not pageIndex.hasResource(pagename, imagename):
+            return httpError(404, "No such picture '%s'" %
+                             cgi.escape(imagename))
+        thumbfile = imaging.thumbnail(
+            pageStore.resourcePath(pagename, imagename))
+        if thumbfile is None:
+            raise cherrypy.HTTPRedirect("/pages/%s/res/%s"
+                                        % (pagename, imagename))
+        return serving.serveFile(thumbfile, imaging.contentType(thumbfile),
+                                 self.RES_MAX_AGE)
+
+    def atlas(self, pagename, atlasname):
+        """
+        Returns a picture containing thumbnails of all the pictures on a page,
+        made by 'imaging.atlas()'. Its name includes a hash of its contents.
+        """
+        if not (atlasname.startswith("atlas-") and
+                allAlphaNum(atlasname[6:-4]) and atlasname.endswith(".png")):
+            return httpError(404, "Bad atlas name")
+        atlasfile = os.path.join(imaging.THUMB_DIR, atlasname)
+        if not os.path.exists(atlasfile):
+            return httpError(404, "No such atlas")
+        imaging.touch(atlasfile)
+        return serving.serveFile(atlasfile, "image/png", immutable=True)
+
+root = Wiki()
+root.pages = Pages()
+cherrypy.tree.mount(root, "/")
+
+def openMetricsLog():
+    metricsLog = cherrypy.config.get('nifki.metricsLog')
+    if metricsLog: metrics.openJsonLog(metricsLog)
+
+# The 'export.Exporter' which 'compilePage()' tells about each page, or
+# 'None'. Set by 'openExporter()'.
+exporter = None
+
+def staticExports():
+    """Returns a dict mapping paths to the static files to export there."""
+    ans = {}
+    for (path, (filename, contentType)) in Wiki.staticFiles.items():
+        ans[path] = filename
+    for name in os.listdir("images"):
+        filename = os.path.join("images", name)
+        if not name.startswith(".") and os.path.isfile(filename):
+            ans["images/" + name] = filename
+    return ans
+
+def openExporter():
+    global exporter
+    exportDir = cherrypy.config.get('nifki.exportDir')
+    if exportDir:
+        exporter = export.Exporter(exportDir, pageStore, playPage,
+            {"index.html": lambda: template("welcome-to-nifki"),
+             "pages/index.html": root.pages.firstPage},
+            staticExports(), pageIndex.listingVersion)
+
+def exportPage(pagename):
+    """
+    Brings the export of 'pagename' up to date after it has been compiled,
+    if there is an export. Failures are logged, not raised, because the
+    compilation itself has worked.
+    """
+    if exporter is None: return
+    try:
+        exporter.exportPage(pagename)
+    except Exception:
+        cherrypy.log("Could not export %s" % pagename, "EXPORT",
+                     traceback=True)
+
+def start():
+    """
+    Starts the compiler threads and the web server, and returns when the
+    server stops. SIGTERM stops the server. SIGHUP restarts it if it is not
+    attached to a terminal (and otherwise stops it): requests which are
+    running are given 'server.shutdown_timeout' seconds to finish, and then
+    the process is replaced with a fresh one. SIGUSR1 reopens the log files,
+    for log rotation. A snapshot is saved when the server stops, so that the
+    fresh one starts quickly, and every 'nifki.snapshotInterval' seconds in
+    case it does not stop cleanly.
+    """
+    openMetricsLog()
+    openExporter()
+    for (filename, contentType) in Wiki.staticFiles.values():
+        if compression.isCompressible(contentType):
+            serving.precompress(filename)
+    engine = cherrypy.engine
+    engine.subscribe('start', compileQueue.start)
+    # After the web server has stopped, so that no more saves arrive.
+    engine.subscribe('stop', compileQueue.stop, priority=80)
+    # After the compiler threads have stopped, so that it is up to date.
+    engine.subscribe('stop', saveSnapshot, priority=85)
+    interval = cherrypy.config.get('nifki.snapshotInterval')
+    if interval:
+        Monitor(engine, saveSnapshot, interval, "Snapshot").subscribe()
+    engine.subscribe('graceful', openMetricsLog)
+    if hasattr(engine, "signal_handler"): engine.signal_handler.subscribe()
+    engine.start()
+    engine.block()
+
+def exportAll():
+    """
+    Brings the whole export up to date. Run "python server.py export" once
+    after setting 'nifki.exportDir', and again after changing the static
+    files; the server keeps the pages up to date itself.
+    """
+    openExporter()
+    if exporter is None:
+        sys.stderr.write("'nifki.exportDir' is not set\n")
+        return 1
+    exporter.exportAll()
+    stats = exporter.stats()
+    print "Exported to %s: %d files written, %d deleted" % (
+        exporter.exportDir, stats["written"], stats["deleted"])
+    return 0
+
+def collectGarbage():
+    """
+    Deletes the blobs that no page uses any more (see "blobstore.py"), and
+    the thumbnails that are no longer needed (see "imaging.py"). Run
+    "python server.py gc" from time to time, for example from cron; it is
+    safe to run while the server is running.
+    """
+    count = pageStore.collectGarbage()
+    blobPath = pageStore.blobStore.blobPath
+    thumbs = imaging.collectGarbage(
+        lambda digest: os.path.exists(blobPath(digest)))
+    print "Deleted %d unused blobs and %d thumbnails" % (count, thumbs)
+    return 0
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["export"]: sys.exit(exportAll())
+    if sys.argv[1:] == ["gc"]: sys.exit(collectGarbage())
+    start()
@@ -0,0 +1,181 @@
+"""
+Helpers for sending files over HTTP, so that browsers can cache them.
+
+Every file gets a strong "ETag" computed from its contents and a
+"Last-Modified" header from its modification time, and requests carrying
+"If-None-Match" or "If-Modified-Since" get a "304 Not Modified" response if
+the browser's copy is still good.
+
+Files are sent from disk a chunk at a time, rather than read into memory
+first, and "Range" requests for a single range of bytes are supported.
+
+Files of a compressible type are sent compressed if the browser allows it,
+using the variants kept by 'compression.store'.
+"""
+
+import os, time, rfc822
+import cherrypy
+from digests import fileDigest
+import compression
+
+# One year, which is the longest HTTP/1.1 allows.
+FOREVER = 365 * 24 * 60 * 60
+
+CHUNK_SIZE = 64 * 1024
+
+def httpDate(t):
+    """Formats the time 't' (in seconds since the epoch) for HTTP."""
+    return time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(t))
+
+def parseHttpDate(s):
+    """
+    Parses an HTTP date and returns it in seconds since the epoch, or 'None'
+    if it cannot be parsed.
+    """
+    parsed = rfc822.parsedate_tz(s)
+    if parsed is None: return None
+    return rfc822.mktime_tz(parsed)
+
+def notModified(etag, mtime):
+    """
+    Returns 'True' if the request says that the browser already has the
+    version of the file identified by 'etag' and 'mtime'.
+    """
+    headers = cherrypy.request.headers
+    ifNoneMatch = headers.get("If-None-Match")
+    if ifNoneMatch is not None:
+        # The weak comparison function is allowed for GET requests.
+        tags = []
+        for tag in ifNoneMatch.split(","):
+            tag = tag.strip()
+            if tag.startswith("W/"): tag = tag[2:]
+            tags.append(tag)
+        return etag in tags or "*" in tags
+    ifModifiedSince = headers.get("If-Modified-Since")
+    if ifModifiedSince is not None:
+        since = parseHttpDate(ifModifiedSince.split(";")[0])
+        return since is not None and int(mtime) <= since
+    return False
+
+def parseRange(rangeHeader, size):
+    """
+    Parses the value of a "Range" header for a file of length 'size'.
+    Returns a pair '(start, stop)' if it asks for a single range of bytes,
+    'None' if it should be ignored, or '()' if the range is not satisfiable.
+    """
+    if not rangeHeader.startswith("bytes="): return None
+    ranges = rangeHeader[6:].split(",")
+    if len(ranges) != 1: return None
+    first, dash, last = ranges[0].strip().partition("-")
+    if not dash: return None
+    try:
+        if first:
+            start = int(first)
+            stop = size
+            if last: stop = min(size, int(last) + 1)
+        else:
+            start = max(0, size - int(last))
+            stop = size
+    except ValueError:
+        return None
+    if start >= stop: return ()
+    return start, stop
+
+def fileChunks(f, start, stop):
+    """
+    Generates the bytes of the open file 'f' from 'start' up to 'stop', a
+    chunk at a time, then closes it.
+    """
+    try:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk: break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+def readfile(filename):
+    """Returns the contents of 'filename' as a (byte) string."""
+    f = file(filename, "rb")
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def serveFile(filename, contentType, maxAge=0, immutable=False):
+    """
+    Returns an iterator over the contents of 'filename' with appropriate
+    caching headers, or an empty "304 Not Modified" response if the
+    browser's copy is current.
+    Browsers may use their copy for 'maxAge' seconds without asking again.
+    If 'immutable' is 'True', the file must never change under its URL, so
+    it may be cached forever.
+    """
+    f = file(filename, "rb")
+    st = os.fstat(f.fileno())
+    mtime, size = st.st_mtime, st.st_size
+    digest = fileDigest(filename)
+    etag = '"%s"' % digest
+    response = cherrypy.response
+    headers = response.headers
+    encoding = None
+    if compression.isCompressible(contentType):
+        headers["Vary"] = "Accept-Encoding"
+        if size >= compression.MIN_SIZE:
+            encoding = compression.requestedEncoding()
+    if encoding is not None:
+        # Each variant needs its own entity tag.
+        etag = '"%s-%s"' % (digest, encoding)
+    headers["ETag"] = etag
+    headers["Last-Modified"] = httpDate(mtime)
+    if immutable:
+        headers["Cache-Control"] = "public, max-age=%d, immutable" % FOREVER
+        headers["Expires"] = httpDate(time.time() + FOREVER)
+    else:
+        headers["Cache-Control"] = "public, max-age=%d" % maxAge
+    if notModified(etag, mtime):
+        f.close()
+        response.status = 304
+        headers.pop("Content-Type", None)
+        return ""
+    headers["Content-Type"] = contentType
+    if encoding is not None:
+        f.close()
+        data = compression.store.compressed(digest, encoding,
+                                            lambda: readfile(filename))
+        headers["Content-Encoding"] = encoding
+        headers["Content-Length"] = str(len(data))
+        return [data]
+    headers["Accept-Ranges"] = "bytes"
+    start, stop = 0, size
+    requestHeaders = cherrypy.request.headers
+    rangeHeader = requestHeaders.get("Range")
+    ifRange = requestHeaders.get("If-Range")
+    if rangeHeader and (ifRange is None or ifRange == etag):
+        byteRange = parseRange(rangeHeader, size)
+        if byteRange == ():
+            f.close()
+            response.status = 416
+            headers["Content-Range"] = "bytes */%d" % size
+            headers["Content-Length"] = "0"
+            return ""
+        if byteRange is not None:
+            start, stop = byteRange
+            response.status = 206
+            headers["Content-Range"] = "bytes %d-%d/%d" % (
+                start, stop - 1, size)
+    headers["Content-Length"] = str(stop - start)
+    return fileChunks(f, start, stop)
+
+def precompress(filename):
+    """
+    Puts every compressed variant of 'filename' into 'compression.store'
+    ahead of time, so that the first request for it need not wait.
+    """
+    digest = fileDigest(filename)
+    for encoding in compression.ENCODERS.keys():
+        compression.store.compressed(digest, encoding,
+                                     lambda: readfile(filename))
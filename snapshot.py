@@ -0,0 +1,62 @@
+"""
+What the server has learnt about the wiki, saved so that a restarted server
+does not have to learn it again from the filesystem while the first
+requests wait: the page index (the list of pages, their resources, their
+tag lines and the compiler outputs, see "pageindex.py"), the digests of
+files (see "digests.py"), and the pages waiting to be compiled (see
+"compilequeue.py"). The server saves a snapshot when it stops and
+every 'nifki.snapshotInterval' seconds, and loads it when it starts.
+
+Everything in a snapshot is checked against directory and file
+modification times before it is used, so an old snapshot, or one from
+before the wiki was changed by something else, is safe to load.
+
+The snapshot is written with 'marshal', which is the fastest way to load a
+large structure of lists and strings in Python. It is only ever read by the
+version of Python which wrote it; if it cannot be read, it is ignored.
+"""
+
+import os, marshal
+import digests
+from storage import writefile
+
+# Changed whenever the contents of a snapshot change.
+VERSION = 3
+
+def save(filename, pageIndex, queued):
+    """
+    Writes a snapshot of 'pageIndex', the digests and the list of page names
+    'queued' to 'filename'.
+    """
+    data = marshal.dumps({
+        "version": VERSION,
+        "index": pageIndex.snapshot(),
+        "digests": digests.snapshot(),
+        "queued": queued,
+    })
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname): os.makedirs(dirname)
+    writefile(filename, data)
+
+def load(filename):
+    """
+    Reads the snapshot in 'filename', and restores the digests from it.
+    Returns '(index, queued)', where 'index' is the snapshot of the page
+    index, for 'pageindex.PageIndex()', and 'queued' is the list of pages
+    waiting to be compiled, or '(None, [])' if there is no usable snapshot.
+    """
+    try:
+        f = file(filename, "rb")
+    except IOError:
+        return None, []
+    try:
+        try:
+            snapshot = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            return None, []
+    finally:
+        f.close()
+    if not isinstance(snapshot, dict) or snapshot.get("version") != VERSION:
+        return None, []
+    digests.restore(snapshot["digests"])
+    return snapshot["index"], snapshot["queued"]
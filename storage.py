@@ -0,0 +1,625 @@
+"""
+Where pages are kept. Each page has a source file, a properties file, and a
+set of resources (pictures) whose contents live in the blob store. There are
+two backends with the same methods, so the server does not need to know
+which one it is using:
+
+  - 'FileStorage' keeps each page in its own directory "wiki/<page>/", with
+    the files "source.sss" and "properties.txt" and the directory "res/".
+    This is the layout the compiler reads.
+
+  - 'SQLiteStorage' keeps the source and properties of every page, and the
+    names and hashes of their resources, in one SQLite database. This saves
+    two files and two directories per page.
+
+The compiler never reads pages where they are stored. Instead, each
+compilation gets a private snapshot of the page in a build directory (see
+'buildPath()'), made by 'materialise()', and its output is then moved into
+"wiki/nifki-out" with 'publishOutput()'. So a save that happens during a
+compilation cannot give the compiler a mixture of old and new files, and
+nobody ever sees a half-written jar file. Files are always replaced by
+writing a temporary file and renaming it, so a crash leaves either the old
+or the new version.
+
+Each backend also keeps the revisions recorded by 'history.History', as
+opaque compressed records. Text is passed in and out as unicode strings.
+Both backends keep resources in the same 'blobstore.BlobStore', so
+'migrate.py' can move pages from one to the other without copying any
+pictures.
+"""
+
+import os, time, errno, shutil, thread, threading
+from hashlib import sha1
+from digests import fileDigest
+import blobstore, uploads
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+# The directory in "wiki" where the compiler puts its output.
+OUT_DIR = "nifki-out"
+
+# The files the compiler can produce for a page.
+OUTPUTS = [".jar", ".err"]
+
+DB_PATH = "nifki.db"
+
+# Where the snapshots of pages being compiled are made.
+BUILD_DIR = "cache/build"
+
+# How many pages to ask the database about at once, when reading properties
+# for a list of pages. SQLite allows at most 999 parameters per statement.
+BATCH_SIZE = 500
+
+def readfile(filename):
+    f = file(filename, "rb")
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def writefile(filename, data):
+    """Replaces the contents of 'filename' with 'data' atomically."""
+    tmpfile = "%s.%d.tmp" % (filename, thread.get_ident())
+    f = file(tmpfile, "wb")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmpfile, filename)
+
+def directoryStamp(path):
+    """Returns the modification time of 'path', or 'None' if it is missing."""
+    try: return os.stat(path).st_mtime
+    except OSError: return None
+
+def listDirectory(path):
+    """Returns the names in 'path', or an empty list if it is missing."""
+    try: return os.listdir(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT: raise
+        return []
+
+def buildPath():
+    """
+    Returns the build directory of the current thread, which is laid out
+    like "wiki", creating it if necessary. The process ID is part of the
+    name, because processes forked from the same thread (as by "rebuild.py")
+    have the same thread idents.
+    """
+    path = os.path.join(BUILD_DIR,
+                        "%d-%d" % (os.getpid(), thread.get_ident()))
+    outdir = os.path.join(path, OUT_DIR)
+    if not os.path.isdir(outdir): os.makedirs(outdir)
+    return path
+
+def releaseBuild(buildPath, pagename):
+    """Deletes the snapshot of 'pagename' from 'buildPath'."""
+    path = os.path.join(buildPath, pagename)
+    if os.path.isdir(path): shutil.rmtree(path)
+
+def publishOutput(buildPath, pagename, wikiPath="wiki"):
+    """
+    Moves the compiler output for 'pagename' from 'buildPath' into
+    "<wikiPath>/nifki-out", replacing the old output atomically. Returns the
+    extension of the file moved, or 'None' if there wasn't one, in which case
+    the old output is left alone.
+    """
+    outdir = os.path.join(wikiPath, OUT_DIR)
+    found = None
+    for ext in OUTPUTS:
+        built = os.path.join(buildPath, OUT_DIR, pagename + ext)
+        if os.path.exists(built):
+            os.rename(built, os.path.join(outdir, pagename + ext))
+            found = ext
+            break
+    if found is None: return None
+    for ext in OUTPUTS:
+        if ext == found: continue
+        try: os.remove(os.path.join(outdir, pagename + ext))
+        except OSError: pass
+    return found
+
+class FileStorage:
+    """Pages kept as directories in 'wikiPath'."""
+    def __init__(self, wikiPath="wiki", blobDir=blobstore.BLOB_DIR):
+        self.wikiPath = wikiPath
+        self.blobStore = blobstore.BlobStore(wikiPath, blobDir)
+        # Maps page name to '(size, headers)' where 'headers' lists
+        # '(number, time, kind, size, offset)' for the revisions in the first
+        # 'size' bytes of its history file.
+        self.historyIndex = {}
+
+    def pagePath(self, pagename, *names):
+        return os.path.join(self.wikiPath, pagename, *names)
+
+    def pagesStamp(self):
+        """
+        Returns a value which changes whenever a page is created, for
+        'pageindex.PageIndex' to check cheaply.
+        """
+        return directoryStamp(self.wikiPath)
+
+    def listPages(self):
+        """Returns the names of all pages, in no particular order."""
+        return [name for name in listDirectory(self.wikiPath)
+                if name != OUT_DIR]
+
+    def resourcesStamp(self, pagename):
+        """Like 'pagesStamp()', for the resources of 'pagename'."""
+        return directoryStamp(self.pagePath(pagename, "res"))
+
+    def listResources(self, pagename):
+        """Returns the names of the resources of 'pagename'."""
+        return listDirectory(self.pagePath(pagename, "res"))
+
+    def readSource(self, pagename):
+        return readfile(self.pagePath(pagename, "source.sss")).decode("UTF-8")
+
+    def readProperties(self, pagename):
+        return readfile(
+            self.pagePath(pagename, "properties.txt")).decode("UTF-8")
+
+    def propertiesStamp(self, pagename):
+        """
+        Like 'pagesStamp()', for the properties of 'pagename', which
+        'pageindex.PageIndex' reads the tag line from.
+        """
+        return directoryStamp(self.pagePath(pagename, "properties.txt"))
+
+    def readAllProperties(self, pagenames):
+        """
+        Returns a dict mapping each of 'pagenames' that exists to the contents
+        of its properties file.
+        """
+        ans = {}
+        for pagename in pagenames:
+            try: ans[pagename] = self.readProperties(pagename)
+            except IOError: pass
+        return ans
+
+    def resourceDigests(self, pagename):
+        """Returns a dict mapping resource names of 'pagename' to hashes."""
+        return self.blobStore.manifest(pagename)
+
+    def resourcePath(self, pagename, name):
+        """Returns a filename from which resource 'name' can be read."""
+        return self.blobStore.resourcePath(pagename, name)
+
+    def savePage(self, pagename, source, properties):
+        """Replaces the source and properties of the existing 'pagename'."""
+        writefile(self.pagePath(pagename, "source.sss"),
+                  source.encode("UTF-8"))
+        writefile(self.pagePath(pagename, "properties.txt"),
+                  properties.encode("UTF-8"))
+
+    def putPage(self, pagename, source, properties, resources):
+        """
+        Creates a new page called 'pagename'. 'resources' maps resource names
+        to the hashes of blobs which are already in the blob store. Raises
+        'OSError' if the page already exists.
+        """
+        os.mkdir(self.pagePath(pagename))
+        os.mkdir(self.pagePath(pagename, "res"))
+        self.savePage(pagename, source, properties)
+        for (name, digest) in resources.items():
+            blobstore.linkOrCopy(self.blobStore.blobPath(digest),
+                                 self.pagePath(pagename, "res", name))
+        self.blobStore.writeManifest(pagename, resources)
+
+    def copyPage(self, pagename, newpage):
+        """
+        Makes a new page called 'newpage' which is a copy of 'pagename'.
+        The resources are shared with the original rather than copied.
+        """
+        self.blobStore.copyPage(pagename, newpage)
+
+    def uploadDir(self, pagename):
+        """
+        Returns a directory in which to receive files that will be passed to
+        'addResource()'. It is on the same filesystem as the resources.
+        """
+        return self.pagePath(pagename)
+
+    def addResource(self, pagename, tmpfile, name, isTaken):
+        """
+        Moves 'tmpfile' into the resources of 'pagename', as described for
+        'uploads.install()'. Returns the name used.
+        """
+        name = uploads.install(tmpfile, self.pagePath(pagename, "res"), name,
+                               isTaken)
+        self.blobStore.addResource(pagename, name)
+        return name
+
+    def appendRevision(self, pagename, number, when, kind, data):
+        """
+        Adds a revision to the history of 'pagename'. The history is one file,
+        "history.log", in which each revision is a line
+        "<number> <time> <kind> <size>" followed by 'size' bytes of 'data'.
+        If an earlier append was cut short by a crash, the partial revision
+        is removed first, so that it does not hide this one. The caller holds
+        the lock for 'pagename', so nothing else is appending.
+        """
+        path = self.pagePath(pagename, "history.log")
+        headers = self.readHistoryIndex(pagename)
+        valid = 0
+        if headers: valid = headers[-1][4] + headers[-1][3]
+        try: size = os.path.getsize(path)
+        except OSError: size = 0
+        f = file(path, "ab")
+        try:
+            if size > valid: f.truncate(valid)
+            f.write("%d %d %s %d\n" % (number, when, kind, len(data)))
+            f.write(data)
+        finally:
+            f.close()
+
+    def readHistoryIndex(self, pagename):
+        """
+        Returns the headers of the revisions of 'pagename' with their
+        offsets, reading only the part of the file we have not read before.
+        A revision at the end whose header or data is incomplete is left
+        out; it is either being written now, or was cut short by a crash.
+        """
+        path = self.pagePath(pagename, "history.log")
+        try: size = os.path.getsize(path)
+        except OSError: return []
+        oldSize, headers = self.historyIndex.get(pagename, (0, []))
+        if size == oldSize: return headers
+        headers = list(headers)
+        f = file(path, "rb")
+        try:
+            f.seek(oldSize)
+            while True:
+                line = f.readline()
+                if not line.endswith("\n"): break
+                try:
+                    number, when, kind, length = line.split()
+                    header = (int(number), int(when), kind, int(length),
+                              f.tell())
+                except ValueError:
+                    break
+                if header[4] + header[3] > size: break
+                headers.append(header)
+                f.seek(header[3], 1)
+        finally:
+            f.close()
+        if headers:
+            last = headers[-1]
+            size = last[4] + last[3]
+        else:
+            size = 0
+        self.historyIndex[pagename] = (size, headers)
+        return headers
+
+    def revisionHeaders(self, pagename):
+        """
+        Returns '(number, time, kind, size)' for each revision of 'pagename'.
+        """
+        return [header[:4] for header in self.readHistoryIndex(pagename)]
+
+    def readRevision(self, pagename, number):
+        """Returns the data of revision 'number' of 'pagename'."""
+        number, when, kind, length, offset = (
+            self.readHistoryIndex(pagename)[number-1])
+        f = file(self.pagePath(pagename, "history.log"), "rb")
+        try:
+            f.seek(offset)
+            return f.read(length)
+        finally:
+            f.close()
+
+    def materialise(self, pagename, buildPath):
+        """
+        Makes a snapshot of 'pagename' in "<buildPath>/<pagename>/", for the
+        compiler, replacing anything left there from before. The files are
+        hard links, which keep their contents when the page is saved, because
+        saving replaces them rather than writing into them.
+        """
+        releaseBuild(buildPath, pagename)
+        path = os.path.join(buildPath, pagename)
+        os.makedirs(os.path.join(path, "res"))
+        for fname in ["source.sss", "properties.txt"]:
+            blobstore.linkOrCopy(self.pagePath(pagename, fname),
+                                 os.path.join(path, fname))
+        for name in self.listResources(pagename):
+            blobstore.linkOrCopy(self.pagePath(pagename, "res", name),
+                                 os.path.join(path, "res", name))
+
+    def pageDigests(self, pagename):
+        """
+        Returns a list of '(name, digest)' for the files 'materialise()'
+        would write now, in the order 'compilecache.inputDigests()' lists
+        them.
+        """
+        ans = [(fname, fileDigest(self.pagePath(pagename, fname)))
+               for fname in ["source.sss", "properties.txt"]]
+        names = self.listResources(pagename)
+        names.sort()
+        for name in names:
+            ans.append(("res/" + name,
+                        fileDigest(self.pagePath(pagename, "res", name))))
+        return ans
+
+    def collectGarbage(self, grace=blobstore.GRACE_SECONDS):
+        """
+        Deletes blobs that no page uses and that have not been changed for
+        'grace' seconds. Returns the number deleted.
+        """
+        return self.blobStore.collectGarbage(grace)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    name TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    properties TEXT NOT NULL,
+    resStamp INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS resources (
+    page TEXT NOT NULL,
+    name TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (page, name)
+);
+CREATE INDEX IF NOT EXISTS resourcesByDigest ON resources (digest);
+CREATE TABLE IF NOT EXISTS revisions (
+    page TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (page, number)
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO counters VALUES ('pages', 0);
+"""
+
+class SQLiteStorage:
+    """
+    Pages kept in the SQLite database 'dbPath'. The database is used in WAL
+    mode, so that the many threads reading it do not wait for the one
+    writing. Each thread has its own connection. Every change is made in a
+    single transaction.
+    """
+    def __init__(self, dbPath=DB_PATH, wikiPath="wiki",
+                 blobDir=blobstore.BLOB_DIR):
+        if sqlite3 is None:
+            raise ImportError("SQLiteStorage needs the 'sqlite3' module")
+        self.dbPath = dbPath
+        self.wikiPath = wikiPath
+        self.blobStore = blobstore.BlobStore(wikiPath, blobDir)
+        self.local = threading.local()
+        conn = self.connection()
+        conn.executescript(SCHEMA)
+        conn.commit()
+
+    def connection(self):
+        """Returns the connection belonging to the current thread."""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.dbPath, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def query(self, sql, *args):
+        """Returns all the rows found by 'sql'."""
+        return self.connection().execute(sql, args).fetchall()
+
+    def transaction(self, body):
+        """
+        Calls 'body' with the connection and commits, or rolls back if it
+        raises an exception. Returns the result of 'body'.
+        """
+        conn = self.connection()
+        try:
+            ans = body(conn)
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        return ans
+
+    def pagesStamp(self):
+        return self.query(
+            "SELECT value FROM counters WHERE name = 'pages'")[0][0]
+
+    def listPages(self):
+        return [str(row[0]) for row in self.query("SELECT name FROM pages")]
+
+    def resourcesStamp(self, pagename):
+        rows = self.query("SELECT resStamp FROM pages WHERE name = ?",
+                          pagename)
+        if not rows: return None
+        return rows[0][0]
+
+    def listResources(self, pagename):
+        return [str(row[0]) for row in self.query(
+            "SELECT name FROM resources WHERE page = ?", pagename)]
+
+    def readColumn(self, pagename, column):
+        rows = self.query("SELECT %s FROM pages WHERE name = ?" % column,
+                          pagename)
+        if not rows: raise IOError(errno.ENOENT, "No such page", pagename)
+        return rows[0][0]
+
+    def readSource(self, pagename):
+        return self.readColumn(pagename, "source")
+
+    def readProperties(self, pagename):
+        return self.readColumn(pagename, "properties")
+
+    def propertiesStamp(self, pagename):
+        # Reading the properties is as cheap as reading a stamp would be.
+        return None
+
+    def readAllProperties(self, pagenames):
+        ans = {}
+        for start in range(0, len(pagenames), BATCH_SIZE):
+            batch = pagenames[start:start+BATCH_SIZE]
+            rows = self.query(
+                "SELECT name, properties FROM pages WHERE name IN (%s)"
+                % ",".join(["?"] * len(batch)), *batch)
+            for (name, properties) in rows: ans[str(name)] = properties
+        return ans
+
+    def resourceDigests(self, pagename):
+        ans = {}
+        for (name, digest) in self.query(
+            "SELECT name, digest FROM resources WHERE page = ?", pagename):
+            ans[str(name)] = str(digest)
+        return ans
+
+    def resourcePath(self, pagename, name):
+        rows = self.query(
+            "SELECT digest FROM resources WHERE page = ? AND name = ?",
+            pagename, name)
+        if not rows: raise IOError(errno.ENOENT, "No such resource", name)
+        return self.blobStore.blobPath(str(rows[0][0]))
+
+    def savePage(self, pagename, source, properties):
+        def body(conn):
+            cursor = conn.execute(
+                "UPDATE pages SET source = ?, properties = ? WHERE name = ?",
+                (source, properties, pagename))
+            if cursor.rowcount != 1:
+                raise IOError(errno.ENOENT, "No such page", pagename)
+        self.transaction(body)
+
+    def putPage(self, pagename, source, properties, resources):
+        """
+        Raises 'sqlite3.IntegrityError' if the page already exists.
+        """
+        def body(conn):
+            conn.execute(
+                "INSERT INTO pages (name, source, properties) VALUES (?, ?, ?)",
+                (pagename, source, properties))
+            conn.executemany(
+                "INSERT INTO resources (page, name, digest) VALUES (?, ?, ?)",
+                [(pagename, name, digest)
+                 for (name, digest) in resources.items()])
+            conn.execute(
+                "UPDATE counters SET value = value + 1 WHERE name = 'pages'")
+        self.transaction(body)
+
+    def copyPage(self, pagename, newpage):
+        def body(conn):
+            conn.execute(
+                "INSERT INTO pages (name, source, properties) "
+                "SELECT ?, source, properties FROM pages WHERE name = ?",
+                (newpage, pagename))
+            conn.execute(
+                "INSERT INTO resources (page, name, digest) "
+                "SELECT ?, name, digest FROM resources WHERE page = ?",
+                (newpage, pagename))
+            conn.execute(
+                "UPDATE counters SET value = value + 1 WHERE name = 'pages'")
+        self.transaction(body)
+
+    def uploadDir(self, pagename):
+        blobDir = self.blobStore.blobDir
+        if not os.path.isdir(blobDir):
+            try: os.makedirs(blobDir)
+            except OSError:
+                if not os.path.isdir(blobDir): raise
+        return blobDir
+
+    def addResource(self, pagename, tmpfile, name, isTaken):
+        digest = self.blobStore.add(tmpfile)
+        os.remove(tmpfile)
+        def body(conn):
+            count = 0
+            proposedName = name
+            while True:
+                if not isTaken(proposedName):
+                    try:
+                        conn.execute(
+                            "INSERT INTO resources (page, name, digest) "
+                            "VALUES (?, ?, ?)", (pagename, proposedName, digest))
+                    except sqlite3.IntegrityError:
+                        pass
+                    else:
+                        break
+                count += 1
+                proposedName = "%s%d" % (name, count)
+            conn.execute(
+                "UPDATE pages SET resStamp = resStamp + 1 WHERE name = ?",
+                (pagename,))
+            return proposedName
+        return self.transaction(body)
+
+    def appendRevision(self, pagename, number, when, kind, data):
+        self.transaction(lambda conn: conn.execute(
+            "INSERT INTO revisions (page, number, time, kind, data) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (pagename, number, when, kind, sqlite3.Binary(data))))
+
+    def revisionHeaders(self, pagename):
+        return [(number, when, str(kind), size)
+                for (number, when, kind, size) in self.query(
+                    "SELECT number, time, kind, length(data) FROM revisions "
+                    "WHERE page = ? ORDER BY number", pagename)]
+
+    def readRevision(self, pagename, number):
+        rows = self.query(
+            "SELECT data FROM revisions WHERE page = ? AND number = ?",
+            pagename, number)
+        if not rows: raise KeyError(number)
+        return str(rows[0][0])
+
+    def materialise(self, pagename, buildPath):
+        """
+        Writes out "<buildPath>/<pagename>/" for the compiler, replacing
+        anything left there from before. The resources are hard links to the
+        blobs.
+        """
+        releaseBuild(buildPath, pagename)
+        source = self.readSource(pagename)
+        properties = self.readProperties(pagename)
+        resources = self.resourceDigests(pagename)
+        path = os.path.join(buildPath, pagename)
+        os.makedirs(os.path.join(path, "res"))
+        writefile(os.path.join(path, "source.sss"), source.encode("UTF-8"))
+        writefile(os.path.join(path, "properties.txt"),
+                  properties.encode("UTF-8"))
+        for (name, digest) in resources.items():
+            blobstore.linkOrCopy(self.blobStore.blobPath(digest),
+                                 os.path.join(path, "res", name))
+
+    def pageDigests(self, pagename):
+        def digest(text): return sha1(text.encode("UTF-8")).hexdigest()
+        ans = [("source.sss", digest(self.readSource(pagename))),
+               ("properties.txt", digest(self.readProperties(pagename)))]
+        resources = self.resourceDigests(pagename).items()
+        resources.sort()
+        for (name, digest) in resources: ans.append(("res/" + name, digest))
+        return ans
+
+    def collectGarbage(self, grace=blobstore.GRACE_SECONDS):
+        """
+        Deletes blobs that no page uses. Blobs are not hard linked from
+        pages, so the database is asked which are in use. A blob is added
+        before the page that uses it, so blobs changed in the last 'grace'
+        seconds are kept.
+        """
+        before = time.time() - grace
+        used = {}
+        for (digest,) in self.query("SELECT DISTINCT digest FROM resources"):
+            used[str(digest)] = True
+        count = 0
+        blobDir = self.blobStore.blobDir
+        for subdir in listDirectory(blobDir):
+            subdir = os.path.join(blobDir, subdir)
+            if not os.path.isdir(subdir): continue
+            for name in os.listdir(subdir):
+                blob = os.path.join(subdir, name)
+                if name not in used and os.path.getmtime(blob) < before:
+                    os.remove(blob)
+                    count += 1
+        return count
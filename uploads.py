@@ -0,0 +1,92 @@
+"""
+Receiving uploaded files without holding them in memory.
+
+'checkRequestSize()' rejects request bodies that are obviously too big before
+CherryPy reads them, using the "Content-Length" header, and tells CherryPy
+to stop reading any other body (such as a chunked one, which has no
+"Content-Length") as soon as it is too big. Each uploaded file is
+then copied a chunk at a time into a temporary file next to its destination,
+giving up as soon as it exceeds its size limit, and finally linked into place
+under a name that is not already taken.
+"""
+
+import os, errno, tempfile
+import cherrypy
+
+# The largest request body we will read at all, including the page source
+# which is submitted along with the images.
+MAX_REQUEST_SIZE = 2 * 1024 * 1024
+
+CHUNK_SIZE = 16 * 1024
+
+class TooLarge(Exception):
+    """Raised when an uploaded file is larger than allowed."""
+    pass
+
+def checkRequestSize():
+    """
+    Refuses POST requests whose "Content-Length" exceeds 'MAX_REQUEST_SIZE'
+    with "413 Request Entity Too Large", without reading the body. Bodies
+    without a "Content-Length" get the same answer once 'MAX_REQUEST_SIZE'
+    bytes have been read. This is a "before_request_body" hook for
+    'cherrypy.tools.requestSize'.
+    """
+    request = cherrypy.request
+    if request.method != "POST": return
+    request.body.maxbytes = MAX_REQUEST_SIZE
+    try: length = int(request.headers.get("Content-Length", 0))
+    except ValueError: length = 0
+    if length > MAX_REQUEST_SIZE:
+        raise cherrypy.HTTPError(413,
+            "Uploads must be smaller than %dK in total."
+            % (MAX_REQUEST_SIZE / 1024))
+
+def receive(source, directory, maxSize):
+    """
+    Copies the file-like object 'source' into a new temporary file in
+    'directory'. Returns a pair '(path, head)' where 'path' is the name of
+    the temporary file and 'head' is its first few bytes. Raises 'TooLarge'
+    (and deletes the temporary file) if 'source' has more than 'maxSize'
+    bytes.
+    """
+    fd, path = tempfile.mkstemp(prefix=".upload-", dir=directory)
+    out = os.fdopen(fd, "wb")
+    head = ""
+    size = 0
+    try:
+        try:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk: break
+                if not head: head = chunk[:16]
+                size += len(chunk)
+                if size > maxSize: raise TooLarge()
+                out.write(chunk)
+        finally:
+            out.close()
+    except:
+        os.remove(path)
+        raise
+    return path, head
+
+def install(path, directory, fname, isTaken):
+    """
+    Moves the temporary file 'path' into 'directory', under the name 'fname'
+    if that is free, otherwise 'fname' followed by the smallest number that
+    makes it free. 'isTaken' is a function that says whether a name is
+    known to be in use; names are also checked atomically on disk, so two
+    uploads can never overwrite each other. Returns the name used.
+    """
+    count = 0
+    proposedName = fname
+    while True:
+        if not isTaken(proposedName):
+            try:
+                os.link(path, os.path.join(directory, proposedName))
+            except OSError, e:
+                if e.errno != errno.EEXIST: raise
+            else:
+                os.remove(path)
+                return proposedName
+        count += 1
+        proposedName = "%s%d" % (fname, count)